@@ -1,23 +1,647 @@
 import os
+import sys
+import argparse
 import time
 import threading
 import requests
 import pytchat
 import json
-from flask import Flask
+from flask import Flask, Response, jsonify, request, abort
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
 import re
-from collections import defaultdict
+import csv
+import math
+import socket
+import sqlite3
+import zlib
+import hashlib
+import signal
+import heapq
+import bisect
+import itertools
+import queue
+import random
+import atexit
+import logging
+from logging.handlers import QueueHandler, QueueListener
+from collections import Counter, OrderedDict, defaultdict, deque
+from array import array
+from urllib.parse import urlsplit
+from contextlib import contextmanager
+from requests.adapters import HTTPAdapter
+
+# Parquet export is optional
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+# Vectorized analytics are optional, plain loops are used without NumPy
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 app = Flask(__name__)
 
+# === Logging ===
+# Records go onto a queue and a background listener writes them to stdout,
+# so the chat loop never blocks on terminal I/O. LOG_FORMAT=json emits one
+# JSON object per line, with structured fields passed as extra={"fields": ...}.
+# Raw chat lines are high volume and only a sample is logged.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")  # json or text
+CHAT_LOG_SAMPLE_RATE = float(os.getenv("CHAT_LOG_SAMPLE_RATE", "0.05"))
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, with any structured fields merged in"""
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3],
+            "level": record.levelname,
+            "thread": record.threadName,
+            "msg": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+def setup_logging():
+    """Route the bot logger through a queue to a single writer thread"""
+    output = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == "json":
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, output, respect_handler_level=False)
+    listener.start()
+    atexit.register(listener.stop)
+    
+    bot_logger = logging.getLogger("sunnie")
+    bot_logger.setLevel(LOG_LEVEL)
+    bot_logger.addHandler(QueueHandler(log_queue))
+    bot_logger.propagate = False
+    return bot_logger
+
+logger = setup_logging()
+
+def log_chat_line(stream, chat_item):
+    """Log a sample of raw chat lines"""
+    if logger.isEnabledFor(logging.DEBUG) or random.random() < CHAT_LOG_SAMPLE_RATE:
+        logger.info(f"{chat_item.author.name}: {chat_item.message}", extra={"fields": {
+            "event": "chat",
+            "stream": stream["video_id"],
+            "user": chat_item.author.channelId,
+            "sample_rate": 1.0 if logger.isEnabledFor(logging.DEBUG) else CHAT_LOG_SAMPLE_RATE,
+        }})
+
+def log_command(stream, command, userid, latency_ms, outcome):
+    """Structured record of one processed command"""
+    logger.info(f"{command} {outcome} in {latency_ms:.0f}ms", extra={"fields": {
+        "event": "command",
+        "stream": stream["video_id"],
+        "command": command,
+        "user": userid,
+        "latency_ms": round(latency_ms, 1),
+        "outcome": outcome,
+    }})
+
+# === Tracing ===
+# Each chat command runs inside a trace. Every gspread call and every HTTP
+# request to Google made during it is recorded as a child span. Finished traces
+# go into a bounded ring buffer, the slowest are kept separately, and both are
+# served as JSON on /debug/traces. Outside a trace, span() costs one
+# attribute lookup.
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", "200"))
+TRACE_SLOWEST_SIZE = int(os.getenv("TRACE_SLOWEST_SIZE", "20"))
+
+trace_local = threading.local()
+trace_lock = threading.Lock()
+recent_traces = deque(maxlen=TRACE_BUFFER_SIZE)
+slowest_traces = []  # Min-heap of (duration_ms, seq, trace)
+trace_seq = itertools.count()
+
+@contextmanager
+def start_trace(name, **attrs):
+    """Record a root span and everything traced under it on this thread"""
+    root = {
+        "name": name,
+        "attrs": attrs,
+        "started_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3],
+        "spans": [],
+    }
+    started = time.perf_counter()
+    trace_local.started = started
+    trace_local.stack = [root]
+    try:
+        yield root
+    finally:
+        root["duration_ms"] = round((time.perf_counter() - started) * 1000, 2)
+        trace_local.stack = None
+        record_trace(root)
+
+@contextmanager
+def span(name, **attrs):
+    """Time a child span of the current trace, a no-op when nothing is traced"""
+    stack = getattr(trace_local, "stack", None)
+    if not stack:
+        yield
+        return
+    
+    node = {"name": name, "attrs": attrs, "spans": []}
+    started = time.perf_counter()
+    node["offset_ms"] = round((started - trace_local.started) * 1000, 2)
+    stack[-1]["spans"].append(node)
+    stack.append(node)
+    try:
+        yield
+    except Exception as e:
+        node["error"] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        node["duration_ms"] = round((time.perf_counter() - started) * 1000, 2)
+        stack.pop()
+
+def record_trace(root):
+    """Keep a finished trace in the ring buffer and, if slow enough, in the slowest list"""
+    with trace_lock:
+        recent_traces.append(root)
+        entry = (root["duration_ms"], next(trace_seq), root)
+        if len(slowest_traces) < TRACE_SLOWEST_SIZE:
+            heapq.heappush(slowest_traces, entry)
+        elif entry[0] > slowest_traces[0][0]:
+            heapq.heapreplace(slowest_traces, entry)
+
+class TracedProxy:
+    """Wraps a gspread Spreadsheet or Worksheet so each method call is a span,
+    retried and guarded by the Sheets circuit breaker"""
+    def __init__(self, target):
+        self._target = target
+
+    def __getattr__(self, name):
+        value = getattr(self._target, name)
+        if name.startswith("_") or not callable(value):
+            return value
+        
+        def traced(*args, **kwargs):
+            with span(f"sheets.{name}", sheet=getattr(self._target, "title", None)):
+                result = call_sheets(value, args, kwargs, idempotent=is_idempotent_call(self._target, name))
+            if name in SHEET_WRITE_METHODS and isinstance(self._target, WORKSHEET_TYPES):
+                note_sheet_write(self._target.title, written_rows(name, args, kwargs, result))
+            return wrap_gspread(result)
+        return traced
+
+    def __repr__(self):
+        return f"TracedProxy({self._target!r})"
+
+def wrap_gspread(result):
+    """Trace worksheets handed out by a traced spreadsheet"""
+    if isinstance(result, WORKSHEET_TYPES):
+        return TracedProxy(result)
+    if isinstance(result, list) and result and isinstance(result[0], WORKSHEET_TYPES):
+        return [TracedProxy(sheet) for sheet in result]
+    return result
+
+# Rows this process wrote since the last change-detection probe, so the probe
+# can tell the bot's own writes from manual edits
+CHANGE_POLL_SECONDS = int(os.getenv("CHANGE_POLL_SECONDS", "60"))  # 0 disables change detection
+SHEET_WRITE_METHODS = {"append_row", "append_rows", "update", "update_cell", "batch_update"}
+A1_ROWS = re.compile(r"[A-Z]*(\d+)(?::[A-Z]*(\d+))?")
+
+sheet_write_lock = threading.Lock()
+own_sheet_writes = {}  # worksheet title -> set of row numbers, None when rows moved
+
+def a1_rows(a1):
+    """Row numbers an A1 range covers, None for whole columns"""
+    match = A1_ROWS.fullmatch(str(a1).rsplit("!", 1)[-1].replace("$", ""))
+    if not match:
+        return None
+    first = int(match.group(1))
+    return set(range(first, int(match.group(2) or first) + 1))
+
+def written_rows(name, args, kwargs, result):
+    """Row numbers touched by a worksheet write, None if they can't be told"""
+    try:
+        if name == "update_cell":
+            return {int(args[0])}
+        if name == "update":
+            return a1_rows(args[0] if args else kwargs.get("range_name"))
+        if name == "batch_update":
+            rows = set()
+            for entry in args[0]:
+                entry_rows = a1_rows(entry["range"])
+                if entry_rows is None:
+                    return None
+                rows |= entry_rows
+            return rows
+        return a1_rows(result["updates"]["updatedRange"])  # append_row, append_rows
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+
+def note_sheet_write(title, rows):
+    if not CHANGE_POLL_SECONDS:
+        return  # Nothing drains the record without change detection
+    with sheet_write_lock:
+        if rows is None:
+            own_sheet_writes[title] = None
+        elif own_sheet_writes.get(title, set()) is not None:
+            own_sheet_writes.setdefault(title, set()).update(rows)
+
+class TracedSession(requests.Session):
+    """requests.Session that records calls to Google APIs as spans"""
+    def request(self, method, url, *args, **kwargs):
+        host = urlsplit(url).netloc
+        if not host.endswith("googleapis.com"):
+            return super().request(method, url, *args, **kwargs)
+        
+        with span(f"http.{method.lower()}", host=host, path=urlsplit(url).path):
+            response = super().request(method, url, *args, **kwargs)
+            current = getattr(trace_local, "stack", None)
+            if current:
+                current[-1]["attrs"]["status"] = response.status_code
+            return response
+
+# === Resilient Sheets Access ===
+# Every worksheet call goes through call_sheets (via TracedProxy). Errors are
+# classified: 429 means the call was rejected and is always safe to repeat,
+# 5xx and dropped connections may have been applied, anything else is a
+# real answer from Sheets. Rate limits and server errors are retried with
+# jittered exponential backoff until SHEETS_RETRY_DEADLINE_SECONDS, except
+# that appends and row deletes only retry 429s. After SHEETS_BREAKER_FAILURES
+# transient failures in a row the circuit breaker opens. Calls then fail at
+# once with SheetsUnavailable until one trial call after the cooldown
+# succeeds. SHEETS_BACKEND=fake swaps the spreadsheet for an in-memory one
+# that injects latency and 429/5xx faults, for local runs and benchmarks.
+SHEETS_BACKEND = os.getenv("SHEETS_BACKEND", "google")  # "google" or "fake"
+SHEETS_RETRY_DEADLINE_SECONDS = float(os.getenv("SHEETS_RETRY_DEADLINE_SECONDS", "10"))
+SHEETS_BACKOFF_BASE_SECONDS = float(os.getenv("SHEETS_BACKOFF_BASE_SECONDS", "0.5"))
+SHEETS_BACKOFF_MAX_SECONDS = float(os.getenv("SHEETS_BACKOFF_MAX_SECONDS", "8"))
+SHEETS_BREAKER_FAILURES = int(os.getenv("SHEETS_BREAKER_FAILURES", "5"))
+SHEETS_BREAKER_COOLDOWN_SECONDS = float(os.getenv("SHEETS_BREAKER_COOLDOWN_SECONDS", "30"))
+TRANSIENT_SHEETS_STATUSES = {429, 500, 502, 503, 504}
+NON_IDEMPOTENT_SHEETS_METHODS = {"append_row", "append_rows", "add_worksheet", "add_cols"}
+
+# Fault injection for SHEETS_BACKEND=fake
+SHEETS_FAULT_RATE = float(os.getenv("SHEETS_FAULT_RATE", "0"))  # Share of calls that fail
+SHEETS_FAULT_STATUSES = [int(s) for s in os.getenv("SHEETS_FAULT_STATUSES", "429,500,503").split(",") if s.strip()]
+SHEETS_FAULT_LATENCY_MS = float(os.getenv("SHEETS_FAULT_LATENCY_MS", "0"))  # Mean added latency
+
+class SheetsUnavailable(Exception):
+    """Raised when Sheets stayed busy past the retry deadline or the breaker is open"""
+
+sheets_breaker_lock = threading.Lock()
+sheets_breaker = {
+    "state": "closed",  # closed, open or half_open (one trial call in flight)
+    "failures": 0,      # Transient failures in a row
+    "opened_at": 0.0,
+    "trips": 0,
+    "retries": 0,
+    "rejected": 0,
+}
+
+def sheets_error_status(error):
+    return getattr(getattr(error, "response", None), "status_code", None)
+
+def classify_sheets_error(error):
+    """Returns "rate_limited", "transient" or "permanent" """
+    if isinstance(error, gspread.exceptions.APIError):
+        status = sheets_error_status(error)
+        if status == 429:
+            return "rate_limited"
+        if status in TRANSIENT_SHEETS_STATUSES:
+            return "transient"
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return "transient"
+    return "permanent"
+
+def is_idempotent_call(target, name):
+    """Whether repeating a call that may already have been applied is harmless"""
+    if name in NON_IDEMPOTENT_SHEETS_METHODS:
+        return False
+    # Spreadsheet.batch_update deletes rows, Worksheet.batch_update writes values
+    return name != "batch_update" or isinstance(target, WORKSHEET_TYPES)
+
+def retry_after_seconds(error):
+    try:
+        return float(error.response.headers.get("Retry-After", 0))
+    except (AttributeError, TypeError, ValueError):
+        return 0
+
+def acquire_sheets_call():
+    """Let a call through unless the breaker is open, raises SheetsUnavailable"""
+    with sheets_breaker_lock:
+        if sheets_breaker["state"] == "closed":
+            return
+        if (sheets_breaker["state"] == "open"
+                and time.monotonic() - sheets_breaker["opened_at"] >= SHEETS_BREAKER_COOLDOWN_SECONDS):
+            sheets_breaker["state"] = "half_open"
+            return
+        sheets_breaker["rejected"] += 1
+    raise SheetsUnavailable("Google Sheets is unavailable, waiting for it to recover")
+
+def record_sheets_result(healthy):
+    """Close the breaker on an answer from Sheets, count transient failures toward opening it"""
+    with sheets_breaker_lock:
+        if healthy:
+            sheets_breaker["state"] = "closed"
+            sheets_breaker["failures"] = 0
+            return
+        
+        sheets_breaker["failures"] += 1
+        if sheets_breaker["state"] == "half_open" or sheets_breaker["failures"] >= SHEETS_BREAKER_FAILURES:
+            if sheets_breaker["state"] != "open":
+                sheets_breaker["trips"] += 1
+                logger.warning(f"⚠️ Google Sheets circuit breaker opened for {SHEETS_BREAKER_COOLDOWN_SECONDS:.0f}s "
+                               f"after {sheets_breaker['failures']} failures")
+            sheets_breaker["state"] = "open"
+            sheets_breaker["opened_at"] = time.monotonic()
+
+def call_sheets(method, args, kwargs, idempotent=True):
+    """Call a gspread method, retrying rate limits and server errors within the deadline"""
+    deadline = time.monotonic() + SHEETS_RETRY_DEADLINE_SECONDS
+    attempt = 0
+    while True:
+        acquire_sheets_call()
+        try:
+            result = method(*args, **kwargs)
+        except Exception as e:
+            kind = classify_sheets_error(e)
+            record_sheets_result(kind == "permanent")
+            if kind == "permanent" or (kind == "transient" and not idempotent):
+                raise
+            
+            delay = min(SHEETS_BACKOFF_MAX_SECONDS, SHEETS_BACKOFF_BASE_SECONDS * 2 ** attempt)
+            delay = max(retry_after_seconds(e), random.uniform(delay / 2, delay))
+            if time.monotonic() + delay > deadline:
+                raise SheetsUnavailable(f"Google Sheets is busy, gave up after {attempt + 1} attempts: {e}") from e
+            with sheets_breaker_lock:
+                sheets_breaker["retries"] += 1
+            time.sleep(delay)
+            attempt += 1
+            continue
+        
+        record_sheets_result(True)
+        return result
+
+def sheets_health():
+    with sheets_breaker_lock:
+        return {
+            "sheets_breaker_state": sheets_breaker["state"],
+            "sheets_breaker_trips": sheets_breaker["trips"],
+            "sheets_retries": sheets_breaker["retries"],
+            "sheets_rejected_calls": sheets_breaker["rejected"],
+        }
+
+def column_letter(index):
+    """A1 letters of a 0-based column index"""
+    letters = ""
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+def column_number(letters):
+    """1-based column number of A1 letters"""
+    number = 0
+    for letter in letters:
+        number = number * 26 + ord(letter) - 64
+    return number
+
+FAKE_A1 = re.compile(r"([A-Z]*)(\d*)(?::([A-Z]*)(\d*))?")
+FAKE_MAX_COLUMN = column_number("ZZ")
+
+# Every sheet the setup below opens or creates. Creating one is an append,
+# which is never retried, so an injected fault there would fail the import.
+FAKE_SEED_SHEETS = {
+    "attendance": ["Username", "UserID", "Date"],
+    "session": ["Username", "UserID", "StartTime", "EndTime", "Duration", "Status"],
+    "task": ["Username", "UserID", "TaskName", "CreatedDate", "CompletedDate", "Status"],
+    "xp": ["Username", "UserID", "TotalXP", "LastUpdated"],
+    "goal": ["Username", "UserID", "GoalName", "CreatedDate", "CompletedDate", "Status"],
+    "reminders": ["Username", "UserID", "Message", "DelayMinutes", "CreatedTime", "TriggerTime", "Status",
+                  "SentTime", "ReminderID", "VideoID"],
+    "buddy": ["RequesterUsername", "RequesterID", "TargetUsername", "TargetID", "Status", "RequestDate",
+              "PairedDate", "BuddyType"],
+    "buddy_requests": ["RequesterUsername", "RequesterID", "TargetUsername", "TargetID", "RequestDate", "Status"],
+    "rollup": ["UserID", "Username", "SessionMinutes", "SessionsCompleted", "TasksCompleted", "TasksRemoved",
+               "AttendanceDays", "LastAttendanceDate", "AttendanceStreak", "RemindersSent", "RemindersFailed",
+               "UpdatedAt"],
+}
+
+def injects_faults(method):
+    """Run the fake spreadsheet's fault injection before a fake API call"""
+    def call(self, *args, **kwargs):
+        getattr(self, "spreadsheet", self).inject_fault()
+        return method(self, *args, **kwargs)
+    return call
+
+class FakeWorksheet:
+    """In-memory worksheet with the part of the gspread API the bot uses"""
+    def __init__(self, spreadsheet, title, sheet_id):
+        self.spreadsheet = spreadsheet
+        self.title = title
+        self.id = sheet_id
+        self.rows = []
+    
+    @property
+    def row_count(self):
+        return max(1000, len(self.rows))
+    
+    @property
+    def col_count(self):
+        return FAKE_MAX_COLUMN
+    
+    def bounds(self, a1):
+        """(first_row, last_row, first_col, last_col) of an A1 range, 1-based and inclusive"""
+        if not a1:
+            return 1, len(self.rows), 1, FAKE_MAX_COLUMN
+        first_col, first_row, last_col, last_row = FAKE_A1.fullmatch(a1.replace("$", "")).groups()
+        if last_col is None:
+            last_col, last_row = first_col, first_row
+        return (int(first_row or 1), int(last_row) if last_row else len(self.rows),
+                column_number(first_col) if first_col else 1,
+                column_number(last_col) if last_col else FAKE_MAX_COLUMN)
+    
+    def read(self, a1=None, formatted=True):
+        first_row, last_row, first_col, last_col = self.bounds(a1)
+        values = []
+        for row in self.rows[first_row - 1:last_row]:
+            cells = [str(cell) if formatted else cell for cell in row[first_col - 1:last_col]]
+            while cells and cells[-1] == "":
+                cells.pop()
+            values.append(cells)
+        while values and not values[-1]:
+            values.pop()
+        return values
+    
+    def write(self, row_number, col_number, values):
+        for row_offset, row_values in enumerate(values):
+            while len(self.rows) < row_number + row_offset:
+                self.rows.append([])
+            row = self.rows[row_number + row_offset - 1]
+            for col_offset, value in enumerate(row_values):
+                while len(row) < col_number + col_offset:
+                    row.append("")
+                row[col_number + col_offset - 1] = value
+        self.spreadsheet.modified += 1
+    
+    @injects_faults
+    def get(self, range_name=None, **kwargs):
+        return self.read(range_name)
+    
+    @injects_faults
+    def get_all_values(self, **kwargs):
+        return self.read()
+    
+    @injects_faults
+    def get_all_records(self, **kwargs):
+        values = self.read(formatted=False)
+        if not values:
+            return []
+        header = values[0]
+        return [{name: (row[i] if i < len(row) else "") for i, name in enumerate(header)} for row in values[1:]]
+    
+    @injects_faults
+    def row_values(self, row_number, **kwargs):
+        values = self.read(f"A{row_number}:ZZ{row_number}")
+        return values[0] if values else []
+    
+    @injects_faults
+    def append_rows(self, values, **kwargs):
+        first_row = len(self.read(formatted=False)) + 1
+        self.write(first_row, 1, values)
+        width = max((len(row) for row in values), default=1)
+        return {"updates": {"updatedRange":
+                            f"'{self.title}'!A{first_row}:{column_letter(width - 1)}{first_row + len(values) - 1}"}}
+    
+    def append_row(self, values, **kwargs):
+        return self.append_rows([values], **kwargs)
+    
+    @injects_faults
+    def update(self, range_name, values=None, **kwargs):
+        first_row, _, first_col, _ = self.bounds(range_name)
+        self.write(first_row, first_col, values)
+    
+    @injects_faults
+    def update_cell(self, row, col, value):
+        self.write(row, col, [[value]])
+    
+    @injects_faults
+    def batch_update(self, data, **kwargs):
+        for entry in data:
+            first_row, _, first_col, _ = self.bounds(entry["range"])
+            self.write(first_row, first_col, entry["values"])
+    
+    @injects_faults
+    def clear(self):
+        self.rows = []
+        self.spreadsheet.modified += 1
+
+class FakeSpreadsheet:
+    """In-memory spreadsheet that fails like a busy Sheets API, see SHEETS_FAULT_*"""
+    def __init__(self, title):
+        self.title = title
+        self.id = f"fake-{title}"
+        self.sheets = {}
+        self.modified = 0
+        for sheet_title, header in FAKE_SEED_SHEETS.items():
+            sheet = FakeWorksheet(self, sheet_title, len(self.sheets))
+            sheet.write(1, 1, [header])
+            self.sheets[sheet_title] = sheet
+    
+    def inject_fault(self):
+        if SHEETS_FAULT_LATENCY_MS:
+            time.sleep(random.uniform(0, 2 * SHEETS_FAULT_LATENCY_MS) / 1000)
+        if SHEETS_FAULT_STATUSES and random.random() < SHEETS_FAULT_RATE:
+            status = random.choice(SHEETS_FAULT_STATUSES)
+            response = requests.Response()
+            response.status_code = status
+            response._content = json.dumps({"error": {"code": status, "message": "Injected fault"}}).encode("utf-8")
+            raise gspread.exceptions.APIError(response)
+    
+    @injects_faults
+    def worksheet(self, title):
+        if title not in self.sheets:
+            raise gspread.exceptions.WorksheetNotFound(title)
+        return self.sheets[title]
+    
+    @injects_faults
+    def worksheets(self):
+        return list(self.sheets.values())
+    
+    @injects_faults
+    def add_worksheet(self, title, rows, cols, **kwargs):
+        sheet = FakeWorksheet(self, title, len(self.sheets))
+        self.sheets[title] = sheet
+        self.modified += 1
+        return sheet
+    
+    @injects_faults
+    def values_batch_get(self, ranges, params=None):
+        params = params or {}
+        value_ranges = []
+        for a1 in ranges:
+            title, _, cells = a1.partition("!")
+            sheet = self.sheets[title.strip("'")]
+            values = sheet.read(cells, formatted=params.get("valueRenderOption") != "UNFORMATTED_VALUE")
+            if params.get("majorDimension") == "COLUMNS":
+                width = max((len(row) for row in values), default=0)
+                values = [[row[c] if c < len(row) else "" for row in values] for c in range(width)]
+                for column in values:
+                    while column and column[-1] == "":
+                        column.pop()
+            value_ranges.append({"range": a1, "values": values})
+        return {"valueRanges": value_ranges}
+    
+    @injects_faults
+    def batch_update(self, body):
+        for entry in body.get("requests", []):
+            dimension = entry["deleteDimension"]["range"]
+            sheet = next(sheet for sheet in self.sheets.values() if sheet.id == dimension["sheetId"])
+            del sheet.rows[dimension["startIndex"]:dimension["endIndex"]]
+        self.modified += 1
+
+class FakeSheetsClient:
+    """Stands in for the gspread client when SHEETS_BACKEND=fake"""
+    def __init__(self):
+        self.spreadsheets = {}
+    
+    def open(self, title):
+        if title not in self.spreadsheets:
+            self.spreadsheets[title] = FakeSpreadsheet(title)
+        return self.spreadsheets[title]
+    
+    def request(self, method, endpoint, params=None, **kwargs):
+        """Drive files.get, enough for the change-detection probe"""
+        response = requests.Response()
+        response.status_code = 200
+        modified = sum(spreadsheet.modified for spreadsheet in self.spreadsheets.values())
+        response._content = json.dumps({"modifiedTime": str(modified)}).encode("utf-8")
+        return response
+
+WORKSHEET_TYPES = (gspread.Worksheet, FakeWorksheet)
+
 # Load credentials from environment variable
-VIDEO_ID = os.getenv("YOUTUBE_VIDEO_ID")
+# YOUTUBE_VIDEO_IDS takes a comma-separated list to serve several streams
+VIDEO_IDS = [v.strip() for v in (os.getenv("YOUTUBE_VIDEO_IDS") or os.getenv("YOUTUBE_VIDEO_ID") or "").split(",") if v.strip()]
+VIDEO_ID = VIDEO_IDS[0] if VIDEO_IDS else None  # Default stream
 credentials = json.loads(os.getenv("PROJECTS_JSON", "[]"))
 current_index = 0
 ACCESS_TOKEN = None  # Will be generated using refresh token
+token_lock = threading.Lock()
+
+# One pooled HTTP session shared by every stream
+http = TracedSession()
+http.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
 
 # === Google Sheet Setup ===
 SERVICE_ACCOUNT_FILE = os.getenv("GOOGLE_SERVICE_ACCOUNT_FILE", "/etc/secrets/credentials.json")
@@ -26,15 +650,31 @@ scope = [
     'https://www.googleapis.com/auth/drive'
 ]
 
-# Reminder system variables
-active_reminders = []
-reminder_threads = []
+# Reminder system variables, pending reminders are indexed in memory so
+# listing and cancelling never scan the reminders sheet
+reminder_lock = threading.RLock()
+active_reminders = {}  # ReminderID -> pending reminder, saved in the warm-start snapshot
+user_reminders = defaultdict(list)  # UserID -> ReminderIDs
+reminder_timers = {}  # ReminderID -> threading.Timer
+reminder_sequence = itertools.count(1)
 
 
+def open_worksheet(title, header, rows="1000"):
+    """Open a worksheet, creating it with a header row if it doesn't exist"""
+    try:
+        return spreadsheet.worksheet(title)
+    except gspread.exceptions.WorksheetNotFound:
+        sheet = spreadsheet.add_worksheet(title=title, rows=rows, cols=str(len(header)))
+        sheet.append_row(header)
+        return sheet
+
 # Initialize Google Sheets client
 try:
-    client = gspread.service_account(filename=SERVICE_ACCOUNT_FILE)
-    spreadsheet = client.open("StudyPlusData")
+    if SHEETS_BACKEND == "fake":
+        client = FakeSheetsClient()
+    else:
+        client = gspread.service_account(filename=SERVICE_ACCOUNT_FILE)
+    spreadsheet = TracedProxy(client.open("StudyPlusData"))
     
     # Define separate sheets
     attendance_sheet = spreadsheet.worksheet("attendance")
@@ -45,204 +685,587 @@ try:
     # Add goal sheet - make sure this sheet exists in your Google Sheet
     try:
         goal_sheet = spreadsheet.worksheet("goal")
-    except:
+    except gspread.exceptions.WorksheetNotFound:
         # If goal sheet doesn't exist, create it
         goal_sheet = spreadsheet.add_worksheet(title="goal", rows="1000", cols="6")
         goal_sheet.append_row(["Username", "UserID", "GoalName", "CreatedDate", "CompletedDate", "Status"])
     
     SHEETS_ENABLED = True
-    print("✅ Google Sheets connected successfully")
+    logger.info("✅ Google Sheets connected successfully")
 except Exception as e:
-    print(f"❌ Google Sheets connection failed: {e}")
+    logger.error(f"❌ Google Sheets connection failed: {e}")
     SHEETS_ENABLED = False
 
 # === REMINDER SHEET SETUP ===
 try:
     reminder_sheet = spreadsheet.worksheet("reminders")
-except:
+    # Sheets from before multi-stream support lack the VideoID column
+    reminder_header = reminder_sheet.row_values(1)
+    if "VideoID" not in reminder_header:
+        if reminder_sheet.col_count <= len(reminder_header):
+            reminder_sheet.add_cols(1)
+        reminder_sheet.update_cell(1, len(reminder_header) + 1, "VideoID")
+except gspread.exceptions.WorksheetNotFound:
     # If reminder sheet doesn't exist, create it
-    reminder_sheet = spreadsheet.add_worksheet(title="reminders", rows="1000", cols="9")
-    reminder_sheet.append_row(["Username", "UserID", "Message", "DelayMinutes", "CreatedTime", "TriggerTime", "Status", "SentTime", "ReminderID"])
+    reminder_sheet = spreadsheet.add_worksheet(title="reminders", rows="1000", cols="10")
+    reminder_sheet.append_row(["Username", "UserID", "Message", "DelayMinutes", "CreatedTime", "TriggerTime", "Status", "SentTime", "ReminderID", "VideoID"])
 
 # Add this after the goal_sheet initialization (around line 50-60)
 try:
     buddy_sheet = spreadsheet.worksheet("buddy")
-except:
+except gspread.exceptions.WorksheetNotFound:
     # If buddy sheet doesn't exist, create it
     buddy_sheet = spreadsheet.add_worksheet(title="buddy", rows="1000", cols="8")
     buddy_sheet.append_row(["RequesterUsername", "RequesterID", "TargetUsername", "TargetID", "Status", "RequestDate", "PairedDate", "BuddyType"])
 
 try:
     buddy_requests_sheet = spreadsheet.worksheet("buddy_requests")
-except:
+except gspread.exceptions.WorksheetNotFound:
     # If buddy requests sheet doesn't exist, create it
     buddy_requests_sheet = spreadsheet.add_worksheet(title="buddy_requests", rows="1000", cols="6")
     buddy_requests_sheet.append_row(["RequesterUsername", "RequesterID", "TargetUsername", "TargetID", "RequestDate", "Status"])
 
+# Per-user totals of rows moved out of the hot sheets by archival
+ROLLUP_HEADER = ["UserID", "Username", "SessionMinutes", "SessionsCompleted", "TasksCompleted",
+                 "TasksRemoved", "AttendanceDays", "LastAttendanceDate", "AttendanceStreak",
+                 "RemindersSent", "RemindersFailed", "UpdatedAt"]
+rollup_sheet = open_worksheet("rollup", ROLLUP_HEADER)
+
+# === Time-Sharded Worksheets ===
+# With SHARD_BY_MONTH on, sessions and attendance go to one worksheet per
+# month (e.g. session_2026_10), created at rollover. Reads only touch the
+# current and previous month; older shards are folded into the rollup sheet
+# by the archival job, so all-time totals come from the rollup.
+SHARD_BY_MONTH = os.getenv("SHARD_BY_MONTH", "false").lower() in ("1", "true", "yes")
+SESSION_HEADER = ["Username", "UserID", "StartTime", "EndTime", "Duration", "Status"]
+ATTENDANCE_HEADER = ["Username", "UserID", "Date"]
+SHARD_TITLE_PATTERN = re.compile(r"^(session|attendance)_(\d{4})_(\d{2})$")
+
+shard_lock = threading.Lock()
+shard_sheets = {}  # worksheet title -> worksheet
+shard_month = None  # (year, month) the routing layer last served
+
+def shard_title(base, year, month):
+    return f"{base}_{year}_{month:02d}"
+
+def shard_base(title):
+    """Strip a month suffix, so session_2026_10 maps back to session"""
+    match = SHARD_TITLE_PATTERN.match(title)
+    return match.group(1) if match else title
+
+def routed_months(now=None):
+    """Months a routed read covers: the previous and the current one"""
+    now = now or datetime.now()
+    previous = (now.year - 1, 12) if now.month == 1 else (now.year, now.month - 1)
+    return [previous, (now.year, now.month)]
+
+def _get_shard(base, header, year, month, create):
+    """Get a shard worksheet from the cache, opening or creating it"""
+    title = shard_title(base, year, month)
+    with shard_lock:
+        sheet = shard_sheets.get(title)
+        if sheet is not None:
+            return sheet
+        
+        if create:
+            sheet = open_worksheet(title, header)
+        else:
+            try:
+                sheet = spreadsheet.worksheet(title)
+            except gspread.exceptions.WorksheetNotFound:
+                return None
+        shard_sheets[title] = sheet
+        return sheet
+
+def _check_rollover(now):
+    """Fold the shards that just left the routed window into the rollup"""
+    global shard_month
+    
+    month = (now.year, now.month)
+    if shard_month == month:
+        return
+    first_call = shard_month is None
+    shard_month = month
+    
+    # At startup the archival worker does this on its first run
+    if not first_call:
+        threading.Thread(target=fold_old_shards, daemon=True).start()
+
+def current_session_sheet():
+    """Worksheet new sessions are written to"""
+    if not SHARD_BY_MONTH:
+        return session_sheet
+    now = datetime.now()
+    _check_rollover(now)
+    return _get_shard("session", SESSION_HEADER, now.year, now.month, create=True)
+
+def current_attendance_sheet():
+    """Worksheet new attendance is written to"""
+    if not SHARD_BY_MONTH:
+        return attendance_sheet
+    now = datetime.now()
+    _check_rollover(now)
+    return _get_shard("attendance", ATTENDANCE_HEADER, now.year, now.month, create=True)
+
+def _routed_sheets(base, header, current_sheet):
+    """Sheets a routed read covers, oldest first"""
+    if not SHARD_BY_MONTH:
+        return [current_sheet()]
+    
+    (prev_year, prev_month), _ = routed_months()
+    sheets = []
+    previous = _get_shard(base, header, prev_year, prev_month, create=False)
+    if previous is not None:
+        sheets.append(previous)
+    sheets.append(current_sheet())
+    return sheets
+
+def session_sheets():
+    """Session worksheets to read for active sessions, streaks and recent totals"""
+    return _routed_sheets("session", SESSION_HEADER, current_session_sheet)
+
+def attendance_sheets():
+    """Attendance worksheets to read for streaks"""
+    return _routed_sheets("attendance", ATTENDANCE_HEADER, current_attendance_sheet)
+
+def old_shard_sheets():
+    """Unrouted session/attendance sheets, oldest first, whose rows belong in the rollup"""
+    routed_titles = {shard_title(base, year, month)
+                     for base in ("session", "attendance")
+                     for year, month in routed_months()}
+    
+    old = []
+    for sheet in spreadsheet.worksheets():
+        match = SHARD_TITLE_PATTERN.match(sheet.title)
+        if match and sheet.title not in routed_titles:
+            old.append(((int(match.group(2)), int(match.group(3))), sheet))
+    old.sort(key=lambda item: item[0])
+    
+    # Rows from before sharding was switched on come first
+    return [attendance_sheet, session_sheet] + [sheet for _, sheet in old]
+
+# === Column Queries ===
+# Handlers name the columns they need instead of calling get_all_records.
+# read_columns fetches just those column ranges of one or more worksheets
+# in a single values_batch_get with unformatted values, and returns typed
+# lists: timestamps as datetimes, counts and durations as ints, and
+# everything else as strings. Headers are read once per worksheet.
+#
+# A command that reads several sheets declares them up front with
+# plan_reads. Every declared range comes back in one values_batch_get, and
+# read_columns serves those reads from memory until the command finishes.
+# Index loaders publish what they will read (xp_index_reads and friends),
+# so a cold index joins the same request.
+COLUMN_TYPES = {
+    "Date": "timestamp",
+    "StartTime": "timestamp",
+    "EndTime": "timestamp",
+    "CreatedDate": "timestamp",
+    "CompletedDate": "timestamp",
+    "LastUpdated": "timestamp",
+    "CreatedTime": "timestamp",
+    "TriggerTime": "timestamp",
+    "SentTime": "timestamp",
+    "RequestDate": "timestamp",
+    "PairedDate": "timestamp",
+    "UpdatedAt": "timestamp",
+    "Duration": "duration_minutes",
+    "DelayMinutes": "duration_minutes",
+    "SessionMinutes": "duration_minutes",
+    "TotalXP": "int",
+    "SessionsCompleted": "int",
+    "TasksCompleted": "int",
+    "TasksRemoved": "int",
+    "AttendanceDays": "int",
+    "AttendanceStreak": "int",
+    "RemindersSent": "int",
+    "RemindersFailed": "int",
+}
+SHEETS_EPOCH = datetime(1899, 12, 30)  # Day 0 of serial date numbers
+
+sheet_headers = {}  # worksheet title -> header row
+command_reads = threading.local()  # .columns: read_key -> columns planned for the running command
+
+def parse_cell_value(value, column_type):
+    """Convert one unformatted cell to its column type, None for blanks and bad values"""
+    if value is None or value == "":
+        return None
+    if column_type == "timestamp":
+        if isinstance(value, (int, float)):
+            return SHEETS_EPOCH + timedelta(days=value)
+        return parse_sheet_time(value)
+    if column_type in ("int", "duration_minutes"):
+        try:
+            return int(float(value))
+        except (TypeError, ValueError):
+            return None
+    return str(value)
+
+def format_sheet_time(value):
+    """Inverse of parse_sheet_time, blank for None"""
+    return value.strftime("%Y-%m-%d %H:%M:%S") if value else ""
+
+def load_sheet_headers(sheets):
+    """Read the header rows not cached yet, all in one request"""
+    missing = list({sheet.title: sheet for sheet in sheets if sheet.title not in sheet_headers}.values())
+    for sheet, values in zip(missing, get_ranges([f"'{sheet.title}'!A1:ZZ1" for sheet in missing])):
+        sheet_headers[sheet.title] = [str(c) for c in values[0]] if values else []
+
+def read_key(sheets, names):
+    return tuple(sheet.title for sheet in sheets), tuple(names)
+
+def fetch_columns(reads):
+    """Fetch several (sheets, names) reads in one values_batch_get, keyed by read_key"""
+    reads = list({read_key(*read): read for read in reads}.values())
+    load_sheet_headers([sheet for sheets, _ in reads for sheet in sheets])
+    
+    ranges = []
+    for sheets, names in reads:
+        for sheet in sheets:
+            header = sheet_headers[sheet.title]
+            for name in names:
+                letter = column_letter(header.index(name))
+                ranges.append(f"'{sheet.title}'!{letter}2:{letter}")
+    
+    batch = spreadsheet.values_batch_get(
+        ranges,
+        params={"valueRenderOption": "UNFORMATTED_VALUE", "majorDimension": "COLUMNS"}
+    ) if ranges else {}
+    value_ranges = iter(batch.get("valueRanges", []))
+    
+    results = {}
+    for sheets, names in reads:
+        columns = {name: [] for name in names}
+        columns["_sheet"], columns["_row"] = [], []
+        for sheet in sheets:
+            raw = []
+            for name in names:
+                values = next(value_ranges, {}).get("values", [])
+                raw.append(values[0] if values else [])
+            # Trailing blank cells are left out, so columns can be shorter than the sheet
+            count = max((len(values) for values in raw), default=0)
+            for name, values in zip(names, raw):
+                column_type = COLUMN_TYPES.get(name, "string")
+                values = values + [None] * (count - len(values))
+                columns[name].extend(parse_cell_value(value, column_type) for value in values)
+            columns["_sheet"].extend([sheet] * count)
+            columns["_row"].extend(range(2, count + 2))
+        results[read_key(sheets, names)] = columns
+    return results
+
+@contextmanager
+def command_reads_scope():
+    """Reads planned inside the block are shared until it ends"""
+    command_reads.columns = {}
+    try:
+        yield
+    finally:
+        command_reads.columns = None
+
+def plan_reads(*reads):
+    """Prefetch the (sheets, names) reads a command is about to make in one request"""
+    planned = getattr(command_reads, "columns", None)
+    if planned is None:
+        return  # Outside a command each read goes on its own
+    
+    reads = [read for read in reads if read_key(*read) not in planned]
+    if not reads:
+        return
+    try:
+        planned.update(fetch_columns(reads))
+    except Exception as e:
+        logger.error(f"Error prefetching reads, reading them one by one: {e}")
+
+def read_columns(sheets, names):
+    """Read the named columns of sheets, oldest row first.
+    
+    Returns {name: typed list} plus "_sheet" and "_row" lists giving each
+    value's worksheet and sheet row number. Reads planned for the running
+    command are served without a request.
+    """
+    key = read_key(sheets, names)
+    planned = getattr(command_reads, "columns", None)
+    if planned and key in planned:
+        return planned[key]
+    return fetch_columns([(sheets, names)])[key]
+
+def find_latest(columns, userid, status):
+    """Index of the newest row of a user with a status, or None"""
+    userid = str(userid)
+    for i in range(len(columns["_row"]) - 1, -1, -1):
+        if columns["UserID"][i] == userid and (columns["Status"][i] or "").strip() == status:
+            return i
+    return None
+
 # === Timer Message System ===
-# Global variables for tracking
-chat_message_count = 0
-last_reset_time = datetime.now()
+# Each stream has its own timers, and each timer keeps its own count of chat
+# lines since it last fired, so one timer sending no longer starves the
+# others. Intervals stretch when chat is quiet and shrink when it is busy,
+# based on an EWMA of messages per minute. A stream's worker sleeps until its
+# next timer is due, chat makes one eligible, or the rate has grown enough
+# since it went to sleep that a shorter interval may already be due.
 timer_threads = []
 
-# Timer messages configuration
-TIMER_MESSAGES = [
+TIMER_REFERENCE_RATE = float(os.getenv("TIMER_REFERENCE_RATE", "4"))  # msgs/min where intervals are unscaled
+TIMER_MIN_SCALE = float(os.getenv("TIMER_MIN_SCALE", "0.5"))
+TIMER_MAX_SCALE = float(os.getenv("TIMER_MAX_SCALE", "3"))
+CHAT_RATE_TAU_SECONDS = 300  # EWMA time constant for the chat rate
+TIMER_RESCHEDULE_RATIO = 1.25  # Interval shrink since the worker slept that wakes it to reschedule
+
+# Default timer messages, override with TIMER_MESSAGES_FILE or TIMER_MESSAGES_JSON
+DEFAULT_TIMER_MESSAGES = [
     {
         "message": "To study more attentively and productively, use commands. Type !help to see all commands. Learn how to use them here: https://tinyurl.com/command-user-manual —Use it to make your study more efficient",
         "interval_minutes": 20,
-        "min_chat_lines": 5,
-        "last_sent": None
+        "min_chat_lines": 5
     },
     {
         "message": "Hi guys! I am Sunnie — a former public servant at the Ministry of National Defense, now studying to become an IT official. More about me & the stream: https://tinyurl.com/sunnie-study",
         "interval_minutes": 40,
-        "min_chat_lines": 3,
-        "last_sent": None
+        "min_chat_lines": 3
     },
     {
         "message": "If you want to study with me, do not forget to subscribe and like 😊 If you like to support the live stream: https://buymeacoffee.com/nayakwonelq -Happy studying and thank you 💛",
         "interval_minutes": 55,
-        "min_chat_lines": 6,
-        "last_sent": None
+        "min_chat_lines": 6
     },
     {
         "message": "Chat Rules: Be respectful, no ads/spam/explicit content. Please use English only for chat. Follow moderators. Respect everyone. Spamming, insults, or harassment will lead to a ban",
         "interval_minutes": 30,
-        "min_chat_lines": 7,
-        "last_sent": None
+        "min_chat_lines": 7
     },
     {
         "message": "I usually start my live stream between 10:00 AM and 2:00 AM KST and study for 7 to 10 hours. Any schedule changes due to unforeseen events will be updated instantly via a post on the YT Community tab",
         "interval_minutes": 40,
-        "min_chat_lines": 4,
-        "last_sent": None
+        "min_chat_lines": 4
     },
 ]
 
-def increment_chat_count():
-    """Call this function every time a new chat message is received"""
-    global chat_message_count
-    chat_message_count += 1
+TIMER_MESSAGES_FILE = os.getenv("TIMER_MESSAGES_FILE")
 
-def reset_chat_count_daily():
-    """Reset chat count every 24 hours"""
-    global chat_message_count, last_reset_time
+def load_timer_messages(previous=None):
+    """Load timer configs from the file, env or defaults, keeping state of unchanged timers"""
+    if TIMER_MESSAGES_FILE and os.path.exists(TIMER_MESSAGES_FILE):
+        with open(TIMER_MESSAGES_FILE, encoding="utf-8") as f:
+            configs = json.load(f)
+    elif os.getenv("TIMER_MESSAGES_JSON"):
+        configs = json.loads(os.getenv("TIMER_MESSAGES_JSON"))
+    else:
+        configs = DEFAULT_TIMER_MESSAGES
     
-    while True:
-        now = datetime.now()
-        if now - last_reset_time >= timedelta(days=1):
-            chat_message_count = 0
-            last_reset_time = now
-            print("📊 Daily chat count reset")
-        
-        time.sleep(3600)  # Check every hour
+    old_state = {t["message"]: t for t in previous or []}
+    timers = []
+    for config in configs:
+        old = old_state.get(config["message"], {})
+        timers.append({
+            "message": config["message"],
+            "interval_minutes": float(config["interval_minutes"]),
+            "min_chat_lines": int(config.get("min_chat_lines", 0)),
+            "last_sent": old.get("last_sent"),
+            "chat_lines": old.get("chat_lines", 0)
+        })
+    return timers
 
-def should_send_timer_message(timer_config):
-    """Check if a timer message should be sent"""
-    global chat_message_count
-    
-    now = datetime.now()
-    
-    # Check if enough chat lines have occurred
-    if chat_message_count < timer_config["min_chat_lines"]:
-        return False
+def reload_timer_messages_if_changed(stream):
+    """Pick up edits to TIMER_MESSAGES_FILE without a restart"""
+    if not TIMER_MESSAGES_FILE:
+        return
+    try:
+        mtime = os.path.getmtime(TIMER_MESSAGES_FILE)
+    except OSError:
+        return
+    if mtime == stream["timers_mtime"]:
+        return
     
-    # Check if enough time has passed since last message of this type
+    try:
+        with stream["timer_condition"]:
+            stream["timers"] = load_timer_messages(stream["timers"])
+            stream["timers_mtime"] = mtime
+        logger.info(f"🔄 Loaded {len(stream['timers'])} timer messages for {stream['video_id']}")
+    except (OSError, ValueError, KeyError) as e:
+        logger.error(f"❌ Invalid timer messages file: {e}")
+
+def current_chat_rate(stream, now=None):
+    """Chat messages per minute in a stream, decayed to now"""
+    now = now or time.monotonic()
+    return stream["chat_rate"] * math.exp(-(now - stream["chat_rate_time"]) / CHAT_RATE_TAU_SECONDS) * 60
+
+def increment_chat_count(stream):
+    """Call this function every time a new chat message is received in a stream"""
+    now = time.monotonic()
+    with stream["timer_condition"]:
+        decay = math.exp(-(now - stream["chat_rate_time"]) / CHAT_RATE_TAU_SECONDS)
+        stream["chat_rate"] = stream["chat_rate"] * decay + 1 / CHAT_RATE_TAU_SECONDS
+        stream["chat_rate_time"] = now
+        
+        # Busier chat shortens intervals, reschedule instead of sleeping to the old deadline
+        wait_rate = stream["timer_wait_rate"]
+        wake = (wait_rate is not None
+                and timer_scale(stream["chat_rate"] * 60) * TIMER_RESCHEDULE_RATIO <= timer_scale(wait_rate))
+        for timer_config in stream["timers"]:
+            timer_config["chat_lines"] += 1
+            # Only wake the worker when this line made a timer eligible
+            if timer_config["chat_lines"] == timer_config["min_chat_lines"]:
+                wake = True
+        if wake:
+            stream["timer_condition"].notify()
+
+def timer_scale(rate_per_minute):
+    """Interval multiplier for a chat rate, shorter when chat is busy"""
+    if rate_per_minute <= 0:
+        return TIMER_MAX_SCALE
+    return min(TIMER_MAX_SCALE, max(TIMER_MIN_SCALE, TIMER_REFERENCE_RATE / rate_per_minute))
+
+def timer_interval_seconds(timer_config, rate_per_minute):
+    """Timer interval scaled by how busy chat is"""
+    return timer_config["interval_minutes"] * 60 * timer_scale(rate_per_minute)
+
+def timer_next_due(timer_config, rate_per_minute, now):
+    """When the timer may next fire, or None if it waits on chat lines"""
+    if timer_config["chat_lines"] < timer_config["min_chat_lines"]:
+        return None
     if timer_config["last_sent"] is None:
-        return True
-    
-    time_diff = now - timer_config["last_sent"]
-    required_interval = timedelta(minutes=timer_config["interval_minutes"])
-    
-    return time_diff >= required_interval
+        return now
+    return timer_config["last_sent"] + timedelta(seconds=timer_interval_seconds(timer_config, rate_per_minute))
 
-def send_timer_message(timer_config):
+def send_timer_message(stream, timer_config):
     """Send a timer message and update its last_sent time"""
-    global chat_message_count
-    
     try:
-        send_message(VIDEO_ID, timer_config["message"], ACCESS_TOKEN)
-        timer_config["last_sent"] = datetime.now()
+        # Every instance keeps the schedule, only the leader posts, and not while quota is short
+        if not is_cluster_leader():
+            skipped = "another instance leads the cluster"
+        elif digest_mode:
+            skipped = "digest mode is saving YouTube quota"
+        else:
+            skipped = None
+            send_message(stream["video_id"], timer_config["message"], ACCESS_TOKEN)
         
-        # Reset chat count after sending message
-        chat_message_count = 0
+        with stream["timer_condition"]:
+            timer_config["last_sent"] = datetime.now()
+            # Only this timer starts counting chat lines again
+            timer_config["chat_lines"] = 0
         
-        print(f"📢 Timer message sent: {timer_config['message'][:50]}...")
+        if skipped:
+            increment_metric("timer_messages_skipped")
+            logger.info(f"⏭️ Timer message skipped, {skipped}: {timer_config['message'][:50]}...")
+        else:
+            logger.info(f"📢 Timer message sent: {timer_config['message'][:50]}...")
     except Exception as e:
-        print(f"❌ Error sending timer message: {e}")
+        logger.error(f"❌ Error sending timer message: {e}")
 
-def timer_message_worker():
-    """Background worker to check and send timer messages"""
+def timer_message_worker(stream):
+    """Background worker that sleeps until the stream's next timer message is due"""
+    condition = stream["timer_condition"]
     while True:
         try:
-            for timer_config in TIMER_MESSAGES:
-                if should_send_timer_message(timer_config):
-                    send_timer_message(timer_config)
-                    time.sleep(2)  # Small delay between messages if multiple are due
+            reload_timer_messages_if_changed(stream)
+            
+            with condition:
+                now = datetime.now()
+                rate = current_chat_rate(stream)
+                due_times = [(timer_next_due(t, rate, now), t) for t in stream["timers"]]
+                ready = [t for due, t in due_times if due is not None and due <= now]
+                
+                if not ready:
+                    upcoming = [due for due, _ in due_times if due is not None]
+                    timeout = (min(upcoming) - now).total_seconds() if upcoming else None
+                    if TIMER_MESSAGES_FILE:
+                        # Keep checking the config file for edits
+                        timeout = min(timeout, 60) if timeout is not None else 60
+                    stream["timer_wait_rate"] = rate
+                    condition.wait(timeout)
+                    stream["timer_wait_rate"] = None
+                    continue
+            
+            for timer_config in ready:
+                send_timer_message(stream, timer_config)
+                time.sleep(2)  # Small delay between messages if multiple are due
         except Exception as e:
-            print(f"❌ Timer message worker error: {e}")
-        
-        time.sleep(60)  # Check every minute
+            logger.error(f"❌ Timer message worker error: {e}")
+            time.sleep(60)
 
-def start_timer_system():
-    """Initialize and start the timer message system"""
-    # Start daily reset thread
-    reset_thread = threading.Thread(target=reset_chat_count_daily, daemon=True)
-    reset_thread.start()
-    timer_threads.append(reset_thread)
-    
-    # Start timer message worker thread
-    timer_thread = threading.Thread(target=timer_message_worker, daemon=True)
+def start_timer_system(stream):
+    """Initialize and start the timer message system for a stream"""
+    timer_thread = threading.Thread(target=timer_message_worker, args=(stream,), daemon=True)
     timer_thread.start()
     timer_threads.append(timer_thread)
     
-    print("✅ Timer message system started")
+    logger.info(f"✅ Timer message system started for {stream['video_id']}")
 
-def refresh_access_token_auto():
+def refresh_access_token_auto(failed_token=None):
+    """Refresh the shared access token, skipping it if another stream already did"""
     global ACCESS_TOKEN, current_index
 
-    for _ in range(len(credentials)):
-        cred = credentials[current_index]
-        data = {
-            "client_id": cred["client_id"],
-            "client_secret": cred["client_secret"],
-            "refresh_token": cred["refresh_token"],
-            "grant_type": "refresh_token"
-        }
-        response = requests.post("https://oauth2.googleapis.com/token", data=data)
-        if response.status_code == 200:
-            ACCESS_TOKEN = response.json()["access_token"]
-            print(f"✅ Access token refreshed from: {cred['name']}")
+    with token_lock:
+        if failed_token is not None and ACCESS_TOKEN != failed_token:
             return
-        else:
-            print(f"❌ Failed to refresh from {cred['name']}, trying next...")
-            current_index = (current_index + 1) % len(credentials)
 
-    print("❌ All tokens failed.")
-    ACCESS_TOKEN = None
+        for _ in range(len(credentials)):
+            cred = credentials[current_index]
+            data = {
+                "client_id": cred["client_id"],
+                "client_secret": cred["client_secret"],
+                "refresh_token": cred["refresh_token"],
+                "grant_type": "refresh_token"
+            }
+            response = http.post("https://oauth2.googleapis.com/token", data=data)
+            if response.status_code == 200:
+                ACCESS_TOKEN = response.json()["access_token"]
+                logger.info(f"✅ Access token refreshed from: {cred['name']}")
+                return
+            else:
+                logger.error(f"❌ Failed to refresh from {cred['name']}, trying next...")
+                current_index = (current_index + 1) % len(credentials)
+
+        logger.error("❌ All tokens failed.")
+        ACCESS_TOKEN = None
 
-def send_message(video_id, message_text, access_token):
-    url = "https://youtube.googleapis.com/youtube/v3/liveChat/messages?part=snippet"
+def get_live_chat_id(video_id, access_token):
+    """Get the live chat ID for a video, cached on its stream after the first lookup"""
+    stream = streams.get(video_id)
+    if stream and stream["live_chat_id"]:
+        return stream["live_chat_id"]
 
-    video_info = requests.get(
+    project = current_project()
+    video_info = http.get(
         f"https://www.googleapis.com/youtube/v3/videos?part=liveStreamingDetails&id={video_id}",
         headers={"Authorization": f"Bearer {access_token}"}
     )
+    charge_quota("videos.list")
 
+    if video_info.status_code == 403 and quota_error_reason(video_info) in QUOTA_EXCEEDED_REASONS:
+        mark_quota_exhausted(project)
+        switch_project_if_exhausted("videos.list")
+        return None
     if video_info.status_code != 200:
-        print("❌ Failed to get video info. Trying token refresh.")
-        refresh_access_token_auto()
-        return
+        logger.error("❌ Failed to get video info. Trying token refresh.")
+        refresh_access_token_auto(access_token)
+        return None
 
     try:
         live_details = video_info.json()["items"][0].get("liveStreamingDetails", {})
         live_chat_id = live_details.get("activeLiveChatId")
 
         if not live_chat_id:
-            print("❌ No active live chat found. Is the stream live and is chat enabled?")
-            return
+            logger.error("❌ No active live chat found. Is the stream live and is chat enabled?")
+            return None
     except (IndexError, KeyError) as e:
-        print(f"❌ Error extracting live chat ID: {e}")
+        logger.error(f"❌ Error extracting live chat ID: {e}")
+        return None
+
+    if stream:
+        stream["live_chat_id"] = live_chat_id
+    return live_chat_id
+
+def send_message(video_id, message_text, access_token):
+    url = "https://youtube.googleapis.com/youtube/v3/liveChat/messages?part=snippet"
+
+    switch_project_if_exhausted("liveChatMessages.insert")
+    if ACCESS_TOKEN and ACCESS_TOKEN != access_token:
+        access_token = ACCESS_TOKEN  # The project changed since the caller read the token
+    
+    live_chat_id = get_live_chat_id(video_id, access_token)
+    if not live_chat_id:
         return
 
     headers = {
@@ -259,263 +1282,803 @@ def send_message(video_id, message_text, access_token):
         }
     }
 
-    response = requests.post(url, headers=headers, json=payload)
+    project = current_project()
+    response = http.post(url, headers=headers, json=payload)
+    charge_quota("liveChatMessages.insert")
 
     if response.status_code == 401:
-        print("🔁 Token expired. Refreshing...")
-        refresh_access_token_auto()
-        send_message(video_id, message_text, ACCESS_TOKEN)
+        logger.info("🔁 Token expired. Refreshing...")
+        refresh_access_token_auto(access_token)
+        if ACCESS_TOKEN and ACCESS_TOKEN != access_token:
+            send_message(video_id, message_text, ACCESS_TOKEN)
     elif response.status_code == 200:
-        print(f"✅ Replied: {message_text}")
+        logger.debug(f"✅ Replied: {message_text}")
+    elif response.status_code == 403 and quota_error_reason(response) in QUOTA_EXCEEDED_REASONS:
+        # The chat is fine, only this project is out of quota
+        mark_quota_exhausted(project)
+        switch_project_if_exhausted("liveChatMessages.insert")
+        if ACCESS_TOKEN and ACCESS_TOKEN != access_token:
+            send_message(video_id, message_text, ACCESS_TOKEN)
+        else:
+            logger.error(f"❌ Failed to send message, every project is out of quota: {message_text}")
     else:
-        print("❌ Failed to send message:", response.text)
+        if response.status_code in (403, 404) and video_id in streams:
+            # The chat may have ended or been replaced, look it up again next time
+            streams[video_id]["live_chat_id"] = None
+        logger.error(f"❌ Failed to send message: {response.text}")
 
-# === Helper Functions ===
+# === Streams ===
+# Per-stream state: chat reader, timers, chat rate and live chat ID. The
+# sheets, caches, HTTP session and access token are shared by all streams.
+streams = {}  # video_id -> stream state
+restored_timers = {}  # video_id -> timers from the warm-start snapshot
 
-def get_user_id_by_username(username):
-    """Try to find user ID from existing records"""
-    if not SHEETS_ENABLED:
-        return None
-    
-    try:
-        # Check attendance sheet first
-        records = attendance_sheet.get_all_records()
-        for row in records:
-            if str(row.get('Username', '')).lower() == username.lower():
-                return str(row.get('UserID', ''))
-        
-        # Check session sheet
-        records = session_sheet.get_all_records()
-        for row in records:
-            if str(row.get('Username', '')).lower() == username.lower():
-                return str(row.get('UserID', ''))
-        
-        # Check xp sheet
-        records = xp_sheet.get_all_records()
-        for row in records:
-            if str(row.get('Username', '')).lower() == username.lower():
-                return str(row.get('UserID', ''))
-                
-    except Exception as e:
-        print(f"Error finding user ID: {e}")
-    
-    return None
+def create_stream(video_id):
+    """Register a stream and its own timer state"""
+    stream = {
+        "video_id": video_id,
+        "live_chat_id": None,
+        "timers": load_timer_messages(restored_timers.get(video_id)),
+        "timers_mtime": None,
+        "timer_condition": threading.Condition(),
+        "chat_rate": 0.0,  # Messages per second, as of chat_rate_time
+        "chat_rate_time": time.monotonic(),
+        "timer_wait_rate": None,  # Chat rate the timer worker scheduled its sleep with
+        "chat": None,  # Current pytchat connection
+        "reader_generation": 0,  # Bumped when the supervisor replaces the reader
+        "poll_started": None,  # Monotonic start of the reader's current connect or poll
+        "continuation": None,  # Last pytchat continuation token
+        "is_replay": False,
+        "digest": [],  # Replies waiting for the next digest message
+    }
+    streams[video_id] = stream
+    return stream
 
-def get_active_buddy(userid):
-    """Get user's current active buddy from buddy sheet"""
-    if not SHEETS_ENABLED:
-        return None
+# === Quota Ledger ===
+# Every YouTube Data API call is charged its unit cost against the daily
+# budget of the project (credential) whose token made it. Budgets reset at
+# midnight Pacific time, like YouTube's. The spend rate over the last half
+# hour projects the day's total. When that would pass the budget, replies
+# switch to digest mode: they are queued per stream and posted as combined
+# messages every DIGEST_INTERVAL_SECONDS, and timer messages pause. A project
+# that runs out, or that YouTube answers with quotaExceeded, hands over to
+# the next credential that still has quota. Spend survives restarts in the
+# warm-start snapshot. In cluster mode each instance adds its spend to a
+# shared table on every cluster poll and reads back every project's total,
+# so instances using the same credentials share one budget.
+YOUTUBE_DAILY_QUOTA = int(os.getenv("YOUTUBE_DAILY_QUOTA", "10000"))  # Per project, "daily_quota" in PROJECTS_JSON overrides
+QUOTA_COSTS = {
+    "videos.list": 1,
+    "liveChatMessages.insert": 50,
+}
+QUOTA_COSTS.update(json.loads(os.getenv("QUOTA_COSTS_JSON", "{}")))
+QUOTA_RATE_WINDOW_SECONDS = 1800
+QUOTA_RESUME_RATIO = 0.8  # Leave digest mode once the projection drops below this share of the budget
+QUOTA_RESET_TZ = ZoneInfo("America/Los_Angeles")
+DIGEST_INTERVAL_SECONDS = float(os.getenv("DIGEST_INTERVAL_SECONDS", "60"))
+DIGEST_MAX_CHARS = 200  # Longest live chat message YouTube accepts
+QUOTA_EXCEEDED_REASONS = {"quotaExceeded", "dailyLimitExceeded"}
+
+quota_lock = threading.Lock()
+quota_ledger = {}  # project name -> {"day", "used", "since", "synced", "recent": deque of (monotonic, units)}
+quota_pending = defaultdict(int)  # project name -> units spent here, not yet added to the cluster ledger
+quota_exhausted = set()  # Projects YouTube refused here, not yet marked in the cluster ledger
+digest_mode = False
+
+def current_project():
+    return credentials[current_index]["name"] if credentials else "default"
+
+def project_budget(name):
+    for cred in credentials:
+        if cred["name"] == name:
+            return int(cred.get("daily_quota", YOUTUBE_DAILY_QUOTA))
+    return YOUTUBE_DAILY_QUOTA
+
+def _ledger_entry(name):
+    """A project's ledger for the current quota day, reset after midnight Pacific"""
+    day = datetime.now(QUOTA_RESET_TZ).date()
+    entry = quota_ledger.get(name)
+    if entry is None or entry["day"] != day:
+        entry = quota_ledger[name] = {"day": day, "used": 0, "since": time.monotonic(), "synced": False,
+                                      "recent": deque()}
+    return entry
+
+def projected_quota_usage(name):
+    """Units used today plus the recent spend rate carried to the next reset"""
+    now = time.monotonic()
+    with quota_lock:
+        entry = _ledger_entry(name)
+        recent = entry["recent"]
+        while recent and now - recent[0][0] > QUOTA_RATE_WINDOW_SECONDS:
+            recent.popleft()
+        span = max(300, min(QUOTA_RATE_WINDOW_SECONDS, now - entry["since"]))
+        rate = sum(units for _, units in recent) / span
+        used = entry["used"]
     
-    try:
-        records = buddy_sheet.get_all_records()
-        for row in records:
-            if ((str(row.get('RequesterID')) == str(userid) or str(row.get('TargetID')) == str(userid)) 
-                and str(row.get('Status')) == 'Active'):
-                if str(row.get('RequesterID')) == str(userid):
-                    return {
-                        'buddy_id': str(row.get('TargetID')),
-                        'buddy_name': str(row.get('TargetUsername')),
-                        'paired_date': str(row.get('PairedDate'))
-                    }
-                else:
-                    return {
-                        'buddy_id': str(row.get('RequesterID')),
-                        'buddy_name': str(row.get('RequesterUsername')),
-                        'paired_date': str(row.get('PairedDate'))
-                    }
-    except Exception as e:
-        print(f"Error getting active buddy: {e}")
+    reset = datetime.now(QUOTA_RESET_TZ)
+    seconds_left = (datetime.combine(reset.date() + timedelta(days=1), datetime.min.time(), QUOTA_RESET_TZ)
+                    - reset).total_seconds()
+    return used + rate * seconds_left
+
+def charge_quota(method):
+    """Charge an API call to the current project and re-evaluate digest mode"""
+    units = QUOTA_COSTS.get(method, 1)
+    name = current_project()
+    with quota_lock:
+        entry = _ledger_entry(name)
+        entry["used"] += units
+        entry["recent"].append((time.monotonic(), units))
+        if CLUSTER_DB:
+            quota_pending[name] += units
+    increment_metric("quota_units", units)
+    update_digest_mode(name)
+
+def update_digest_mode(name):
+    """Enter or leave digest mode from a project's projected spend"""
+    global digest_mode
     
-    return None
+    budget = project_budget(name)
+    projected = projected_quota_usage(name)
+    if not digest_mode and projected > budget:
+        digest_mode = True
+        increment_metric("digest_mode_entered")
+        logger.warning(f"⚠️ Quota for {name} projected at {projected:.0f}/{budget} units, switching to digest replies")
+    elif digest_mode and projected < budget * QUOTA_RESUME_RATIO:
+        digest_mode = False
+        logger.info(f"✅ Quota for {name} projected at {projected:.0f}/{budget} units, replying directly again")
 
-def get_pending_buddy_request(username):
-    """Get pending buddy request for username"""
-    if not SHEETS_ENABLED:
+def quota_error_reason(response):
+    """The reason of a YouTube API error response, None if there is none"""
+    try:
+        return response.json()["error"]["errors"][0].get("reason")
+    except (ValueError, KeyError, IndexError, TypeError, AttributeError):
         return None
+
+def mark_quota_exhausted(name):
+    """YouTube refused a call for quota, count the project as spent until the reset"""
+    with quota_lock:
+        entry = _ledger_entry(name)
+        entry["used"] = max(entry["used"], project_budget(name))
+        if CLUSTER_DB:
+            quota_exhausted.add(name)
+    increment_metric("quota_exceeded_responses")
+    logger.warning(f"⚠️ YouTube reports the quota for {name} is exceeded")
+    update_digest_mode(name)
+
+def sync_quota_ledger(conn):
+    """Add this instance's spend to the cluster ledger and read back every project's total"""
+    day = str(datetime.now(QUOTA_RESET_TZ).date())
+    with quota_lock:
+        pending, exhausted = dict(quota_pending), set(quota_exhausted)
+        quota_pending.clear()
+        quota_exhausted.clear()
     
     try:
-        records = buddy_requests_sheet.get_all_records()
-        for i, row in enumerate(records):
-            if (str(row.get('TargetUsername', '')).lower() == username.lower() 
-                and str(row.get('Status')) == 'Pending'):
-                return {
-                    'index': i + 2,  # Sheet row index
-                    'requester_id': str(row.get('RequesterID')),
-                    'requester_name': str(row.get('RequesterUsername')),
-                    'request_date': str(row.get('RequestDate'))
-                }
-    except Exception as e:
-        print(f"Error getting pending request: {e}")
+        for name, units in pending.items():
+            conn.execute("INSERT INTO quota (project, day, used) VALUES (?, ?, ?) "
+                         "ON CONFLICT (project, day) DO UPDATE SET used = used + excluded.used", (name, day, units))
+        for name in exhausted:
+            conn.execute("INSERT INTO quota (project, day, used) VALUES (?, ?, ?) "
+                         "ON CONFLICT (project, day) DO UPDATE SET used = MAX(used, excluded.used)",
+                         (name, day, project_budget(name)))
+        rows = conn.execute("SELECT project, used FROM quota WHERE day = ?", (day,)).fetchall()
+        conn.execute("DELETE FROM quota WHERE day < ?", (day,))
+    except Exception:
+        # Keep the spend for the next poll
+        with quota_lock:
+            for name, units in pending.items():
+                quota_pending[name] += units
+            quota_exhausted.update(exhausted)
+        raise
     
-    return None
+    now = time.monotonic()
+    with quota_lock:
+        for name, used in rows:
+            entry = _ledger_entry(name)
+            total = used + quota_pending.get(name, 0)  # Plus what was spent here during the sync
+            if entry["synced"] and total > entry["used"]:
+                entry["recent"].append((now, total - entry["used"]))  # Peers' spend counts toward the rate
+            entry["used"] = max(entry["used"], total)
+            entry["synced"] = True
+    update_digest_mode(current_project())
 
-def has_pending_request_to(target_username, requester_id):
-    """Check if requester already sent request to target"""
-    if not SHEETS_ENABLED:
-        return False
-    
-    try:
-        records = buddy_requests_sheet.get_all_records()
-        for row in records:
-            if (str(row.get('TargetUsername', '')).lower() == target_username.lower() 
-                and str(row.get('RequesterID')) == str(requester_id)
-                and str(row.get('Status')) == 'Pending'):
-                return True
-    except Exception as e:
-        print(f"Error checking pending request: {e}")
+def has_quota(name, method):
+    with quota_lock:
+        return _ledger_entry(name)["used"] + QUOTA_COSTS.get(method, 1) <= project_budget(name)
+
+def switch_project_if_exhausted(method):
+    """Move to the next credential with quota left when the current one is spent"""
+    global current_index
     
-    return False
+    if has_quota(current_project(), method) or len(credentials) < 2:
+        return
+    for step in range(1, len(credentials)):
+        index = (current_index + step) % len(credentials)
+        if has_quota(credentials[index]["name"], method):
+            with token_lock:
+                logger.warning(f"⚠️ Quota for {current_project()} is spent, switching to {credentials[index]['name']}")
+                current_index = index
+            refresh_access_token_auto()
+            return
 
-def update_user_xp(username, userid, xp_earned, action_type):
-    """Update or create user XP record in the xp sheet"""
-    if not SHEETS_ENABLED:
+def post_reply(video_id, text):
+    """Send a chat reply now, or queue it for the stream's next digest while quota is short"""
+    stream = streams.get(video_id)
+    if digest_mode and stream is not None:
+        with quota_lock:
+            stream["digest"].append(text)
+        increment_metric("digest_replies_queued")
         return
-    
-    try:
-        records = xp_sheet.get_all_records()
-        user_found = False
-        
-        for i, row in enumerate(records):
-            if str(row['UserID']) == str(userid):
-                # Update existing user
-                current_xp = int(row.get('TotalXP', 0))
-                new_total = current_xp + int(xp_earned)
-                xp_sheet.update_cell(i + 2, 3, new_total)  # TotalXP column
-                xp_sheet.update_cell(i + 2, 4, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))  # LastUpdated
-                user_found = True
-                break
-        
-        if not user_found:
-            # Add new user
-            xp_sheet.append_row([
-                username,
-                userid,
-                int(xp_earned),
-                datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            ])
-    except Exception as e:
-        print(f"Error updating XP: {e}")
+    send_message(video_id, text, ACCESS_TOKEN)
 
-def get_user_total_xp(userid):
-    """Get user's total XP from xp sheet"""
-    if not SHEETS_ENABLED:
-        return 0
+def pack_digest(replies):
+    """Join queued replies into as few messages of at most DIGEST_MAX_CHARS as possible"""
+    messages, current = [], ""
+    for reply in replies:
+        if current and len(current) + 3 + len(reply) <= DIGEST_MAX_CHARS:
+            current += " | " + reply
+        else:
+            if current:
+                messages.append(current)
+            current = reply
+    if current:
+        messages.append(current)
+    return messages
+
+def digest_worker():
+    """Background worker that posts each stream's queued replies as combined messages"""
+    while True:
+        time.sleep(DIGEST_INTERVAL_SECONDS)
+        for video_id, stream in list(streams.items()):
+            with quota_lock:
+                replies, stream["digest"] = stream["digest"], []
+            for message in pack_digest(replies):
+                try:
+                    send_message(video_id, message, ACCESS_TOKEN)
+                    increment_metric("digest_messages_sent")
+                except Exception as e:
+                    logger.error(f"❌ Error sending digest: {e}")
+
+def start_quota_system():
+    digest_thread = threading.Thread(target=digest_worker, daemon=True)
+    digest_thread.start()
+    logger.info(f"✅ Quota ledger started, {YOUTUBE_DAILY_QUOTA} units per project per day")
+
+# === Response Cache ===
+# Read-only command replies and per-user query results are cached by
+# (kind, UserID) for a TTL. Writes invalidate exactly the entries they affect,
+# so a cached reply is never older than the data behind it.
+CACHE_TTLS = {
+    "!top": 60,
+    "!rank": 300,
+    "!summary": 300,
+    "!pending": 600,
+    "!comtask": 600,
+    "!buddyprog": 300,
+}
+CACHE_TTLS.update(json.loads(os.getenv("CACHE_TTLS_JSON", "{}")))
+
+# Views that depend on each kind of write
+XP_VIEWS = ("!rank", "!summary")
+TASK_VIEWS = ("!pending", "!comtask", "!summary")
+SESSION_VIEWS = ("!summary", "!buddyprog")
+
+cache_lock = threading.Lock()
+response_cache = {}  # (kind, UserID or None) -> (expires_at, value)
+
+def cache_get(kind, userid=None):
+    """Return a cached value, or None if missing or expired"""
+    key = (kind, str(userid) if userid is not None else None)
+    with cache_lock:
+        entry = response_cache.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del response_cache[key]
+            return None
+    increment_metric("cache_hits")
+    return entry[1]
+
+def cache_put(kind, userid, value):
+    """Store a value for its kind's TTL"""
+    key = (kind, str(userid) if userid is not None else None)
+    with cache_lock:
+        response_cache[key] = (time.monotonic() + CACHE_TTLS.get(kind, 60), value)
+
+def clear_cache():
+    """Drop every cached reply and query result"""
+    with cache_lock:
+        response_cache.clear()
+
+def invalidate_cache(userid, *kinds, broadcast=True):
+    """Drop the given cached views for one user (None for global views)"""
+    userid = str(userid) if userid is not None else None
+    with cache_lock:
+        for kind in kinds:
+            response_cache.pop((kind, userid), None)
+    
+    if broadcast:
+        publish_cluster_event("invalidate_cache", {"userid": userid, "kinds": list(kinds)})
+
+def cached_response(kind, userid, compute):
+    """Serve a read-only command from cache, computing it on a miss"""
+    response = cache_get(kind, userid)
+    if response is not None:
+        return response
+    
+    increment_metric("cache_misses")
+    response = compute()
+    # Warnings and errors are retried on the next call instead of cached
+    if response and not response.startswith("⚠️"):
+        cache_put(kind, userid, response)
+    return response
+
+# === User State ===
+# XP totals and attendance dates live in memory. They are loaded from the
+# sheets on first use, or restored from the warm-start snapshot, and kept
+# current by write-through. XP, rank, streak and leaderboard lookups then
+# need no sheet reads. All-time study minutes (completed sessions plus the
+# rollup) load the same way on the first !stop, to detect badge unlocks. In cluster mode every write is replicated to the
+# other instances.
+#
+# Each viewer gets one slotted UserRecord, found through an integer key.
+# UserIDs are interned once. Attendance is a sorted array of day ordinals.
+# A user costs a few hundred bytes instead of one dict per sheet row; run
+# `python app.py bench-state` to measure it.
+XP_HEADER = ["Username", "UserID", "TotalXP", "LastUpdated"]
+USER_STATE_BUDGET_MB = float(os.getenv("USER_STATE_BUDGET_MB", "256"))
+
+class UserRecord:
+    """In-memory state of one viewer"""
+    __slots__ = ("userid", "username", "total_xp", "xp_row", "attendance", "study_minutes")
+    
+    def __init__(self, userid):
+        self.userid = userid
+        self.username = ""
+        self.total_xp = 0
+        self.xp_row = None  # Row in the xp sheet, None if the user has none yet
+        self.attendance = array("i")  # Sorted date ordinals from the routed attendance sheets
+        self.study_minutes = 0  # Completed session minutes, archived ones included
+
+user_state_lock = threading.RLock()
+user_keys = {}     # UserID -> integer key
+user_records = []  # integer key -> UserRecord
+xp_index_loaded = False
+attendance_index_loaded = False
+study_minutes_loaded = False
+
+def get_user_record(userid, create=False):
+    """Look up a user's record by UserID, optionally creating it"""
+    userid = str(userid)
+    key = user_keys.get(userid)
+    if key is not None:
+        return user_records[key]
+    if not create:
+        return None
+    
+    with user_state_lock:
+        key = user_keys.get(userid)
+        if key is None:
+            userid = sys.intern(userid)
+            key = len(user_records)
+            user_records.append(UserRecord(userid))
+            user_keys[userid] = key
+        return user_records[key]
+
+def user_key(userid):
+    """Integer key of a user, creating the record if needed"""
+    return user_keys[get_user_record(userid, create=True).userid]
+
+def record_xp(userid, username, total_xp, row):
+    """Set a user's XP total and xp sheet row"""
+    with user_state_lock:
+        record = get_user_record(userid, create=True)
+        record.username = username
+        record.total_xp = int(total_xp)
+        record.xp_row = row
+
+def record_attendance(userid, date):
+    """Add an attendance day to a user's record"""
+    day = date.toordinal()
+    with user_state_lock:
+        days = get_user_record(userid, create=True).attendance
+        i = bisect.bisect_left(days, day)
+        if i == len(days) or days[i] != day:
+            days.insert(i, day)
+
+def attended_on(userid, date):
+    record = get_user_record(userid)
+    if not record:
+        return False
+    days = record.attendance
+    i = bisect.bisect_left(days, date.toordinal())
+    return i < len(days) and days[i] == date.toordinal()
+
+def xp_index_reads():
+    """Reads load_xp_index makes, none while the index is loaded"""
+    return [] if xp_index_loaded else [([xp_sheet], ["Username", "UserID", "TotalXP"])]
+
+def attendance_index_reads():
+    """Reads load_attendance_index makes, none while the index is loaded"""
+    return [] if attendance_index_loaded else [(attendance_sheets(), ["UserID", "Date"])]
+
+def study_minutes_reads():
+    """Reads load_study_minutes makes from the session sheets, none while loaded"""
+    return [] if study_minutes_loaded else [(session_sheets(), ["UserID", "Duration", "Status"])]
+
+def load_xp_index():
+    """Rebuild XP totals from the xp sheet"""
+    global xp_index_loaded
+    
+    columns = read_columns([xp_sheet], ["Username", "UserID", "TotalXP"])
+    with user_state_lock:
+        for record in user_records:
+            record.total_xp = 0
+            record.xp_row = None
+        for username, userid, total_xp, row in zip(columns["Username"], columns["UserID"],
+                                                   columns["TotalXP"], columns["_row"]):
+            record_xp(userid or "", username or "", total_xp or 0, row)
+        xp_index_loaded = True
+    check_user_state_budget()
+
+def load_attendance_index():
+    """Rebuild attendance days from the routed attendance sheets"""
+    global attendance_index_loaded
+    
+    columns = read_columns(attendance_sheets(), ["UserID", "Date"])
+    with user_state_lock:
+        for record in user_records:
+            record.attendance = array("i")
+        for userid, date in zip(columns["UserID"], columns["Date"]):
+            if date:
+                record_attendance(userid or "", date.date())
+        attendance_index_loaded = True
+    check_user_state_budget()
+
+def load_study_minutes():
+    """Rebuild all-time study minutes from the session sheets and the rollup"""
+    global study_minutes_loaded
+    
+    columns = read_columns(session_sheets(), ["UserID", "Duration", "Status"])
+    if not rollup_loaded:
+        load_rollup_index()
+    with user_state_lock:
+        for record in user_records:
+            record.study_minutes = 0
+        for userid, duration, status in zip(columns["UserID"], columns["Duration"], columns["Status"]):
+            if (status or "").strip() == "Completed" and duration:
+                get_user_record(userid or "", create=True).study_minutes += duration
+        for userid, rollup in rollup_index.items():
+            minutes = rollup_int(rollup, "SessionMinutes")
+            if minutes:
+                get_user_record(userid, create=True).study_minutes += minutes
+        study_minutes_loaded = True
+
+def record_study_minutes(userid, minutes):
+    """Add a completed session's minutes, returns (old, new) totals or None while not loaded"""
+    if not study_minutes_loaded:
+        return None
+    with user_state_lock:
+        record = get_user_record(userid, create=True)
+        old_total = record.study_minutes
+        record.study_minutes += int(minutes)
+        return old_total, record.study_minutes
+
+def ensure_xp_index():
+    if not xp_index_loaded:
+        load_xp_index()
+
+def ensure_attendance_index():
+    if not attendance_index_loaded:
+        load_attendance_index()
+
+def invalidate_xp_index():
+    global xp_index_loaded
+    xp_index_loaded = False
+
+def invalidate_attendance_index():
+    global attendance_index_loaded
+    attendance_index_loaded = False
+
+def ensure_study_minutes():
+    if not study_minutes_loaded:
+        load_study_minutes()
+
+def invalidate_study_minutes():
+    global study_minutes_loaded
+    study_minutes_loaded = False
+
+def user_state_bytes(records=None):
+    """Approximate memory held by user records, their keys and attendance arrays"""
+    records = user_records if records is None else records
+    total = sys.getsizeof(records)
+    for record in records:
+        total += (sys.getsizeof(record) + sys.getsizeof(record.userid)
+                  + sys.getsizeof(record.username) + sys.getsizeof(record.attendance))
+    if records is user_records:
+        total += sys.getsizeof(user_keys)
+    return total
+
+def check_user_state_budget():
+    """Warn when user state grows past USER_STATE_BUDGET_MB"""
+    used_mb = user_state_bytes() / (1024 * 1024)
+    with metrics_lock:
+        metrics["user_state_bytes"] = int(used_mb * 1024 * 1024)
+        metrics["user_state_users"] = len(user_records)
+    if used_mb > USER_STATE_BUDGET_MB:
+        increment_metric("user_state_over_budget")
+        logger.warning(f"⚠️ User state uses {used_mb:.1f} MB for {len(user_records)} users, "
+                       f"over the {USER_STATE_BUDGET_MB:.0f} MB budget")
+
+def apply_xp_event(payload):
+    """Apply an XP write made by another cluster instance"""
+    if xp_index_loaded:
+        record_xp(payload["userid"], payload["username"], payload["total_xp"], payload["row"])
+    record_xp_award(payload["userid"], payload.get("earned", 0))
+    invalidate_cache(payload["userid"], *XP_VIEWS, broadcast=False)
+    invalidate_cache(None, "!top", broadcast=False)
+
+def apply_session_event(payload):
+    """Apply a session another cluster instance completed"""
+    record_session(payload["userid"], datetime.strptime(payload["date"], "%Y-%m-%d").date(), payload["minutes"])
+    record_study_minutes(payload["userid"], payload["minutes"])
+
+def apply_attendance_event(payload):
+    """Apply attendance logged by another cluster instance"""
+    if attendance_index_loaded:
+        record_attendance(payload["userid"], datetime.strptime(payload["date"], "%Y-%m-%d").date())
+
+# === Windowed Leaderboards ===
+# !top today / week / month rank XP earned inside a rolling window. Every
+# XP award goes into a per-day bucket and into a running total for each
+# window that covers that day. When the day changes, buckets that left a
+# window are subtracted from its totals. Each window keeps its own max-heap
+# of (total, user key) entries. Outdated entries are skipped lazily and the
+# heap is rebuilt when it grows, so a windowed top-k costs about the same
+# as the all-time one. Buckets are saved in the warm-start snapshot.
+LEADERBOARD_WINDOWS = {"today": 1, "week": 7, "month": 30}
+
+leaderboard_lock = threading.RLock()
+xp_buckets = {}  # day ordinal -> {user key: XP earned that day}
+window_totals = {window: {} for window in LEADERBOARD_WINDOWS}  # window -> {user key: XP}
+window_heaps = {window: [] for window in LEADERBOARD_WINDOWS}   # window -> [(-XP, user key)]
+leaderboard_day = None  # Day ordinal the window totals are aligned to
+
+def _add_window_xp(window, key, amount):
+    totals = window_totals[window]
+    total = totals.get(key, 0) + amount
+    if total > 0:
+        totals[key] = total
+        heapq.heappush(window_heaps[window], (-total, key))
+    else:
+        totals.pop(key, None)
+    
+    # Drop outdated entries once they outnumber the live ones
+    heap = window_heaps[window]
+    if len(heap) > 2 * len(totals) + 64:
+        heap[:] = [(-xp, k) for k, xp in totals.items()]
+        heapq.heapify(heap)
+
+def advance_leaderboard_day(today):
+    """Expire buckets that fell out of each window since the last aligned day"""
+    global leaderboard_day
+    
+    with leaderboard_lock:
+        if leaderboard_day is None:
+            leaderboard_day = today
+        if today <= leaderboard_day:
+            return
+        
+        for window, days in LEADERBOARD_WINDOWS.items():
+            # Days leaving the window: from the old start to the day before the new start
+            for day in range(leaderboard_day - days + 1, min(today - days + 1, leaderboard_day + 1)):
+                for key, xp in xp_buckets.get(day, {}).items():
+                    _add_window_xp(window, key, -xp)
+        
+        oldest = today - max(LEADERBOARD_WINDOWS.values()) + 1
+        for day in [day for day in xp_buckets if day < oldest]:
+            del xp_buckets[day]
+        leaderboard_day = today
+
+def record_xp_award(userid, amount, day=None):
+    """Count an XP award in its day bucket and the windows covering that day"""
+    today = datetime.now().date().toordinal()
+    day = today if day is None else day
+    amount = int(amount)
+    if not amount or day > today or day <= today - max(LEADERBOARD_WINDOWS.values()):
+        return
+    
+    key = user_key(userid)
+    with leaderboard_lock:
+        advance_leaderboard_day(today)
+        bucket = xp_buckets.setdefault(day, {})
+        bucket[key] = bucket.get(key, 0) + amount
+        for window, days in LEADERBOARD_WINDOWS.items():
+            if day > today - days:
+                _add_window_xp(window, key, amount)
+
+def window_top(window, k=5):
+    """Top k (user key, XP) pairs of a window"""
+    with leaderboard_lock:
+        advance_leaderboard_day(datetime.now().date().toordinal())
+        totals, heap = window_totals[window], window_heaps[window]
+        top, seen = [], set()
+        while heap and len(top) < k:
+            neg_xp, key = heapq.heappop(heap)
+            if key in seen or totals.get(key) != -neg_xp:
+                continue  # Outdated entry
+            seen.add(key)
+            top.append((key, -neg_xp))
+        for key, xp in top:
+            heapq.heappush(heap, (-xp, key))
+        return top
+
+# === Helper Functions ===
+
+def update_user_xp(username, userid, xp_earned, action_type):
+    """Update or create user XP record in the xp sheet"""
+    if not SHEETS_ENABLED:
+        return
     
     try:
-        records = xp_sheet.get_all_records()
-        for row in records:
-            if str(row['UserID']) == str(userid):
-                return int(row.get('TotalXP', 0))
-        return 0
-    except:
+        with user_state_lock:
+            ensure_xp_index()
+            record = get_user_record(userid)
+            now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            
+            old_total = record.total_xp if record else 0
+            if record and record.xp_row:
+                # Update existing user, TotalXP and LastUpdated in one call
+                new_total = record.total_xp + int(xp_earned)
+                row = record.xp_row
+                xp_sheet.update(f"C{row}:D{row}", [[new_total, now]], value_input_option="USER_ENTERED")
+            else:
+                # Add new user
+                new_total = int(xp_earned)
+                response = xp_sheet.append_row([
+                    username,
+                    userid,
+                    new_total,
+                    now
+                ])
+                row = appended_row_index(response)
+                if row is None:
+                    invalidate_xp_index()
+            
+            record_xp(userid, username, new_total, row)
+        
+        record_xp_award(userid, xp_earned)
+        queue_rank_up(username, userid, old_total, new_total)
+        publish_cluster_event("xp", {"userid": str(userid), "username": username,
+                                     "total_xp": new_total, "row": row, "earned": int(xp_earned)})
+        invalidate_cache(userid, *XP_VIEWS, broadcast=False)
+        invalidate_cache(None, "!top", broadcast=False)
+    except Exception as e:
+        logger.error(f"Error updating XP: {e}")
+
+def get_user_total_xp(userid):
+    """Get user's total XP from the XP index, raises if the XP sheet can't be read"""
+    if not SHEETS_ENABLED:
         return 0
+    
+    ensure_xp_index()
+    record = get_user_record(userid)
+    return record.total_xp if record else 0
 
 def calculate_streak(userid):
-    """Calculate daily streak from attendance sheet"""
+    """Calculate daily streak from the attendance index, raises if the sheets can't be read"""
     if not SHEETS_ENABLED:
         return 0
     
-    try:
-        records = attendance_sheet.get_all_records()
-        dates = set()
-        for row in records:
-            if str(row['UserID']) == str(userid):
-                try:
-                    date = datetime.strptime(str(row['Date']), "%Y-%m-%d %H:%M:%S").date()
-                    dates.add(date)
-                except ValueError:
-                    pass
+    ensure_attendance_index()
+    record = get_user_record(userid)
 
-        if not dates:
-            return 0
+    if not record or not record.attendance:
+        return 0
 
-        streak = 0
-        today = datetime.now().date()
+    # Walk back from the newest day while the days are consecutive
+    streak = 0
+    today = datetime.now().date()
+    expected = today.toordinal()
+    for day in reversed(record.attendance):
+        if day > expected:
+            continue
+        if day != expected:
+            break
+        streak += 1
+        expected -= 1
+    
+    # Continue into the archived streak if the hot rows reach back to it
+    rollup = get_user_rollup(userid)
+    if streak and str(rollup.get('LastAttendanceDate') or '') == str(today - timedelta(days=streak)):
+        streak += rollup_int(rollup, 'AttendanceStreak')
+    return streak
 
-        for i in range(0, 365):
-            day = today - timedelta(days=i)
-            if day in dates:
-                streak += 1
-            else:
-                break
-        return streak
-    except:
-        return 0
+# Rank and badge tiers, sorted by threshold so lookups are a bisect
+RANK_TIERS = [
+    (0, "🍼 Lost in the Mist"),
+    (30, "👣 Silent Steps"),
+    (60, "🎒 Scroll Carrier"),
+    (120, "🥋 Beltless Initiate"),
+    (200, "🔪 Kunai Rookie"),
+    (300, "🦊 Masked Novice"),
+    (400, "💨 Hidden Leafling"),
+    (550, "🌪️ Shadow Trainee"),
+    (700, "🥷 Ninja Adept"),
+    (850, "🎯 Swift Claw"),
+    (1000, "🌑 Nightcrawler"),
+    (1200, "🌀 Silent Tempest"),
+    (1500, "🐉 Mystic Ninja"),
+    (2000, "⚔️ Stealth Slayer"),
+    (2500, "🔥 Phantom Shinobi"),
+    (3000, "💥 Shadowblade Ninja"),
+    (4000, "🌪️ Stormborn Silent Tempest"),
+    (5000, "🔥 Dragonfire Mystic Ninja"),
+    (6000, "⚡ Ascended Stealth Slayer"),
+    (8000, "🛡️ Legendary Phantom Shinobi"),
+    (10000, "🌌 Eternal Shadowblade"),
+    (15000, "🥷⚔️Sunnie's Study Café's Ninja"),
+    (20000, "🤴Study Leader of the month"),
+]
+RANK_THRESHOLDS = [threshold for threshold, _ in RANK_TIERS]
+
+BADGE_TIERS = [
+    (30, "🥷 Silent Scroll"),
+    (60, "🗡️ Swift Kunai"),
+    (90, "🌀 Shadow Shuriken"),
+    (120, "🌑 Nightblade"),
+    (180, "⚡ Lightning Step"),
+    (240, "🔥 Fire Lotus"),
+    (300, "🐉 Dragon's Breath"),
+    (420, "🌪️ Tornado Strike"),
+    (600, "🛡️ Phantom Guard"),
+    (800, "💥 Shadow Master"),
+    (1000, "🌌 Eternal Ninja"),
+]
+BADGE_THRESHOLDS = [threshold for threshold, _ in BADGE_TIERS]
+
+def rank_tier(xp):
+    """Index into RANK_TIERS for an XP total"""
+    return max(0, bisect.bisect_right(RANK_THRESHOLDS, int(xp)) - 1)
 
 def get_rank(xp):
-    xp = int(xp)
-    if xp >= 20000:
-        return "🤴Study Leader of the month"
-    elif xp >= 15000:
-        return "🥷⚔️Sunnie's Study Café's Ninja"
-    elif xp >= 10000:
-        return "🌌 Eternal Shadowblade"
-    elif xp >= 8000:
-        return "🛡️ Legendary Phantom Shinobi"
-    elif xp >= 6000:
-        return "⚡ Ascended Stealth Slayer"
-    elif xp >= 5000:
-        return "🔥 Dragonfire Mystic Ninja"
-    elif xp >= 4000:
-        return "🌪️ Stormborn Silent Tempest"
-    elif xp >= 3000:
-        return "💥 Shadowblade Ninja"
-    elif xp >= 2500:
-        return "🔥 Phantom Shinobi"
-    elif xp >= 2000:
-        return "⚔️ Stealth Slayer"
-    elif xp >= 1500:
-        return "🐉 Mystic Ninja"
-    elif xp >= 1200:
-        return "🌀 Silent Tempest"
-    elif xp >= 1000:
-        return "🌑 Nightcrawler"
-    elif xp >= 850:
-        return "🎯 Swift Claw"
-    elif xp >= 700:
-        return "🥷 Ninja Adept"
-    elif xp >= 550:
-        return "🌪️ Shadow Trainee"
-    elif xp >= 400:
-        return "💨 Hidden Leafling"
-    elif xp >= 300:
-        return "🦊 Masked Novice"
-    elif xp >= 200:
-        return "🔪 Kunai Rookie"
-    elif xp >= 120:
-        return "🥋 Beltless Initiate"
-    elif xp >= 60:
-        return "🎒 Scroll Carrier"
-    elif xp >= 30:
-        return "👣 Silent Steps"
-    else:
-        return "🍼 Lost in the Mist"
+    return RANK_TIERS[rank_tier(xp)][1]
 
 def get_badges(total_minutes):
-    badges = []
-    if total_minutes >= 30:
-        badges.append("🥷 Silent Scroll")
-    if total_minutes >= 60:
-        badges.append("🗡️ Swift Kunai")
-    if total_minutes >= 90:
-        badges.append("🌀 Shadow Shuriken")
-    if total_minutes >= 120:
-        badges.append("🌑 Nightblade")
-    if total_minutes >= 180:
-        badges.append("⚡ Lightning Step")
-    if total_minutes >= 240:
-        badges.append("🔥 Fire Lotus")
-    if total_minutes >= 300:
-        badges.append("🐉 Dragon's Breath")
-    if total_minutes >= 420:
-        badges.append("🌪️ Tornado Strike")
-    if total_minutes >= 600:
-        badges.append("🛡️ Phantom Guard")
-    if total_minutes >= 800:
-        badges.append("💥 Shadow Master")
-    if total_minutes >= 1000:
-        badges.append("🌌 Eternal Ninja")
-    return badges
+    return [badge for _, badge in BADGE_TIERS[:bisect.bisect_right(BADGE_THRESHOLDS, total_minutes)]]
+
+# Rank-ups found while awarding XP and badge unlocks found when a session's
+# minutes are added, sent after the command's reply. Several tiers crossed
+# at once give one announcement for the highest, and a rank-up and a badge
+# from the same command share a message when they fit.
+rank_up_lock = threading.Lock()
+rank_ups = {}  # UserID -> {"rank": announcement, "badge": announcement}
+
+def queue_rank_up(username, userid, old_total, new_total):
+    """Queue an announcement if an XP award moved the user into a higher rank"""
+    if rank_tier(new_total) <= rank_tier(old_total):
+        return
+    with rank_up_lock:
+        rank_ups.setdefault(str(userid), {})["rank"] = (
+            f"🎊 {username} ,you have risen to the rank of {get_rank(new_total)}! "
+            f"The dojo bows to your discipline. ⚔️")
+    increment_metric("rank_ups")
+
+def queue_badge_unlock(username, userid, old_minutes, new_minutes):
+    """Queue an announcement if study minutes crossed a badge threshold"""
+    badges = get_badges(new_minutes)
+    if len(badges) <= len(get_badges(old_minutes)):
+        return
+    with rank_up_lock:
+        rank_ups.setdefault(str(userid), {})["badge"] = (
+            f"🎖 {username}, the badge {badges[-1]} has awakened through your silent training. ⚔️")
+    increment_metric("badge_unlocks")
+
+def pop_rank_ups(userid):
+    """Announcements queued for a user by the command that just ran, packed into chat messages"""
+    with rank_up_lock:
+        queued = rank_ups.pop(str(userid), {})
+    return pack_digest([queued[kind] for kind in ("rank", "badge") if kind in queued])
 
 def parse_reminder_time(text):
     """Parse reminder time from text like '30 min', '2 hour', '45 minutes', etc."""
@@ -536,52 +2099,125 @@ def parse_reminder_time(text):
     
     return None
 
-def reminder_worker(username, userid, message, delay_minutes, reminder_id):
-    """Background worker to send reminder after specified time"""
+def reminder_text_for(reminder):
+    if reminder["message"]:
+        return f"⏰ {reminder['username']} , reminder: {reminder['message']}"
+    return f"⏰ {reminder['username']} , your {reminder['delay_minutes']}-minute reminder is up!"
+
+def find_reminder_rows(reminders):
+    """Fill in sheet rows of reminders that lost theirs, with one read"""
+    missing = {r["reminder_id"]: r for r in reminders if not r.get("row")}
+    if not missing:
+        return
+    for i, row in enumerate(reminder_sheet.get_all_records()):
+        reminder = missing.get(str(row.get('ReminderID')))
+        if reminder:
+            reminder["row"] = i + 2  # Google Sheets row index
+
+def forget_reminder_rows():
+    """Row numbers shifted, look them up again on the next write"""
+    with reminder_lock:
+        for reminder in active_reminders.values():
+            reminder["row"] = None
+
+def set_reminder_status(reminder, status, sent_time=""):
+    """Write Status and SentTime of a reminder row"""
+    with sheet_maintenance_lock.shared():
+        if not reminder.get("row"):
+            # Look up every pending reminder's row in the same read
+            with reminder_lock:
+                find_reminder_rows([reminder] + list(active_reminders.values()))
+        if reminder.get("row"):
+            row = reminder["row"]
+            reminder_sheet.update(f"G{row}:H{row}", [[status, sent_time]], value_input_option="USER_ENTERED")
+
+def _unregister_reminder(reminder_id):
+    """Drop a reminder from both indexes and unschedule it, returns None if it already fired or was cancelled"""
+    with reminder_lock:
+        reminder = active_reminders.pop(reminder_id, None)
+        timer = reminder_timers.pop(reminder_id, None)
+        if timer:
+            timer.cancel()  # No-op when called from the timer's own callback
+        if reminder:
+            ids = user_reminders.get(str(reminder["userid"]), [])
+            if reminder_id in ids:
+                ids.remove(reminder_id)
+            if not ids:
+                user_reminders.pop(str(reminder["userid"]), None)
+        return reminder
+
+def fire_reminder(reminder_id):
+    """Timer callback that sends a due reminder"""
+    reminder = _unregister_reminder(reminder_id)
+    if not reminder:
+        return  # Cancelled after the timer had already started
+    
     try:
-        # Sleep for the specified time
-        time.sleep(delay_minutes * 60)  # Convert minutes to seconds
-        
-        # Check if reminder is still active in the sheet
-        records = reminder_sheet.get_all_records()
-        reminder_active = False
-        row_index = None
-        
-        for i, row in enumerate(records):
-            if (str(row.get('ReminderID')) == str(reminder_id) and 
-                str(row.get('Status')) == 'Active'):
-                reminder_active = True
-                row_index = i + 2  # Google Sheets row index
-                break
-        
-        if not reminder_active:
-            print(f"⚠️ Reminder {reminder_id} was cancelled or already sent")
-            return
-        
-        # Send the reminder
-        reminder_text = f"⏰ {username} , reminder: {message}" if message else f"⏰ {username} , your {delay_minutes}-minute reminder is up!"
-        send_message(VIDEO_ID, reminder_text, ACCESS_TOKEN)
-        
-        # Update reminder status in sheet
-        if row_index:
-            reminder_sheet.update_cell(row_index, 7, "Sent")  # Status column
-            reminder_sheet.update_cell(row_index, 8, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))  # SentTime column
-        
-        print(f"📢 Reminder sent to {username}: {message}")
-        
+        post_reply(reminder["video_id"], reminder_text_for(reminder))
+        set_reminder_status(reminder, "Sent", datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+        logger.info(f"📢 Reminder sent to {reminder['username']}: {reminder['message']}")
     except Exception as e:
-        print(f"❌ Error in reminder worker: {e}")
+        logger.error(f"❌ Error in reminder worker: {e}")
         # Mark reminder as failed in sheet if possible
         try:
-            records = reminder_sheet.get_all_records()
-            for i, row in enumerate(records):
-                if str(row.get('ReminderID')) == str(reminder_id):
-                    reminder_sheet.update_cell(i + 2, 7, "Failed")
-                    break
-        except:
-            pass
+            set_reminder_status(reminder, "Failed")
+        except Exception as e:
+            logger.error(f"❌ Error marking reminder as failed: {e}")
+
+def start_reminder(reminder, wait_seconds=None):
+    """Index a pending reminder and schedule it"""
+    if wait_seconds is None:
+        wait_seconds = reminder["delay_minutes"] * 60
+    
+    timer = threading.Timer(wait_seconds, fire_reminder, args=(reminder["reminder_id"],))
+    timer.daemon = True
+    with reminder_lock:
+        active_reminders[reminder["reminder_id"]] = reminder
+        user_reminders[str(reminder["userid"])].append(reminder["reminder_id"])
+        reminder_timers[reminder["reminder_id"]] = timer
+    timer.start()
+
+def get_user_reminders(userid):
+    """A user's pending reminders, soonest first, as numbered in !reminders"""
+    with reminder_lock:
+        reminders = [active_reminders[rid] for rid in user_reminders.get(str(userid), [])]
+    return sorted(reminders, key=lambda r: r["trigger_time"])
+
+def handle_reminders(username, userid):
+    """List a user's pending reminders"""
+    reminders = get_user_reminders(userid)
+    if not reminders:
+        return f"⏰ {username} ,you have no pending reminders. Set one with !remind 30 min take tea"
+    
+    now = datetime.now()
+    items = []
+    for i, reminder in enumerate(reminders, 1):
+        left = max(0, int((parse_sheet_time(reminder["trigger_time"]) - now).total_seconds() // 60))
+        left_text = f"{left // 60}h {left % 60}m" if left >= 60 else f"{left}m"
+        items.append(f"{i}. {reminder['message'] or 'reminder'} in {left_text}")
+    return f"⏰ {username} ,your reminders: {' · '.join(items)}. Cancel with !remind cancel <n>"
+
+def handle_remind_cancel(username, userid, number_text):
+    """Cancel the nth pending reminder from !reminders"""
+    reminders = get_user_reminders(userid)
+    if not number_text.isdigit() or not 1 <= int(number_text) <= len(reminders):
+        if not reminders:
+            return f"⚠️ {username} ,you have no pending reminders to cancel."
+        return f"⚠️ {username} ,use: !remind cancel <n> with n from 1 to {len(reminders)} (see !reminders)"
+    
+    reminder = _unregister_reminder(reminders[int(number_text) - 1]["reminder_id"])
+    if not reminder:
+        return f"⚠️ {username} ,that reminder was already sent."
+    
+    try:
+        set_reminder_status(reminder, "Cancelled")
+    except Exception as e:
+        logger.error(f"Error cancelling reminder: {e}")
+    
+    message_part = f" about '{reminder['message']}'" if reminder["message"] else ""
+    return f"🗑️ {username} ,reminder{message_part} cancelled."
 
-def handle_remind(username, userid, remind_text):
+def handle_remind(username, userid, remind_text, video_id=None):
     """Handle reminder commands"""
     if not SHEETS_ENABLED:
         return f"⚠️ {username} ,reminder features are currently unavailable."
@@ -591,6 +2227,9 @@ def handle_remind(username, userid, remind_text):
     
     text = remind_text.strip()
     
+    if text.lower().startswith("cancel"):
+        return handle_remind_cancel(username, userid, text[6:].strip())
+    
     # Parse time from the beginning of the text
     delay_minutes = parse_reminder_time(text)
     
@@ -609,15 +2248,15 @@ def handle_remind(username, userid, remind_text):
     # Remove common words like "later", "about", "me"
     message_match = re.sub(r'^(?:later|about|me|for|to)\s*', '', message_match).strip()
     
-    # Create unique reminder ID
-    reminder_id = f"{userid}_{int(time.time())}"
+    # Create unique reminder ID, the sequence keeps two in the same second apart
+    reminder_id = f"{userid}_{int(time.time())}_{next(reminder_sequence)}"
     
     # Calculate trigger time
     trigger_time = datetime.now() + timedelta(minutes=delay_minutes)
     
     try:
         # Save reminder to Google Sheet
-        reminder_sheet.append_row([
+        response = reminder_sheet.append_row([
             username,
             userid,
             message_match,
@@ -626,17 +2265,21 @@ def handle_remind(username, userid, remind_text):
             trigger_time.strftime("%Y-%m-%d %H:%M:%S"),
             "Active",
             "",  # SentTime (empty initially)
-            reminder_id
+            reminder_id,
+            video_id or VIDEO_ID  # Stream the reminder is posted to, also after a restart
         ])
         
         # Start reminder thread
-        reminder_thread = threading.Thread(
-            target=reminder_worker, 
-            args=(username, userid, message_match, delay_minutes, reminder_id),
-            daemon=True
-        )
-        reminder_thread.start()
-        reminder_threads.append(reminder_thread)
+        start_reminder({
+            "username": username,
+            "userid": userid,
+            "message": message_match,
+            "delay_minutes": delay_minutes,
+            "reminder_id": reminder_id,
+            "video_id": video_id or VIDEO_ID,
+            "trigger_time": trigger_time.strftime("%Y-%m-%d %H:%M:%S"),
+            "row": appended_row_index(response),
+        })
         
         time_text = f"{delay_minutes} minute{'s' if delay_minutes != 1 else ''}"
         if delay_minutes >= 60:
@@ -653,105 +2296,201 @@ def handle_remind(username, userid, remind_text):
         return f"⚠️ Error setting reminder: {str(e)}"
 
 # ============== STUDY BUDDY SYSTEM FUNCTIONS ==============
+# The buddy and buddy_requests sheets are loaded once into an in-memory graph.
+# Every !buddy subcommand answers from these maps and writes changes through
+# to the sheets, so no command has to scan a worksheet.
+buddy_lock = threading.RLock()
+buddy_graph = {
+    "loaded": False,
+    "active": {},        # UserID -> {'buddy_id', 'buddy_name', 'paired_date', 'row'}
+    "pending_to": {},    # target username (lower) -> {requester UserID: request}
+    "pending_from": {},  # requester UserID -> set of target usernames (lower)
+}
+
+# username (lower) -> UserID, filled from the sheets once and then from chat
+known_users = {}
+known_users_loaded = False
+
+def appended_row_index(response):
+    """Get the sheet row number written by an append_row call"""
+    try:
+        updated_range = response["updates"]["updatedRange"]
+        return int(re.search(r"![A-Z]+(\d+)", updated_range).group(1))
+    except (KeyError, TypeError, AttributeError, ValueError):
+        return None
+
+def remember_user(username, userid):
+    """Record the latest username seen for a UserID"""
+    if username and userid:
+        known_users[str(username).lower()] = sys.intern(str(userid))
+
+def known_users_reads():
+    """Reads load_known_users makes, none once the index is loaded"""
+    return [] if known_users_loaded else [(attendance_sheets() + session_sheets() + [xp_sheet], ["Username", "UserID"])]
+
+def load_known_users():
+    """Build the username index from attendance, session and xp sheets"""
+    global known_users_loaded
+    
+    index = {}
+    # Earlier sheets win, same as the old sequential lookup
+    columns = read_columns(attendance_sheets() + session_sheets() + [xp_sheet], ["Username", "UserID"])
+    for name, userid in zip(columns["Username"], columns["UserID"]):
+        name = (name or "").lower()
+        if name:
+            index.setdefault(name, userid or "")
+    
+    # Names seen in chat since startup are more recent than the sheets
+    index.update(known_users)
+    known_users.clear()
+    known_users.update(index)
+    known_users_loaded = True
+
 def get_user_id_by_username(username):
     """Try to find user ID from existing records"""
     if not SHEETS_ENABLED:
         return None
     
     try:
-        # Check attendance sheet first
-        records = attendance_sheet.get_all_records()
-        for row in records:
-            if str(row.get('Username', '')).lower() == username.lower():
-                return str(row.get('UserID', ''))
-        
-        # Check session sheet
-        records = session_sheet.get_all_records()
-        for row in records:
-            if str(row.get('Username', '')).lower() == username.lower():
-                return str(row.get('UserID', ''))
-        
-        # Check xp sheet
-        records = xp_sheet.get_all_records()
-        for row in records:
-            if str(row.get('Username', '')).lower() == username.lower():
-                return str(row.get('UserID', ''))
-                
+        if not known_users_loaded:
+            load_known_users()
     except Exception as e:
-        print(f"Error finding user ID: {e}")
+        logger.error(f"Error finding user ID: {e}")
     
-    return None
+    return known_users.get(username.lower())
 
-def get_active_buddy(userid):
-    """Get user's current active buddy from buddy sheet"""
-    if not SHEETS_ENABLED:
-        return None
+def _add_active_pair(requester_id, requester_name, target_id, target_name, paired_date, row):
+    """Link both users of a buddy row in the graph"""
+    buddy_graph["active"][requester_id] = {
+        'buddy_id': target_id,
+        'buddy_name': target_name,
+        'paired_date': paired_date,
+        'row': row
+    }
+    buddy_graph["active"][target_id] = {
+        'buddy_id': requester_id,
+        'buddy_name': requester_name,
+        'paired_date': paired_date,
+        'row': row
+    }
+
+def _add_pending_request(request):
+    """Add a pending request to both adjacency maps"""
+    target = request['target_name']
+    requester_id = request['requester_id']
+    buddy_graph["pending_to"].setdefault(target, {})[requester_id] = request
+    buddy_graph["pending_from"].setdefault(requester_id, set()).add(target)
+
+def _drop_pending_request(request):
+    """Remove a pending request from both adjacency maps"""
+    target = request['target_name']
+    requester_id = request['requester_id']
+    
+    requesters = buddy_graph["pending_to"].get(target, {})
+    requesters.pop(requester_id, None)
+    if not requesters:
+        buddy_graph["pending_to"].pop(target, None)
+    
+    targets = buddy_graph["pending_from"].get(requester_id, set())
+    targets.discard(target)
+    if not targets:
+        buddy_graph["pending_from"].pop(requester_id, None)
+
+BUDDY_COLUMNS = ["RequesterUsername", "RequesterID", "TargetUsername", "TargetID", "Status", "PairedDate"]
+BUDDY_REQUEST_COLUMNS = ["RequesterUsername", "RequesterID", "TargetUsername", "RequestDate", "Status"]
+
+def buddy_graph_reads():
+    """Reads load_buddy_graph makes, none while the graph is loaded"""
+    if buddy_graph["loaded"]:
+        return []
+    return [([buddy_sheet], BUDDY_COLUMNS), ([buddy_requests_sheet], BUDDY_REQUEST_COLUMNS)]
+
+def load_buddy_graph():
+    """Rebuild the buddy graph from the buddy and buddy_requests sheets"""
+    pairs = read_columns([buddy_sheet], BUDDY_COLUMNS)
+    requests_columns = read_columns([buddy_requests_sheet], BUDDY_REQUEST_COLUMNS)
+    
+    with buddy_lock:
+        buddy_graph["active"] = {}
+        buddy_graph["pending_to"] = {}
+        buddy_graph["pending_from"] = {}
+        
+        for i, row in enumerate(pairs["_row"]):
+            if pairs["Status"][i] == 'Active':
+                _add_active_pair(
+                    pairs["RequesterID"][i] or "",
+                    pairs["RequesterUsername"][i] or "",
+                    pairs["TargetID"][i] or "",
+                    pairs["TargetUsername"][i] or "",
+                    format_sheet_time(pairs["PairedDate"][i]),
+                    row
+                )
+        
+        for i, row in enumerate(requests_columns["_row"]):
+            if requests_columns["Status"][i] == 'Pending':
+                _add_pending_request({
+                    'index': row,
+                    'requester_id': requests_columns["RequesterID"][i] or "",
+                    'requester_name': requests_columns["RequesterUsername"][i] or "",
+                    'target_name': (requests_columns["TargetUsername"][i] or "").lower(),
+                    'request_date': format_sheet_time(requests_columns["RequestDate"][i])
+                })
+        
+        buddy_graph["loaded"] = True
+
+def ensure_buddy_graph():
+    """Load the buddy graph on first use, returns False if the sheets are unreachable"""
+    if buddy_graph["loaded"]:
+        return True
     
     try:
-        records = buddy_sheet.get_all_records()
-        for row in records:
-            if ((str(row.get('RequesterID', '')) == str(userid) or str(row.get('TargetID', '')) == str(userid)) 
-                and str(row.get('Status', '')) == 'Active'):
-                if str(row.get('RequesterID', '')) == str(userid):
-                    return {
-                        'buddy_id': str(row.get('TargetID', '')),
-                        'buddy_name': str(row.get('TargetUsername', '')),
-                        'paired_date': str(row.get('PairedDate', ''))
-                    }
-                else:
-                    return {
-                        'buddy_id': str(row.get('RequesterID', '')),
-                        'buddy_name': str(row.get('RequesterUsername', '')),
-                        'paired_date': str(row.get('PairedDate', ''))
-                    }
+        load_buddy_graph()
+        return True
     except Exception as e:
-        print(f"Error getting active buddy: {e}")
+        logger.error(f"Error loading buddy graph: {e}")
+        return False
+
+def invalidate_buddy_graph():
+    """Force a reload after a write that may have left the graph out of sync"""
+    with buddy_lock:
+        buddy_graph["loaded"] = False
+
+def publish_buddy_change():
+    """Other cluster instances re-read the buddy sheets after a change here"""
+    publish_cluster_event("buddy_changed")
+
+def get_active_buddy(userid):
+    """Get user's current active buddy"""
+    if not SHEETS_ENABLED or not ensure_buddy_graph():
+        return None
     
-    return None
+    return buddy_graph["active"].get(str(userid))
 
 def get_pending_buddy_request(username):
-    """Get pending buddy request for username"""
-    if not SHEETS_ENABLED:
+    """Get the oldest pending buddy request for username"""
+    if not SHEETS_ENABLED or not ensure_buddy_graph():
         return None
     
-    try:
-        records = buddy_requests_sheet.get_all_records()
-        for i, row in enumerate(records):
-            if (str(row.get('TargetUsername', '')).lower() == username.lower() 
-                and str(row.get('Status', '')) == 'Pending'):
-                return {
-                    'index': i + 2,  # Sheet row index
-                    'requester_id': str(row.get('RequesterID', '')),
-                    'requester_name': str(row.get('RequesterUsername', '')),
-                    'request_date': str(row.get('RequestDate', ''))
-                }
-    except Exception as e:
-        print(f"Error getting pending request: {e}")
-    
-    return None
+    requesters = buddy_graph["pending_to"].get(username.lower())
+    if not requesters:
+        return None
+    return next(iter(requesters.values()))
 
 def has_pending_request_to(target_username, requester_id):
     """Check if requester already sent request to target"""
-    if not SHEETS_ENABLED:
+    if not SHEETS_ENABLED or not ensure_buddy_graph():
         return False
     
-    try:
-        records = buddy_requests_sheet.get_all_records()
-        for row in records:
-            if (str(row.get('TargetUsername', '')).lower() == target_username.lower() 
-                and str(row.get('RequesterID', '')) == str(requester_id)
-                and str(row.get('Status', '')) == 'Pending'):
-                return True
-    except Exception as e:
-        print(f"Error checking pending request: {e}")
-    
-    return False
+    return target_username.lower() in buddy_graph["pending_from"].get(str(requester_id), set())
 
 def handle_buddy_request(username, userid, target_name):
     """Send buddy request to specific user"""
     if not SHEETS_ENABLED:
         return f"⚠️ {username} ,buddy features are currently unavailable."
     
+    # The graph and username index load in one request when cold
+    plan_reads(*buddy_graph_reads(), *known_users_reads())
+    
     # Check if user already has a buddy
     if get_active_buddy(userid):
         return f"⚠️ {username} ,you already have a study buddy! Use !buddy remove first."
@@ -770,16 +2509,30 @@ def handle_buddy_request(username, userid, target_name):
         return f"⚠️ {username} ,you already sent a request to {target_name}. Wait for their response."
     
     try:
-        # Add request to buddy_requests sheet - FIXED: Added target_id parameter
-        buddy_requests_sheet.append_row([
-            username,
-            userid,
-            target_name,
-            target_id,  # This was missing in original code
-            datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "Pending"
-        ])
+        with buddy_lock:
+            request_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            response = buddy_requests_sheet.append_row([
+                username,
+                userid,
+                target_name,
+                target_id,
+                request_date,
+                "Pending"
+            ])
+            
+            row_index = appended_row_index(response)
+            if row_index is None:
+                invalidate_buddy_graph()
+            else:
+                _add_pending_request({
+                    'index': row_index,
+                    'requester_id': str(userid),
+                    'requester_name': username,
+                    'target_name': target_name,
+                    'request_date': request_date
+                })
         
+        publish_buddy_change()
         return f"📨 {username} ,buddy request sent to {target_name}! They can use !buddy accept to become your study buddy."
     except Exception as e:
         return f"⚠️ Error sending buddy request: {str(e)}"
@@ -804,28 +2557,49 @@ def handle_buddy_accept(username, userid):
     # Check if requester already has a buddy
     if get_active_buddy(requester_id):
         # Update request status to expired
-        try:
-            buddy_requests_sheet.update_cell(request['index'], 6, "Expired")  # Status column
-        except:
-            pass
+        with buddy_lock:
+            try:
+                buddy_requests_sheet.update_cell(request['index'], 6, "Expired")  # Status column
+                _drop_pending_request(request)
+                publish_buddy_change()
+            except Exception as e:
+                logger.error(f"Error expiring buddy request: {e}")
+                invalidate_buddy_graph()
         return f"⚠️ {username} ,{requester_name} already found another study buddy."
     
     try:
-        # Create buddy pair in buddy sheet
-        buddy_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        buddy_sheet.append_row([
-            requester_name,
-            requester_id,
-            username,
-            userid,
-            "Active",
-            request['request_date'],
-            buddy_date,
-            "Mutual"
-        ])
+        with buddy_lock:
+            try:
+                # Create buddy pair in buddy sheet
+                buddy_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                response = buddy_sheet.append_row([
+                    requester_name,
+                    requester_id,
+                    username,
+                    userid,
+                    "Active",
+                    request['request_date'],
+                    buddy_date,
+                    "Mutual"
+                ])
+                
+                # Update request status to accepted
+                buddy_requests_sheet.update_cell(request['index'], 6, "Accepted")  # Status column
+            except Exception:
+                # A half-applied accept is re-read from the sheets
+                invalidate_buddy_graph()
+                raise
+            
+            _drop_pending_request(request)
+            row_index = appended_row_index(response)
+            if row_index is None:
+                invalidate_buddy_graph()
+            else:
+                _add_active_pair(requester_id, requester_name, str(userid), username, buddy_date, row_index)
         
-        # Update request status to accepted
-        buddy_requests_sheet.update_cell(request['index'], 6, "Accepted")  # Status column
+        invalidate_cache(userid, "!buddyprog")
+        invalidate_cache(requester_id, "!buddyprog")
+        publish_buddy_change()
         
         return f"🤝 {username} and {requester_name} are now study buddies! Use !buddyprog & !buddy stats to compare progress."
     except Exception as e:
@@ -841,8 +2615,12 @@ def handle_buddy_decline(username, userid):
         return f"⚠️ {username} ,you don't have any pending buddy requests."
     
     try:
-        # Update request status to declined
-        buddy_requests_sheet.update_cell(request['index'], 6, "Declined")  # Status column
+        with buddy_lock:
+            # Update request status to declined
+            buddy_requests_sheet.update_cell(request['index'], 6, "Declined")  # Status column
+            _drop_pending_request(request)
+        
+        publish_buddy_change()
         
         return f"❌ {username} ,you declined the buddy request from {request['requester_name']}."
     except Exception as e:
@@ -858,13 +2636,14 @@ def handle_buddy_remove(username, userid):
         return f"⚠️ {username} ,you don't have a study buddy to remove."
     
     try:
-        # Find and update buddy record
-        records = buddy_sheet.get_all_records()
-        for i, row in enumerate(records):
-            if ((str(row.get('RequesterID', '')) == str(userid) or str(row.get('TargetID', '')) == str(userid)) 
-                and str(row.get('Status', '')) == 'Active'):
-                buddy_sheet.update_cell(i + 2, 5, "Removed")  # Status column
-                break
+        with buddy_lock:
+            buddy_sheet.update_cell(buddy_info['row'], 5, "Removed")  # Status column
+            buddy_graph["active"].pop(str(userid), None)
+            buddy_graph["active"].pop(buddy_info['buddy_id'], None)
+        
+        invalidate_cache(userid, "!buddyprog")
+        invalidate_cache(buddy_info['buddy_id'], "!buddyprog")
+        publish_buddy_change()
         
         return f"💔 {username} ,you're no longer study buddies with {buddy_info['buddy_name']}."
     except Exception as e:
@@ -875,6 +2654,9 @@ def handle_buddy_stats(username, userid):
     if not SHEETS_ENABLED:
         return f"⚠️ {username} ,buddy features are currently unavailable."
     
+    session_reads = (session_sheets(), ["UserID", "Status", "Duration"])
+    plan_reads(*buddy_graph_reads(), *xp_index_reads(), *attendance_index_reads(), session_reads)
+    
     buddy_info = get_active_buddy(userid)
     if not buddy_info:
         return f"⚠️ {username} ,you don't have a study buddy. Use !buddy find or !buddy @username"
@@ -882,24 +2664,30 @@ def handle_buddy_stats(username, userid):
     buddy_name = buddy_info['buddy_name']
     buddy_id = buddy_info['buddy_id']
     
-    # Get stats
-    your_xp = get_user_total_xp(userid)
-    your_streak = calculate_streak(userid)
-    buddy_xp = get_user_total_xp(buddy_id)
-    buddy_streak = calculate_streak(buddy_id)
-    
     try:
-        session_records = session_sheet.get_all_records()
-        your_time = sum(int(row.get('Duration', 0)) for row in session_records 
-                       if str(row.get('UserID', '')) == str(userid) and row.get('Status') == 'Completed')
-        buddy_time = sum(int(row.get('Duration', 0)) for row in session_records 
-                        if str(row.get('UserID', '')) == str(buddy_id) and row.get('Status') == 'Completed')
+        your_xp = get_user_total_xp(userid)
+        your_streak = calculate_streak(userid)
+        buddy_xp = get_user_total_xp(buddy_id)
+        buddy_streak = calculate_streak(buddy_id)
+        
+        sessions = read_columns(*session_reads)
+        your_time = 0
+        buddy_time = 0
+        for user, status, duration in zip(sessions["UserID"], sessions["Status"], sessions["Duration"]):
+            if status == 'Completed' and duration is not None:
+                if user == str(userid):
+                    your_time += duration
+                elif user == str(buddy_id):
+                    buddy_time += duration
+        
+        your_time += rollup_int(get_user_rollup(userid), 'SessionMinutes')
+        buddy_time += rollup_int(get_user_rollup(buddy_id), 'SessionMinutes')
         
         your_hours = your_time // 60
         buddy_hours = buddy_time // 60
-    except:
-        your_hours = 0
-        buddy_hours = 0
+    except Exception as e:
+        logger.error(f"Error loading buddy stats: {e}")
+        return f"⚠️ {username} ,buddy stats can't be loaded right now. Please try again in a minute."
     
     return (f"👥 Buddy Stats Comparison:\n"
             f"📊 {username} :{your_xp} XP, {your_streak} day streak, {your_hours}h studied\n"
@@ -910,6 +2698,7 @@ def handle_buddy_progress(username, userid):
     if not SHEETS_ENABLED:
         return f"⚠️ {username} ,buddy features are currently unavailable."
     
+    plan_reads(*buddy_graph_reads(), (session_sheets(), ["UserID", "Duration", "Status"]))
     buddy_info = get_active_buddy(userid)
     if not buddy_info:
         return f"⚠️ {username} ,you don't have a study buddy. Use !buddy find or !buddy @username to get one!"
@@ -918,27 +2707,17 @@ def handle_buddy_progress(username, userid):
     buddy_id = buddy_info['buddy_id']
     
     try:
-        session_records = session_sheet.get_all_records()
-        
-        # Find your last completed session
-        your_last_session = None
-        for row in reversed(session_records):
-            if str(row.get('UserID', '')) == str(userid) and row.get('Status') == 'Completed':
-                your_last_session = {
-                    'duration': int(row.get('Duration', 0)),
-                    'date': row.get('EndTime', '')
-                }
-                break
+        sessions = read_columns(session_sheets(), ["UserID", "Duration", "Status"])
         
-        # Find buddy's last completed session
-        buddy_last_session = None
-        for row in reversed(session_records):
-            if str(row.get('UserID', '')) == str(buddy_id) and row.get('Status') == 'Completed':
-                buddy_last_session = {
-                    'duration': int(row.get('Duration', 0)),
-                    'date': row.get('EndTime', '')
-                }
-                break
+        def last_session(session_userid):
+            """Duration of a user's latest completed session, None if there is none"""
+            for i in range(len(sessions["_row"]) - 1, -1, -1):
+                if sessions["UserID"][i] == str(session_userid) and sessions["Status"][i] == 'Completed':
+                    return {'duration': sessions["Duration"][i] or 0}
+            return None
+        
+        your_last_session = last_session(userid)
+        buddy_last_session = last_session(buddy_id)
         
         # Handle cases where one or both haven't studied
         if not your_last_session and not buddy_last_session:
@@ -1017,79 +2796,435 @@ def handle_buddy(username, userid, buddy_command):
     else:
         return f"⚠️ {username} ,buddy commands: !buddy @username, !buddy accept, !buddy decline, !buddy remove, !buddy stats"
         
-# === Study Bot Commands ===
-def handle_attend(username, userid):
-    if not SHEETS_ENABLED:
-        return f"⚠️ {username} ,study features are currently unavailable."
-    
-    now = datetime.now()
-    today_date = now.date()
-
-    # Check if this user already gave attendance today
-    try:
-        records = attendance_sheet.get_all_records()
-        for row in records[::-1]:
-            if str(row['UserID']) == str(userid):
-                try:
-                    row_date = datetime.strptime(str(row['Date']), "%Y-%m-%d %H:%M:%S").date()
-                    if row_date == today_date:
-                        return f"⚠️ {username} ,your attendance for today is already recorded! ✅"
-                except ValueError:
-                    continue
-    except:
-        pass
+# === Archival & Rollup ===
+# Closed rows older than ARCHIVE_AFTER_DAYS are moved out of the hot sheets in
+# bulk, either to "<sheet>_archive" worksheets or to CSV files in ARCHIVE_DIR.
+# Their totals are folded into one rollup row per user, so all-time numbers
+# stay correct while the hot sheets stay small.
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "60"))  # 0 disables archival
+ARCHIVE_INTERVAL_HOURS = float(os.getenv("ARCHIVE_INTERVAL_HOURS", "24"))
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR")  # Archive to local CSV files instead of worksheets
 
-    # Log new attendance
-    timestamp = now.strftime("%Y-%m-%d %H:%M:%S")
-    attendance_sheet.append_row([username, userid, timestamp])
+# Anything that uses i + 2 or _row positions takes the shared side, so
+# commands on every stream run side by side. Archival takes the exclusive
+# side while it moves rows, so nobody writes to a stale i + 2 row.
+class SheetMaintenanceLock:
+    """Reader/writer lock around sheet row positions, reentrant on both sides"""
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.readers = 0
+        self.writer = None
+        self.writers_waiting = 0  # Waiting writers hold off new readers, so archival can't starve
+        self.local = threading.local()  # .depth: shared sections this thread is inside
     
-    # Update XP
-    update_user_xp(username, userid, 10, "Attendance")
+    @contextmanager
+    def shared(self):
+        depth = getattr(self.local, "depth", 0)
+        nested = depth > 0 or self.writer is threading.current_thread()
+        if not nested:
+            with self.condition:
+                while self.writer is not None or self.writers_waiting:
+                    self.condition.wait()
+                self.readers += 1
+        self.local.depth = depth + 1
+        try:
+            yield
+        finally:
+            self.local.depth = depth
+            if not nested:
+                with self.condition:
+                    self.readers -= 1
+                    if not self.readers:
+                        self.condition.notify_all()
     
-    streak = calculate_streak(userid)
-    return f"✅ {username} ,your attendance is logged and you earned 10 XP! 🔥 Daily Streak: {streak} days."
+    @contextmanager
+    def exclusive(self):
+        me = threading.current_thread()
+        if self.writer is me:
+            yield
+            return
+        if getattr(self.local, "depth", 0):
+            raise RuntimeError("Rows can't be moved from inside a shared section")
+        with self.condition:
+            self.writers_waiting += 1
+            try:
+                while self.writer is not None or self.readers:
+                    self.condition.wait()
+            finally:
+                self.writers_waiting -= 1
+            self.writer = me
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.writer = None
+                self.condition.notify_all()
 
-def handle_start(username, userid):
-    if not SHEETS_ENABLED:
-        return f"⚠️ {username} ,study features are currently unavailable."
+sheet_maintenance_lock = SheetMaintenanceLock()
+
+rollup_index = {}  # UserID -> rollup row dict
+rollup_loaded = False
+
+# Callbacks run after rows of a sheet were deleted, so in-memory indexes that
+# hold sheet row numbers can rebuild themselves
+sheet_rewrite_hooks = defaultdict(list)  # sheet title -> callbacks
+
+def notify_sheet_rewritten(title, broadcast=True):
+    """Tell caches and indexes that row positions in a sheet changed"""
+    global rollup_loaded
     
-    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    clear_cache()
+    rollup_loaded = False
+    sheet_headers.pop(title, None)
+    for callback in sheet_rewrite_hooks[shard_base(title)]:
+        callback()
+    
+    if broadcast:
+        publish_cluster_event("sheet_rewritten", {"title": title})
 
+def parse_sheet_time(value):
+    """Parse a sheet timestamp, returns None for blanks and bad values"""
     try:
-        records = session_sheet.get_all_records()
-        # Check if a session is already running
-        for row in reversed(records):
-            if str(row.get('UserID', '')) == str(userid) and str(row.get('Status', '')).strip() == 'Active':
-                return f"⚠️ {username} , you already started a session. Use !stop before starting a new one."
-    except Exception as e:
-        print(f"Error checking sessions: {e}")
+        return datetime.strptime(str(value), "%Y-%m-%d %H:%M:%S")
+    except ValueError:
+        return None
 
-    # Log new session start
-    session_sheet.append_row([username, userid, now, "", "", "Active"])
-    return f"⏱️ {username} , your study session has started! Use !stop to end it. Happy studying 📚"
+def load_rollup_index():
+    """Load per-user rollup rows into memory"""
+    global rollup_loaded
+    
+    rollup_index.clear()
+    for row in rollup_sheet.get_all_records():
+        rollup_index[str(row.get('UserID', ''))] = row
+    rollup_loaded = True
 
-def handle_stop(username, userid):
+def get_user_rollup(userid):
+    """Get archived totals for a user, empty dict if nothing was archived.
+    Raises if the rollup sheet can't be read, rather than undercounting."""
     if not SHEETS_ENABLED:
-        return f"⚠️ {username} , study features are currently unavailable."
+        return {}
     
-    now = datetime.now()
+    if not rollup_loaded:
+        load_rollup_index()
+    return rollup_index.get(str(userid), {})
 
+def rollup_int(rollup, column):
+    """Read an integer rollup column, treating blanks as 0"""
     try:
-        records = session_sheet.get_all_records()
+        return int(rollup.get(column) or 0)
+    except (TypeError, ValueError):
+        return 0
+
+def _fold_session(rollup, row):
+    if str(row.get('Status', '')).strip() == 'Completed':
+        try:
+            rollup['SessionMinutes'] = rollup_int(rollup, 'SessionMinutes') + int(row.get('Duration', 0))
+        except (TypeError, ValueError):
+            pass
+        rollup['SessionsCompleted'] = rollup_int(rollup, 'SessionsCompleted') + 1
+
+def _fold_task(rollup, row):
+    status = str(row.get('Status', '')).strip()
+    if status == 'Completed':
+        rollup['TasksCompleted'] = rollup_int(rollup, 'TasksCompleted') + 1
+    elif status == 'Removed':
+        rollup['TasksRemoved'] = rollup_int(rollup, 'TasksRemoved') + 1
+
+def _fold_reminder(rollup, row):
+    status = str(row.get('Status', '')).strip()
+    if status == 'Sent':
+        rollup['RemindersSent'] = rollup_int(rollup, 'RemindersSent') + 1
+    elif status == 'Failed':
+        rollup['RemindersFailed'] = rollup_int(rollup, 'RemindersFailed') + 1
+
+def _fold_attendance(rollups, rows):
+    """Fold archived attendance into day counts and the streak ending at the last archived day"""
+    dates_by_user = defaultdict(set)
+    for row in rows:
+        date = parse_sheet_time(row.get('Date', ''))
+        if date:
+            dates_by_user[str(row.get('UserID', ''))].add(date.date())
+    
+    for userid, dates in dates_by_user.items():
+        rollup = rollups[userid]
+        last_date = max(dates)
+        streak = 0
+        while last_date - timedelta(days=streak) in dates:
+            streak += 1
+        
+        # Extend the previous archived streak if this run continues it
+        previous = str(rollup.get('LastAttendanceDate') or '')
+        if previous == str(last_date - timedelta(days=streak)):
+            streak += rollup_int(rollup, 'AttendanceStreak')
+        
+        rollup['AttendanceDays'] = rollup_int(rollup, 'AttendanceDays') + len(dates)
+        rollup['LastAttendanceDate'] = str(last_date)
+        rollup['AttendanceStreak'] = streak
+
+sheet_rewrite_hooks["xp"].append(invalidate_xp_index)
+sheet_rewrite_hooks["attendance"].append(invalidate_attendance_index)
+sheet_rewrite_hooks["session"].append(invalidate_study_minutes)
+sheet_rewrite_hooks["rollup"].append(invalidate_study_minutes)
+sheet_rewrite_hooks["buddy"].append(invalidate_buddy_graph)
+sheet_rewrite_hooks["buddy_requests"].append(invalidate_buddy_graph)
+sheet_rewrite_hooks["reminders"].append(forget_reminder_rows)
+
+# sheet title -> (closed statuses or None for every row, age columns, per-row fold)
+ARCHIVE_SPECS = {
+    "session": ({"Completed"}, ("EndTime", "StartTime"), _fold_session),
+    "task": ({"Completed", "Removed"}, ("CompletedDate", "CreatedDate"), _fold_task),
+    "attendance": (None, ("Date",), None),
+    "reminders": ({"Sent", "Failed", "Cancelled"}, ("SentTime", "TriggerTime", "CreatedTime"), _fold_reminder),
+}
+
+def _row_age_time(row, age_columns):
+    for column in age_columns:
+        parsed = parse_sheet_time(row.get(column, ''))
+        if parsed:
+            return parsed
+    return None
+
+def write_archive_rows(sheet, header, rows):
+    """Append archived rows to the archive worksheet or local CSV file"""
+    if ARCHIVE_DIR:
+        os.makedirs(ARCHIVE_DIR, exist_ok=True)
+        path = os.path.join(ARCHIVE_DIR, f"{shard_base(sheet.title)}.csv")
+        is_new = not os.path.exists(path)
+        with open(path, "a", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            if is_new:
+                writer.writerow(header)
+            writer.writerows(rows)
+        return
+    
+    archive_sheet = open_worksheet(f"{shard_base(sheet.title)}_archive", header)
+    archive_sheet.append_rows(rows, value_input_option="RAW")
+
+def delete_sheet_rows(sheet, row_numbers):
+    """Delete rows (1-based) in one batch request, bottom-up so positions stay valid"""
+    runs = []
+    for row_number in sorted(row_numbers, reverse=True):
+        if runs and runs[-1][0] == row_number + 1:
+            runs[-1][0] = row_number
+        else:
+            runs.append([row_number, row_number])
+    
+    requests_body = [{
+        "deleteDimension": {
+            "range": {
+                "sheetId": sheet.id,
+                "dimension": "ROWS",
+                "startIndex": start - 1,
+                "endIndex": end
+            }
+        }
+    } for start, end in runs]
+    
+    if requests_body:
+        spreadsheet.batch_update({"requests": requests_body})
+        note_sheet_write(sheet.title, None)
+
+def write_rollup(rollups):
+    """Write changed rollup rows back, appending users that are new to the rollup"""
+    if not rollup_loaded:
+        load_rollup_index()
+    
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    existing_rows = {str(row.get('UserID', '')): i + 2 for i, row in enumerate(rollup_sheet.get_all_records())}
+    updates = []
+    new_rows = []
+    
+    for userid, rollup in rollups.items():
+        rollup['UpdatedAt'] = now
+        values = [rollup.get(column, '') for column in ROLLUP_HEADER]
+        if userid in existing_rows:
+            row_number = existing_rows[userid]
+            updates.append({"range": f"A{row_number}:L{row_number}", "values": [values]})
+        else:
+            new_rows.append(values)
+        rollup_index[userid] = rollup
+    
+    if updates:
+        rollup_sheet.batch_update(updates, value_input_option="RAW")
+    if new_rows:
+        rollup_sheet.append_rows(new_rows, value_input_option="RAW")
+
+def archive_sheet(sheet, cutoff):
+    """Move closed rows older than cutoff out of one hot sheet, returns rows moved"""
+    closed_statuses, age_columns, fold = ARCHIVE_SPECS[shard_base(sheet.title)]
+    
+    values = sheet.get_all_values()
+    if len(values) < 2:
+        return 0
+    header = values[0]
+    
+    archived_rows = []
+    archived_numbers = []
+    archived_records = []
+    for i, values_row in enumerate(values[1:]):
+        row = dict(zip(header, values_row))
+        if closed_statuses is not None and str(row.get('Status', '')).strip() not in closed_statuses:
+            continue
+        age_time = _row_age_time(row, age_columns)
+        if age_time is None or age_time >= cutoff:
+            continue
+        archived_rows.append(values_row)
+        archived_numbers.append(i + 2)
+        archived_records.append(row)
+    
+    if not archived_rows:
+        return 0
+    
+    # Start from each user's current rollup so totals accumulate
+    rollups = {}
+    for row in archived_records:
+        userid = str(row.get('UserID', ''))
+        if userid not in rollups:
+            rollups[userid] = dict(get_user_rollup(userid)) or {'UserID': userid}
+            rollups[userid]['Username'] = row.get('Username', '') or rollups[userid].get('Username', '')
+    
+    if fold is not None:
+        for row in archived_records:
+            fold(rollups[str(row.get('UserID', ''))], row)
+    else:
+        _fold_attendance(rollups, archived_records)
+    
+    # Archive first, then rollup, then delete: a crash leaves duplicates, never gaps
+    write_archive_rows(sheet, header, archived_rows)
+    write_rollup(rollups)
+    delete_sheet_rows(sheet, archived_numbers)
+    return len(archived_rows)
+
+def fold_old_shards():
+    """Archive every closed row of shards that reads no longer route to"""
+    if not SHEETS_ENABLED or not SHARD_BY_MONTH or not is_cluster_leader():
+        return
+    
+    try:
+        sheets = old_shard_sheets()
+    except Exception as e:
+        logger.error(f"❌ Error listing old shards: {e}")
+        return
+    archive_sheets(sheets, datetime.max)
+
+def run_archival():
+    """Archive every hot sheet once"""
+    if not SHEETS_ENABLED or not is_cluster_leader():
+        return
+    
+    # Old shards go first so attendance streaks are folded in date order
+    fold_old_shards()
+    
+    if ARCHIVE_AFTER_DAYS <= 0:
+        return
+    cutoff = datetime.now() - timedelta(days=ARCHIVE_AFTER_DAYS)
+    archive_sheets(session_sheets() + [task_sheet] + attendance_sheets() + [reminder_sheet], cutoff)
+
+def archive_sheets(sheets, cutoff):
+    """Archive closed rows older than cutoff from each sheet in turn"""
+    for sheet in sheets:
+        try:
+            with cluster_maintenance(), sheet_maintenance_lock.exclusive():
+                moved = archive_sheet(sheet, cutoff)
+                if moved:
+                    notify_sheet_rewritten(sheet.title)
+            if moved:
+                logger.info(f"🗄️ Archived {moved} rows from {sheet.title}")
+        except Exception as e:
+            logger.error(f"❌ Error archiving {sheet.title}: {e}")
+            # A failed run may have written the rollup already
+            try:
+                load_rollup_index()
+            except Exception:
+                pass
+
+def archive_worker():
+    """Background worker that archives old rows on a schedule"""
+    while True:
+        run_archival()
+        time.sleep(ARCHIVE_INTERVAL_HOURS * 3600)
+
+def start_archive_system():
+    """Start the archival thread if archival or sharding is enabled"""
+    if ARCHIVE_AFTER_DAYS <= 0 and not SHARD_BY_MONTH:
+        return
+    
+    archive_thread = threading.Thread(target=archive_worker, daemon=True)
+    archive_thread.start()
+    logger.info(f"✅ Archival started (rows older than {ARCHIVE_AFTER_DAYS} days)")
+
+# === Study Bot Commands ===
+def handle_attend(username, userid):
+    if not SHEETS_ENABLED:
+        return f"⚠️ {username} ,study features are currently unavailable."
+    
+    now = datetime.now()
+    today_date = now.date()
+
+    # Check if this user already gave attendance today
+    try:
+        ensure_attendance_index()
+        if attended_on(userid, today_date):
+            return f"⚠️ {username} ,your attendance for today is already recorded! ✅"
+    except Exception as e:
+        logger.error(f"Error checking attendance: {e}")
+
+    # Log new attendance
+    timestamp = now.strftime("%Y-%m-%d %H:%M:%S")
+    current_attendance_sheet().append_row([username, userid, timestamp])
+    record_attendance(userid, today_date)
+    publish_cluster_event("attendance", {"userid": str(userid), "date": str(today_date)})
+    
+    # Update XP
+    update_user_xp(username, userid, 10, "Attendance")
+    
+    try:
+        streak = calculate_streak(userid)
+    except Exception as e:
+        logger.error(f"Error calculating streak: {e}")
+        return f"✅ {username} ,your attendance is logged and you earned 10 XP! ⚠️ Your streak can't be loaded right now."
+    return f"✅ {username} ,your attendance is logged and you earned 10 XP! 🔥 Daily Streak: {streak} days."
+
+def handle_start(username, userid):
+    if not SHEETS_ENABLED:
+        return f"⚠️ {username} ,study features are currently unavailable."
+    
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    try:
+        # Check if a session is already running
+        sessions = read_columns(session_sheets(), ["UserID", "Status"])
+        if find_latest(sessions, userid, "Active") is not None:
+            return f"⚠️ {username} , you already started a session. Use !stop before starting a new one."
+    except Exception as e:
+        logger.error(f"Error checking sessions: {e}")
+
+    # Log new session start
+    current_session_sheet().append_row([username, userid, now, "", "", "Active"])
+    return f"⏱️ {username} , your study session has started! Use !stop to end it. Happy studying 📚"
+
+def handle_stop(username, userid):
+    if not SHEETS_ENABLED:
+        return f"⚠️ {username} , study features are currently unavailable."
+    
+    now = datetime.now()
+
+    try:
+        session_reads = (session_sheets(), ["UserID", "Status", "StartTime"])
+        plan_reads(session_reads, *study_minutes_reads())
+        sessions = read_columns(*session_reads)
         
         # Find the latest active session
         session_start = None
         row_index = None
-        for i in range(len(records) - 1, -1, -1):
-            row = records[i]
-            if (str(row.get('UserID', '')) == str(userid) and str(row.get('Status', '')).strip() == 'Active'):
-                try:
-                    session_start = datetime.strptime(row.get('StartTime', ''), "%Y-%m-%d %H:%M:%S")
-                    row_index = i + 2
-                    break
-                except (ValueError, TypeError):
-                    print(f"Error parsing start time: {row.get('StartTime', '')}")
+        for i in range(len(sessions["_row"]) - 1, -1, -1):
+            if sessions["UserID"][i] == str(userid) and (sessions["Status"][i] or "").strip() == 'Active':
+                if sessions["StartTime"][i] is None:
+                    logger.error(f"Error parsing start time in row {sessions['_row'][i]}")
                     continue
+                session_start = sessions["StartTime"][i]
+                sheet, row_index = sessions["_sheet"][i], sessions["_row"][i]
+                break
 
         if not session_start:
             return f"⚠️ {username} , you didn't start any session. Use !start to begin."
@@ -1097,20 +3232,35 @@ def handle_stop(username, userid):
         # Calculate duration and XP
         duration_minutes = int((now - session_start).total_seconds() / 60)
         xp_earned = duration_minutes * 2
+        
+        # Load the totals before this session is marked Completed, or it counts twice
+        try:
+            ensure_study_minutes()
+        except Exception as e:
+            logger.error(f"Error loading study minutes, skipping the badge check: {e}")
 
         # Update the session record
-        session_sheet.update_cell(row_index, 4, now.strftime("%Y-%m-%d %H:%M:%S"))  # EndTime
-        session_sheet.update_cell(row_index, 5, duration_minutes)  # Duration
-        session_sheet.update_cell(row_index, 6, "Completed")  # Status
+        sheet.update_cell(row_index, 4, now.strftime("%Y-%m-%d %H:%M:%S"))  # EndTime
+        sheet.update_cell(row_index, 5, duration_minutes)  # Duration
+        sheet.update_cell(row_index, 6, "Completed")  # Status
+        record_session(userid, session_start.date(), duration_minutes)
+        study_minutes = record_study_minutes(userid, duration_minutes)
+        publish_cluster_event("session", {"userid": str(userid), "date": str(session_start.date()),
+                                          "minutes": duration_minutes})
+        
+        invalidate_cache(userid, *SESSION_VIEWS)
+        buddy_info = get_active_buddy(userid)
+        if buddy_info:
+            invalidate_cache(buddy_info['buddy_id'], "!buddyprog")
 
         # Update XP
         update_user_xp(username, userid, xp_earned, "Study Session")
 
-        # Badge check
-        badges = get_badges(duration_minutes)
-        badge_message = f"🎖 {username}, the badge {badges[-1]} has awakened through your silent training. ⚔️" if badges else ""
+        # Badges unlock on all-time study minutes, announced after the reply
+        if study_minutes:
+            queue_badge_unlock(username, userid, *study_minutes)
         
-        return f"👩🏻‍💻📓✍🏻 {username} , you studied for {duration_minutes} minutes and earned {xp_earned} XP.{badge_message}"
+        return f"👩🏻‍💻📓✍🏻 {username} , you studied for {duration_minutes} minutes and earned {xp_earned} XP."
     
     except Exception as e:
         return f"⚠️ Error stopping session: {str(e)}"
@@ -1119,24 +3269,41 @@ def handle_rank(username, userid):
     if not SHEETS_ENABLED:
         return f"⚠️ {username} ,study features are currently unavailable."
     
-    total_xp = get_user_total_xp(userid)
+    try:
+        total_xp = get_user_total_xp(userid)
+    except Exception as e:
+        logger.error(f"Error loading XP: {e}")
+        return f"⚠️ {username} ,your XP can't be loaded right now. Please try again in a minute."
     user_rank = get_rank(total_xp)
     return f"🏅 {username} ,total XP: {total_xp}. You now walk the shadowed path of the {user_rank}. The dojo watches in silence — your spirit grows sharper with every session."
 
-def handle_top():
+def handle_top(window=None):
     if not SHEETS_ENABLED:
         return "⚠️ Study features are currently unavailable."
     
+    if window and window not in LEADERBOARD_WINDOWS:
+        return f"⚠️ Use: !top, {', '.join('!top ' + w for w in LEADERBOARD_WINDOWS)}"
+    
     try:
-        records = xp_sheet.get_all_records()
-        sorted_users = sorted(records, key=lambda x: int(x.get('TotalXP', 0)), reverse=True)[:5]
+        ensure_xp_index()  # Usernames come from the xp sheet, awards only carry the user key
+        if window:
+            leaders = [(user_records[key].username, xp) for key, xp in window_top(window)]
+            if not leaders:
+                return f"🏆 No XP earned {'today' if window == 'today' else 'this ' + window} yet. Be the first!"
+            message = f"🏆 Top 5 Learners {'today' if window == 'today' else 'this ' + window}: "
+        else:
+            with user_state_lock:
+                sorted_users = heapq.nlargest(5, (r for r in user_records if r.xp_row is not None),
+                                              key=lambda r: r.total_xp)
+            leaders = [(user.username, user.total_xp) for user in sorted_users]
+            message = "🏆 Top 5 Learners: "
         
-        message = "🏆 Top 5 Learners: "
-        for i, user in enumerate(sorted_users, 1):
-            message += f"{i}. {user['Username']} ({user.get('TotalXP', 0)} XP) "
+        for i, (name, xp) in enumerate(leaders, 1):
+            message += f"{i}. {name} ({xp} XP) "
 
         return message.strip()
-    except:
+    except Exception as e:
+        logger.error(f"Error loading leaderboard: {e}")
         return "⚠️ Unable to fetch leaderboard data."
 
 def handle_task(username, userid, task_text):
@@ -1147,16 +3314,16 @@ def handle_task(username, userid, task_text):
         return f"⚠️ {username} , please provide a task like: !task Physics Chapter 1"
 
     try:
-        records = task_sheet.get_all_records()
-        for row in records[::-1]:
-            if str(row.get('UserID', '')) == str(userid) and str(row.get('Status', '')).strip() == 'Pending':
-                return f"⚠️ {username} , please complete your previous task first. Use !done to mark it as completed."
+        tasks = read_columns([task_sheet], ["UserID", "Status"])
+        if find_latest(tasks, userid, "Pending") is not None:
+            return f"⚠️ {username} , please complete your previous task first. Use !done to mark it as completed."
     except Exception as e:
-        print(f"Error checking tasks: {e}")
+        logger.error(f"Error checking tasks: {e}")
 
     now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     task_name = task_text.strip()
     task_sheet.append_row([username, userid, task_name, now, "", "Pending"])
+    invalidate_cache(userid, *TASK_VIEWS)
     return f"✏️ {username} , your task '{task_name}' has been added. Study well! Use !done to complete it."
 
 def handle_done(username, userid):
@@ -1164,23 +3331,22 @@ def handle_done(username, userid):
         return f"⚠️ {username} , study features are currently unavailable."
     
     try:
-        records = task_sheet.get_all_records()
-
-        for i in range(len(records) - 1, -1, -1):
-            row = records[i]
-            if str(row.get('UserID', '')) == str(userid) and str(row.get('Status', '')).strip() == 'Pending':
-                row_index = i + 2
-                task_name = row.get('TaskName', '')
+        tasks = read_columns([task_sheet], ["UserID", "Status", "TaskName"])
+        i = find_latest(tasks, userid, "Pending")
+        if i is not None:
+            row_index = tasks["_row"][i]
+            task_name = tasks["TaskName"][i] or ''
 
-                # Mark task as completed
-                task_sheet.update_cell(row_index, 5, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-                task_sheet.update_cell(row_index, 6, "Completed")
+            # Mark task as completed
+            task_sheet.update_cell(row_index, 5, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+            task_sheet.update_cell(row_index, 6, "Completed")
+            invalidate_cache(userid, *TASK_VIEWS)
 
-                # Update XP
-                xp_earned = 15
-                update_user_xp(username, userid, xp_earned, "Task Completed")
+            # Update XP
+            xp_earned = 15
+            update_user_xp(username, userid, xp_earned, "Task Completed")
 
-                return f"✅ {username} , you completed your task '{task_name}' and earned {xp_earned} XP! Great job! 💪"
+            return f"✅ {username} , you completed your task '{task_name}' and earned {xp_earned} XP! Great job! 💪"
 
         return f"⚠️ {username} , you don't have any active task. Use !task [your task] to add one."
     except Exception as e:
@@ -1191,30 +3357,36 @@ def handle_summary(username, userid):
         return f"⚠️ {username} , study features are currently unavailable."
     
     try:
+        session_reads = (session_sheets(), ["UserID", "Status", "Duration"])
+        task_reads = ([task_sheet], ["UserID", "Status"])
+        plan_reads(session_reads, task_reads, *xp_index_reads())
+        
         # Get total XP
         total_xp = get_user_total_xp(userid)
         
         # Get total study time from sessions
-        session_records = session_sheet.get_all_records()
+        sessions = read_columns(*session_reads)
         total_minutes = 0
-        for row in session_records:
-            if str(row['UserID']) == str(userid) and row['Status'] == 'Completed':
-                try:
-                    total_minutes += int(row['Duration'])
-                except ValueError:
-                    pass
+        for user, status, duration in zip(sessions["UserID"], sessions["Status"], sessions["Duration"]):
+            if user == str(userid) and status == 'Completed' and duration is not None:
+                total_minutes += duration
 
         # Get task counts
-        task_records = task_sheet.get_all_records()
+        tasks = read_columns(*task_reads)
         completed_tasks = 0
         pending_tasks = 0
-        for row in task_records:
-            if str(row['UserID']) == str(userid):
-                if row['Status'] == 'Completed':
+        for user, status in zip(tasks["UserID"], tasks["Status"]):
+            if user == str(userid):
+                if status == 'Completed':
                     completed_tasks += 1
-                elif row['Status'] == 'Pending':
+                elif status == 'Pending':
                     pending_tasks += 1
 
+        # Add totals of archived rows
+        rollup = get_user_rollup(userid)
+        total_minutes += rollup_int(rollup, 'SessionMinutes')
+        completed_tasks += rollup_int(rollup, 'TasksCompleted')
+
         hours = total_minutes // 60
         minutes = total_minutes % 60
         return (f"📊 Today’s Summary for {username} "
@@ -1233,13 +3405,12 @@ def handle_goal(username, userid, goal_text):
         return f"⚠️ {username} , please provide a goal like: !goal Complete Math Course"
 
     try:
-        records = goal_sheet.get_all_records()
         # Check if user already has an active goal
-        for row in records[::-1]:
-            if str(row.get('UserID', '')) == str(userid) and str(row.get('Status', '')).strip() == 'Pending':
-                return f"⚠️ {username} , please complete your previous goal first. Use !complete to mark it as completed."
+        goals = read_columns([goal_sheet], ["UserID", "Status"])
+        if find_latest(goals, userid, "Pending") is not None:
+            return f"⚠️ {username} , please complete your previous goal first. Use !complete to mark it as completed."
     except Exception as e:
-        print(f"Error checking goals: {e}")
+        logger.error(f"Error checking goals: {e}")
 
     now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     goal_name = goal_text.strip()
@@ -1251,23 +3422,21 @@ def handle_complete(username, userid):
         return f"⚠️ {username} , study features are currently unavailable."
     
     try:
-        records = goal_sheet.get_all_records()
+        goals = read_columns([goal_sheet], ["UserID", "Status", "GoalName"])
+        i = find_latest(goals, userid, "Pending")
+        if i is not None:
+            row_index = goals["_row"][i]
+            goal_name = goals["GoalName"][i] or ''
 
-        for i in range(len(records) - 1, -1, -1):
-            row = records[i]
-            if str(row.get('UserID', '')) == str(userid) and str(row.get('Status', '')).strip() == 'Pending':
-                row_index = i + 2
-                goal_name = row.get('GoalName', '')
+            # Mark goal as completed
+            goal_sheet.update_cell(row_index, 5, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+            goal_sheet.update_cell(row_index, 6, "Completed")
 
-                # Mark goal as completed
-                goal_sheet.update_cell(row_index, 5, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-                goal_sheet.update_cell(row_index, 6, "Completed")
+            # Update XP - Goals give 25 XP
+            xp_earned = 25
+            update_user_xp(username , userid, xp_earned, "Goal Completed")
 
-                # Update XP - Goals give 25 XP
-                xp_earned = 25
-                update_user_xp(username , userid, xp_earned, "Goal Completed")
-
-                return f"🎉 {username} , congratulations! You completed your goal '{goal_name}' and earned {xp_earned} XP! Amazing achievement! 🏆✨"
+            return f"🎉 {username} , congratulations! You completed your goal '{goal_name}' and earned {xp_earned} XP! Amazing achievement! 🏆✨"
 
         return f"⚠️ {username} , you don't have any active goal. Use !goal [your goal] to set one."
     except Exception as e:
@@ -1280,13 +3449,12 @@ def handle_pending(username, userid):
         return f"⚠️ {username} , study features are currently unavailable."
     
     try:
-        records = task_sheet.get_all_records()
-        
-        for row in records[::-1]:  # Check from latest to oldest
-            if str(row.get('UserID', '')) == str(userid) and str(row.get('Status', '')).strip() == 'Pending':
-                task_name = row.get('TaskName', '')
-                created_date = row.get('CreatedDate', '')
-                return f"📋 {username} , your pending task: '{task_name}' (Created: {created_date})"
+        tasks = read_columns([task_sheet], ["UserID", "Status", "TaskName", "CreatedDate"])
+        i = find_latest(tasks, userid, "Pending")
+        if i is not None:
+            task_name = tasks["TaskName"][i] or ''
+            created_date = tasks["CreatedDate"][i] or ''
+            return f"📋 {username} , your pending task: '{task_name}' (Created: {created_date})"
         
         return f"✅ {username} , you don't have any pending tasks. Use !task [task name] to add one."
     
@@ -1299,18 +3467,17 @@ def handle_remove(username, userid):
         return f"⚠️ {username} , study features are currently unavailable."
     
     try:
-        records = task_sheet.get_all_records()
-        
-        for i in range(len(records) - 1, -1, -1):  # Check from latest to oldest
-            row = records[i]
-            if str(row.get('UserID', '')) == str(userid) and str(row.get('Status', '')).strip() == 'Pending':
-                row_index = i + 2  # Google Sheets is 1-indexed and has header row
-                task_name = row.get('TaskName', '')
-                
-                # Update status to 'Removed'
-                task_sheet.update_cell(row_index, 6, "Removed")
-                
-                return f"🗑️ {username} , your task '{task_name}' has been removed."
+        tasks = read_columns([task_sheet], ["UserID", "Status", "TaskName"])
+        i = find_latest(tasks, userid, "Pending")
+        if i is not None:
+            row_index = tasks["_row"][i]
+            task_name = tasks["TaskName"][i] or ''
+            
+            # Update status to 'Removed'
+            task_sheet.update_cell(row_index, 6, "Removed")
+            invalidate_cache(userid, *TASK_VIEWS)
+            
+            return f"🗑️ {username} , your task '{task_name}' has been removed."
         
         return f"⚠️ {username} , you don't have any pending tasks to remove."
     
@@ -1323,15 +3490,15 @@ def handle_comtask(username, userid):
         return f"⚠️ {username} , study features are currently unavailable."
     
     try:
-        records = task_sheet.get_all_records()
+        tasks = read_columns([task_sheet], ["UserID", "Status", "TaskName", "CompletedDate"])
         completed_tasks = []
         
         # Get all completed tasks for this user
-        for row in records:
-            if str(row.get('UserID', '')) == str(userid) and str(row.get('Status', '')).strip() == 'Completed':
+        for i in range(len(tasks["_row"])):
+            if tasks["UserID"][i] == str(userid) and (tasks["Status"][i] or "").strip() == 'Completed':
                 completed_tasks.append({
-                    'name': row.get('TaskName', ''),
-                    'completed_date': row.get('CompletedDate', '')
+                    'name': tasks["TaskName"][i] or '',
+                    'completed_date': tasks["CompletedDate"][i] or ''
                 })
         
         if not completed_tasks:
@@ -1349,10 +3516,342 @@ def handle_comtask(username, userid):
     except Exception as e:
         return f"⚠️ Error fetching completed tasks: {str(e)}"
 
-def process_command(message, author_name, author_id):
-    """Process study bot commands from chat messages"""
+# === Study Analytics ===
+# !week and !month answer from a columnar buffer of completed sessions:
+# parallel arrays of user key, start day (ordinal) and minutes. It is loaded
+# once from the routed session sheets and appended to by !stop. Window
+# aggregates for every user at once are computed with NumPy when available
+# (plain loops otherwise) and cached per window until the next session
+# completes or ANALYTICS_TTL_SECONDS pass.
+ANALYTICS_WINDOWS = {"week": 7, "month": 30}
+ANALYTICS_TTL_SECONDS = int(os.getenv("ANALYTICS_TTL_SECONDS", "300"))
+
+analytics_lock = threading.RLock()
+session_columns = {"user": array("i"), "day": array("i"), "minutes": array("i")}
+session_columns_loaded = False
+window_aggregates = {}  # (window, today ordinal) -> (expires_at, aggregates)
+
+def load_session_columns():
+    """Fill the session buffer with completed sessions inside the longest window"""
+    global session_columns_loaded
+    
+    oldest = datetime.now().date().toordinal() - max(ANALYTICS_WINDOWS.values())
+    sessions = read_columns(session_sheets(), ["UserID", "StartTime", "Duration", "Status"])
+    with analytics_lock:
+        columns = {"user": array("i"), "day": array("i"), "minutes": array("i")}
+        for userid, start, minutes, status in zip(sessions["UserID"], sessions["StartTime"],
+                                                  sessions["Duration"], sessions["Status"]):
+            if status != 'Completed':
+                continue
+            if start and start.date().toordinal() >= oldest:
+                columns["user"].append(user_key(userid or ''))
+                columns["day"].append(start.date().toordinal())
+                columns["minutes"].append(minutes or 0)
+        session_columns.update(columns)
+        window_aggregates.clear()
+        session_columns_loaded = True
+
+def invalidate_session_columns():
+    global session_columns_loaded
+    session_columns_loaded = False
+
+def record_session(userid, start_date, minutes):
+    """Append a completed session to the buffer"""
+    if not session_columns_loaded:
+        return
+    with analytics_lock:
+        session_columns["user"].append(user_key(userid))
+        session_columns["day"].append(start_date.toordinal())
+        session_columns["minutes"].append(int(minutes))
+        window_aggregates.clear()
+
+def compute_window_aggregates(days, today):
+    """Minutes per user per day and sessions per user over the days ending today"""
+    start = today - days + 1
+    with analytics_lock:
+        n_users = len(user_records)
+        if np is not None:
+            user = np.array(session_columns["user"], dtype=np.int64)
+            day = np.array(session_columns["day"], dtype=np.int64)
+            minutes = np.array(session_columns["minutes"], dtype=np.int64)
+        else:
+            user, day, minutes = (session_columns[c].tolist() for c in ("user", "day", "minutes"))
+    
+    if np is not None:
+        mask = (day >= start) & (day <= today)
+        u, d, m = user[mask], day[mask] - start, minutes[mask]
+        per_user_day = np.bincount(u * days + d, weights=m, minlength=n_users * days).reshape(n_users, days)
+        per_user_day = per_user_day.astype(np.int64)
+        per_user_sessions = np.bincount(u, minlength=n_users)
+        community_day = per_user_day.sum(axis=0).tolist()
+        sessions = int(mask.sum())
+        active_users = int((per_user_sessions > 0).sum())
+    else:
+        per_user_day = defaultdict(lambda: [0] * days)
+        per_user_sessions = Counter()
+        community_day = [0] * days
+        sessions = 0
+        for u, d, m in zip(user, day, minutes):
+            if start <= d <= today:
+                per_user_day[u][d - start] += m
+                per_user_sessions[u] += 1
+                community_day[d - start] += m
+                sessions += 1
+        active_users = len(per_user_sessions)
+    
+    return {
+        "start": start,
+        "days": days,
+        "per_user_day": per_user_day,
+        "per_user_sessions": per_user_sessions,
+        "community_day": community_day,
+        "sessions": sessions,
+        "active_users": active_users,
+    }
+
+def get_window_aggregates(window):
+    """Cached aggregates for a window name from ANALYTICS_WINDOWS"""
+    today = datetime.now().date().toordinal()
+    key = (window, today)
+    now = time.monotonic()
+    cached = window_aggregates.get(key)
+    if cached and cached[0] > now:
+        increment_metric("analytics_cache_hits")
+        return cached[1]
+    
+    if not session_columns_loaded:
+        load_session_columns()
+    aggregates = compute_window_aggregates(ANALYTICS_WINDOWS[window], today)
+    with analytics_lock:
+        window_aggregates[key] = (now + ANALYTICS_TTL_SECONDS, aggregates)
+    increment_metric("analytics_cache_misses")
+    return aggregates
+
+def window_stats(aggregates, userid=None):
+    """Daily minutes, totals, best day and average session for a user or the community"""
+    days = aggregates["days"]
+    if userid is None:
+        daily, sessions = aggregates["community_day"], aggregates["sessions"]
+    else:
+        key = user_keys.get(str(userid))
+        daily, sessions = [0] * days, 0
+        if key is not None:
+            if np is not None and key < len(aggregates["per_user_day"]):
+                daily = aggregates["per_user_day"][key].tolist()
+                sessions = int(aggregates["per_user_sessions"][key])
+            elif np is None and key in aggregates["per_user_sessions"]:
+                daily = aggregates["per_user_day"][key]
+                sessions = aggregates["per_user_sessions"][key]
+    
+    total = int(sum(daily))
+    best = max(range(days), key=lambda i: daily[i])
+    return {
+        "daily": [{"date": str(datetime.fromordinal(aggregates["start"] + i).date()), "minutes": int(daily[i])}
+                  for i in range(days)],
+        "total_minutes": total,
+        "sessions": sessions,
+        "active_days": sum(1 for minutes in daily if minutes),
+        "best_day": str(datetime.fromordinal(aggregates["start"] + best).date()) if total else None,
+        "best_day_minutes": int(daily[best]),
+        "avg_session_minutes": round(total / sessions) if sessions else 0,
+    }
+
+def handle_window_summary(username, userid, window):
+    if not SHEETS_ENABLED:
+        return f"⚠️ {username} , study features are currently unavailable."
+    
+    try:
+        stats = window_stats(get_window_aggregates(window), userid)
+    except Exception as e:
+        return f"⚠️ Error generating {window} summary: {str(e)}"
+    
+    if not stats["total_minutes"]:
+        return f"📅 {username} ,no completed sessions this {window} yet. Use !start to begin."
+    
+    hours, minutes = divmod(stats["total_minutes"], 60)
+    best_day = datetime.strptime(stats["best_day"], "%Y-%m-%d").strftime("%a %d")
+    message = (f"📅 {username} ,this {window}: {hours}h {minutes}m in {stats['sessions']} sessions "
+               f"on {stats['active_days']}/{len(stats['daily'])} days. "
+               f"🏆 Best day: {best_day} ({stats['best_day_minutes']}m). "
+               f"⏱️ Avg session: {stats['avg_session_minutes']}m.")
+    if window == "week":
+        daily = " ".join(f"{datetime.strptime(d['date'], '%Y-%m-%d').strftime('%a')} {d['minutes']}"
+                         for d in stats["daily"])
+        message += f" 📊 {daily}"
+    return message
+
+sheet_rewrite_hooks["session"].append(invalidate_session_columns)
+
+# === Rate Limiting & Coalescing ===
+# Every command costs tokens from two buckets: one per user and one per
+# (user, command). Expensive commands cost more, so repeating them hits the
+# cooldown sooner. Identical read-only commands from the same user inside
+# the coalesce window are folded into the first execution and get no second
+# reply. Commands that change state always run, so !start, !stop, !start
+# in quick succession leaves a session running, and they clear the user's
+# coalesce entries, so !pending, !task, !pending answers both times.
+RATE_LIMIT_USER_BURST = float(os.getenv("RATE_LIMIT_USER_BURST", "8"))
+RATE_LIMIT_USER_REFILL_SECONDS = float(os.getenv("RATE_LIMIT_USER_REFILL_SECONDS", "5"))
+RATE_LIMIT_COMMAND_BURST = float(os.getenv("RATE_LIMIT_COMMAND_BURST", "3"))
+RATE_LIMIT_COMMAND_REFILL_SECONDS = float(os.getenv("RATE_LIMIT_COMMAND_REFILL_SECONDS", "20"))
+COALESCE_WINDOW_SECONDS = float(os.getenv("COALESCE_WINDOW_SECONDS", "30"))
+
+# Token cost per command, roughly the number of full-sheet reads it does
+COMMAND_COSTS = {
+    "!attend": 1,
+    "!start": 1,
+    "!stop": 1,
+    "!rank": 1,
+    "!top": 2,
+    "!done": 1,
+    "!summary": 3,
+    "!complete": 1,
+    "!task": 1,
+    "!goal": 1,
+    "!pending": 1,
+    "!remove": 1,
+    "!comtask": 1,
+    "!remind": 1,
+    "!reminders": 1,
+    "!buddy": 2,
+    "!buddyprog": 2,
+    "!week": 2,
+    "!month": 2,
+    "!help": 1,
+}
+COMMAND_COSTS.update(json.loads(os.getenv("COMMAND_COSTS_JSON", "{}")))
+
+# Commands that only read, so a repeat would get the same answer
+COALESCED_COMMANDS = {"!rank", "!top", "!summary", "!pending", "!reminders", "!buddyprog", "!week", "!month", "!help"}
+
+rate_limit_lock = threading.Lock()
+user_buckets = {}       # UserID -> [tokens, last_refill]
+command_buckets = {}    # (UserID, command) -> [tokens, last_refill]
+recent_commands = {}    # UserID -> {normalized message: last execution time}
+
+# Counters exposed on /metrics
+metrics = defaultdict(int)
+metrics_lock = threading.Lock()
+
+def increment_metric(name, amount=1):
+    """Add to a named counter"""
+    with metrics_lock:
+        metrics[name] += amount
+
+def _take_tokens(buckets, key, cost, burst, refill_seconds, now):
+    """Refill a token bucket and try to take cost tokens from it"""
+    bucket = buckets.get(key)
+    if bucket is None:
+        bucket = buckets[key] = [burst, now]
+    
+    bucket[0] = min(burst, bucket[0] + (now - bucket[1]) / refill_seconds)
+    bucket[1] = now
+    
+    if bucket[0] < cost:
+        return False
+    bucket[0] -= cost
+    return True
+
+def _prune_rate_limit_state(now):
+    """Drop idle buckets and expired coalesce entries so memory stays bounded"""
+    idle_after = max(RATE_LIMIT_USER_BURST * RATE_LIMIT_USER_REFILL_SECONDS,
+                     RATE_LIMIT_COMMAND_BURST * RATE_LIMIT_COMMAND_REFILL_SECONDS)
+    for buckets in (user_buckets, command_buckets):
+        for key in [k for k, b in buckets.items() if now - b[1] > idle_after]:
+            del buckets[key]
+    for userid, messages in list(recent_commands.items()):
+        for message in [m for m, t in messages.items() if now - t > COALESCE_WINDOW_SECONDS]:
+            del messages[message]
+        if not messages:
+            del recent_commands[userid]
+
+def admit_command(userid, message_lower, command):
+    """Decide whether a command should run, counting what gets shed"""
+    now = time.monotonic()
+    cost = COMMAND_COSTS.get(command, 1)
+    userid = str(userid)
+    
+    with rate_limit_lock:
+        if len(recent_commands) > 10000 or len(command_buckets) > 10000:
+            _prune_rate_limit_state(now)
+        
+        # Identical read-only command already answered inside the window
+        last_run = recent_commands.get(userid, {}).get(message_lower) if command in COALESCED_COMMANDS else None
+        if last_run is not None and now - last_run < COALESCE_WINDOW_SECONDS:
+            increment_metric("commands_coalesced")
+            return False
+        
+        # Check both buckets before taking from either
+        user_bucket = user_buckets.get(userid)
+        command_bucket = command_buckets.get((userid, command))
+        saved = (list(user_bucket) if user_bucket else None,
+                 list(command_bucket) if command_bucket else None)
+        
+        if not (_take_tokens(user_buckets, userid, cost,
+                             RATE_LIMIT_USER_BURST, RATE_LIMIT_USER_REFILL_SECONDS, now)
+                and _take_tokens(command_buckets, (userid, command), cost,
+                                 RATE_LIMIT_COMMAND_BURST, RATE_LIMIT_COMMAND_REFILL_SECONDS, now)):
+            # Refund the user bucket if only the command bucket was empty
+            if saved[0] is not None:
+                user_buckets[userid] = saved[0]
+            else:
+                user_buckets.pop(userid, None)
+            increment_metric("commands_rate_limited")
+            return False
+        
+        if command in COALESCED_COMMANDS:
+            recent_commands.setdefault(userid, {})[message_lower] = now
+        else:
+            # The state changed, so a repeated read gets a different answer
+            recent_commands.pop(userid, None)
+    
+    increment_metric("commands_admitted")
+    return True
+
+# Chat message IDs seen recently. pytchat can deliver an item again after a
+# reconnect or an overlapping poll, and a repeated !stop or !done would
+# repeat its sheet writes and reply. IDs are kept in insertion order and
+# expire after DEDUP_WINDOW_SECONDS, with at most DEDUP_MAX_IDS held.
+DEDUP_WINDOW_SECONDS = float(os.getenv("DEDUP_WINDOW_SECONDS", "600"))
+DEDUP_MAX_IDS = int(os.getenv("DEDUP_MAX_IDS", "20000"))
+
+dedup_lock = threading.Lock()
+seen_messages = OrderedDict()  # message ID -> first seen (monotonic)
+
+def chat_message_id(chat_item):
+    """pytchat's message ID, or author, timestamp and text when it has none"""
+    return getattr(chat_item, "id", None) or f"{chat_item.author.channelId}:{chat_item.timestamp}:{chat_item.message}"
+
+def is_duplicate_message(message_id):
+    """Record a chat message ID, True if it was already seen inside the window"""
+    now = time.monotonic()
+    with dedup_lock:
+        # Expire from the oldest end, then enforce the size bound
+        while seen_messages:
+            seen_at = next(iter(seen_messages.values()))
+            if now - seen_at <= DEDUP_WINDOW_SECONDS and len(seen_messages) < DEDUP_MAX_IDS:
+                break
+            seen_messages.popitem(last=False)
+        
+        if message_id in seen_messages:
+            duplicate = True
+        else:
+            seen_messages[message_id] = now
+            duplicate = False
+    
+    if duplicate:
+        increment_metric("duplicate_messages_dropped")
+    return duplicate
+
+def process_command(message, author_name, author_id, video_id=None):
+    """Process study bot commands from chat messages, video_id is the stream it came from"""
     message_lower = message.lower().strip()
     
+    # Shed spam and repeats before any sheet is touched
+    command = message_lower.split(" ", 1)[0]
+    if command in COMMAND_COSTS and not admit_command(author_id, message_lower, command):
+        return None
+    
     # Command mapping
     if message_lower == "!attend":
         return handle_attend(author_name, author_id)
@@ -1361,13 +3860,17 @@ def process_command(message, author_name, author_id):
     elif message_lower == "!stop":
         return handle_stop(author_name, author_id)
     elif message_lower == "!rank":
-        return handle_rank(author_name, author_id)
+        return cached_response("!rank", author_id, lambda: handle_rank(author_name, author_id))
     elif message_lower == "!top":
-        return handle_top()
+        return cached_response("!top", None, handle_top)
+    elif message_lower.startswith("!top "):
+        return handle_top(message_lower[5:].strip())
     elif message_lower == "!done":
         return handle_done(author_name, author_id)
     elif message_lower == "!summary":
-        return handle_summary(author_name, author_id)
+        return cached_response("!summary", author_id, lambda: handle_summary(author_name, author_id))
+    elif message_lower in ("!week", "!month"):
+        return handle_window_summary(author_name, author_id, message_lower[1:])
     elif message_lower == "!complete":
         return handle_complete(author_name, author_id)
     elif message_lower.startswith("!task "):
@@ -1377,56 +3880,1054 @@ def process_command(message, author_name, author_id):
         goal_text = message[6:]
         return handle_goal(author_name, author_id, goal_text)
     elif message_lower == "!pending":
-        return handle_pending(author_name, author_id)
+        return cached_response("!pending", author_id, lambda: handle_pending(author_name, author_id))
     elif message_lower == "!remove":
         return handle_remove(author_name, author_id)
     elif message_lower == "!comtask":
-        return handle_comtask(author_name, author_id)
+        return cached_response("!comtask", author_id, lambda: handle_comtask(author_name, author_id))
+    elif message_lower == "!reminders":
+        return handle_reminders(author_name, author_id)
     elif message_lower.startswith("!remind "):
         remind_text = message[8:]
-        return handle_remind(author_name, author_id, remind_text)
+        return handle_remind(author_name, author_id, remind_text, video_id or VIDEO_ID)
     elif message_lower == "!buddy" or message_lower.startswith("!buddy "):
         buddy_command = message[7:] if len(message) > 7 else ""
         return handle_buddy(author_name, author_id, buddy_command)
     elif message_lower == "!buddyprog":
-        return handle_buddy_progress(author_name, author_id)
+        return cached_response("!buddyprog", author_id, lambda: handle_buddy_progress(author_name, author_id))
     elif message_lower == "!help":
-        return ("Commands: !attend !start !stop | !rank !top | !task !done !remove !comtask | !goal !complete | !summary !pending | !ask <your question> (Sunnie Study GPT is here to help—ask away)")
+        return ("Commands: !attend !start !stop | !rank !top [today|week|month] | !task !done !remove !comtask | !goal !complete | !summary !week !month !pending | !remind !reminders | !ask <your question> (Sunnie Study GPT is here to help—ask away)")
     
     return None
 
-def run_bot():
-    if not VIDEO_ID:
-        print("❌ Error: YOUTUBE_VIDEO_ID environment variable not set.")
-        return
+# === Cluster Mode ===
+# With CLUSTER_DB set, several instances read the same chat and split users
+# between them. Users hash (by channelId) into CLUSTER_PARTITIONS partitions,
+# and each partition is leased to one live instance through a shared SQLite
+# database. Instances only answer users whose partition they hold. When an
+# instance stops renewing, its leases expire and the others take over. The
+# same database carries cache invalidations between instances, a
+# maintenance flag that pauses commands while archival moves rows, and
+# the YouTube quota spent per project.
+CLUSTER_DB = os.getenv("CLUSTER_DB")
+CLUSTER_PARTITIONS = int(os.getenv("CLUSTER_PARTITIONS", "16"))
+CLUSTER_LEASE_SECONDS = float(os.getenv("CLUSTER_LEASE_SECONDS", "30"))
+CLUSTER_POLL_SECONDS = float(os.getenv("CLUSTER_POLL_SECONDS", "2"))
+INSTANCE_ID = os.getenv("INSTANCE_ID") or f"{socket.gethostname()}-{os.getpid()}"
 
-    # 🔁 Refresh access token before anything else
-    refresh_access_token_auto()
+cluster_lock = threading.Lock()
+owned_partitions = {}  # partition -> lease expiry (wall clock)
+cluster_event_id = 0  # Last event applied from other instances
+cluster_event_handlers = {}  # event name -> callback(payload)
+maintenance_until = 0  # Wall clock end of another instance's maintenance, polled by the worker
+cluster_schema_ready = False
+cluster_local = threading.local()  # .conn: this thread's coordination database connection
 
-    # ✅ Start timer system
-    start_timer_system()
+def cluster_connect():
+    """Open the coordination database, creating the tables the first time in this process"""
+    global cluster_schema_ready
+    
+    conn = sqlite3.connect(CLUSTER_DB, timeout=10, isolation_level=None)
+    conn.execute("PRAGMA synchronous=NORMAL")  # Safe with WAL, commits skip the fsync
+    with cluster_lock:
+        if not cluster_schema_ready:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS members (instance_id TEXT PRIMARY KEY, heartbeat REAL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS leases (partition INTEGER PRIMARY KEY, owner TEXT, expires_at REAL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                         "origin TEXT, name TEXT, payload TEXT, created_at REAL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS maintenance (id INTEGER PRIMARY KEY CHECK (id = 0), "
+                         "owner TEXT, until REAL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS quota (project TEXT, day TEXT, used INTEGER, "
+                         "PRIMARY KEY (project, day))")
+            cluster_schema_ready = True
+    return conn
 
-    chat = pytchat.create(video_id=VIDEO_ID)
-    print("✅ Bot started...")
+def cluster_db():
+    """This thread's coordination database connection, kept open for reuse"""
+    conn = getattr(cluster_local, "conn", None)
+    if conn is None:
+        conn = cluster_local.conn = cluster_connect()
+    return conn
 
-    while chat.is_alive():
-        for c in chat.get().sync_items():
-            print(f"{c.author.name}: {c.message}")
-            
-            # Increment chat count for timer system
-            increment_chat_count()
+def user_partition(channel_id):
+    """Stable partition for a user, the same on every instance"""
+    return zlib.crc32(str(channel_id).encode("utf-8")) % CLUSTER_PARTITIONS
+
+def owns_user(channel_id):
+    """True if this instance should process and reply for the user"""
+    if not CLUSTER_DB:
+        return True
+    expires_at = owned_partitions.get(user_partition(channel_id))
+    return expires_at is not None and expires_at > time.time()
+
+def is_cluster_leader():
+    """The owner of partition 0 runs the once-per-cluster jobs (timers, archival)"""
+    if not CLUSTER_DB:
+        return True
+    expires_at = owned_partitions.get(0)
+    return expires_at is not None and expires_at > time.time()
+
+def rebalance_leases(conn):
+    """Heartbeat, then take, renew or release leases to match the live member list"""
+    now = time.time()
+    expires_at = now + CLUSTER_LEASE_SECONDS
+    
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("INSERT OR REPLACE INTO members VALUES (?, ?)", (INSTANCE_ID, now))
+        conn.execute("DELETE FROM members WHERE heartbeat < ?", (now - CLUSTER_LEASE_SECONDS,))
+        members = [row[0] for row in conn.execute("SELECT instance_id FROM members ORDER BY instance_id")]
+        leases = {row[0]: (row[1], row[2]) for row in conn.execute("SELECT partition, owner, expires_at FROM leases")}
+        
+        owned = {}
+        for partition in range(CLUSTER_PARTITIONS):
+            target = members[partition % len(members)]
+            owner, lease_expiry = leases.get(partition, (None, 0))
             
-            # Handle original !hello command
-            if "!hello" in c.message.lower():
-                reply = f"Hi {c.author.name} !"
-                send_message(VIDEO_ID, reply, ACCESS_TOKEN)
+            if target == INSTANCE_ID:
+                # Take the partition once the previous owner let go or died
+                if owner in (None, INSTANCE_ID) or lease_expiry < now:
+                    conn.execute("INSERT OR REPLACE INTO leases VALUES (?, ?, ?)",
+                                 (partition, INSTANCE_ID, expires_at))
+                    owned[partition] = expires_at
+            elif owner == INSTANCE_ID:
+                # Hand the partition to its new target
+                conn.execute("DELETE FROM leases WHERE partition = ?", (partition,))
+        
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    
+    with cluster_lock:
+        owned_partitions.clear()
+        owned_partitions.update(owned)
+
+def publish_cluster_event(name, payload=None):
+    """Tell the other instances about a change they must apply to their own caches"""
+    if not CLUSTER_DB:
+        return
+    try:
+        cluster_db().execute("INSERT INTO events (origin, name, payload, created_at) VALUES (?, ?, ?, ?)",
+                             (INSTANCE_ID, name, json.dumps(payload), time.time()))
+    except Exception as e:
+        logger.error(f"❌ Error publishing cluster event {name}: {e}")
+
+def apply_cluster_events(conn):
+    """Apply events other instances published since the last poll"""
+    global cluster_event_id
+    
+    rows = conn.execute("SELECT id, name, payload FROM events WHERE id > ? AND origin != ? ORDER BY id",
+                        (cluster_event_id, INSTANCE_ID)).fetchall()
+    for event_id, name, payload in rows:
+        handler = cluster_event_handlers.get(name)
+        if handler:
+            try:
+                handler(json.loads(payload))
+            except Exception as e:
+                logger.error(f"❌ Error applying cluster event {name}: {e}")
+        cluster_event_id = event_id
+    
+    conn.execute("DELETE FROM events WHERE created_at < ?", (time.time() - 600,))
+
+def poll_cluster_maintenance(conn):
+    """Copy another instance's maintenance flag into memory"""
+    global maintenance_until
+    
+    row = conn.execute("SELECT owner, until FROM maintenance WHERE id = 0").fetchone()
+    maintenance_until = row[1] if row and row[0] != INSTANCE_ID else 0
+
+def cluster_worker():
+    """Background worker that keeps leases fresh and applies peer events"""
+    conn = cluster_connect()
+    
+    # Only events published after joining matter, the caches start empty
+    global cluster_event_id
+    cluster_event_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM events").fetchone()[0]
+    
+    last_rebalance = 0
+    while True:
+        try:
+            if time.monotonic() - last_rebalance >= CLUSTER_LEASE_SECONDS / 3:
+                rebalance_leases(conn)
+                last_rebalance = time.monotonic()
+            apply_cluster_events(conn)
+            flush_sheet_writes()
+            poll_cluster_maintenance(conn)
+            sync_quota_ledger(conn)
+        except Exception as e:
+            logger.error(f"❌ Cluster worker error: {e}")
+        time.sleep(CLUSTER_POLL_SECONDS)
+
+def wait_for_cluster_maintenance():
+    """Block while another instance is moving rows in the shared sheets"""
+    while maintenance_until > time.time():
+        time.sleep(CLUSTER_POLL_SECONDS)
+
+@contextmanager
+def cluster_maintenance(max_seconds=120):
+    """Pause command processing on every instance while rows move"""
+    if not CLUSTER_DB:
+        yield
+        return
+    
+    conn = cluster_connect()
+    try:
+        conn.execute("INSERT OR REPLACE INTO maintenance VALUES (0, ?, ?)",
+                     (INSTANCE_ID, time.time() + max_seconds))
+        # Let every instance see the flag and finish the command it is on
+        time.sleep(CLUSTER_POLL_SECONDS * 3)
+        yield
+    finally:
+        conn.execute("DELETE FROM maintenance WHERE id = 0 AND owner = ?", (INSTANCE_ID,))
+        conn.close()
+
+def start_cluster_system():
+    """Join the cluster and take an initial share of partitions"""
+    if not CLUSTER_DB:
+        return
+    
+    conn = cluster_connect()
+    try:
+        rebalance_leases(conn)
+    finally:
+        conn.close()
+    
+    cluster_thread = threading.Thread(target=cluster_worker, daemon=True)
+    cluster_thread.start()
+    logger.info(f"✅ Joined cluster as {INSTANCE_ID}, holding {len(owned_partitions)}/{CLUSTER_PARTITIONS} partitions")
+
+cluster_event_handlers.update({
+    "invalidate_cache": lambda payload: invalidate_cache(payload["userid"], *payload["kinds"], broadcast=False),
+    "sheet_rewritten": lambda payload: notify_sheet_rewritten(payload["title"], broadcast=False),
+    "buddy_changed": lambda payload: invalidate_buddy_graph(),
+    "sheet_writes": lambda payload: apply_peer_sheet_writes(payload),
+    "xp": apply_xp_event,
+    "attendance": apply_attendance_event,
+    "session": apply_session_event,
+})
+
+# === Warm Start ===
+# Derived state is saved to a local snapshot every few minutes and on
+# shutdown. That covers the XP and attendance indexes, known users, the
+# buddy graph, the rollup, timer state and pending reminders. Each saved
+# sheet also gets a fingerprint: its row count and a hash of the column
+# that every write touches. On startup those columns come back in one
+# values_batch_get. Unchanged sheets are trusted as saved. New or edited
+# XP and attendance rows are read on their own. Anything else that changed
+# is left to reload on first use.
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH", "state_snapshot.json")  # Empty disables snapshots
+SNAPSHOT_INTERVAL_SECONDS = int(os.getenv("SNAPSHOT_INTERVAL_SECONDS", "300"))
+SNAPSHOT_VERSION = 2
+REMINDER_RESUME_GRACE_MINUTES = int(os.getenv("REMINDER_RESUME_GRACE_MINUTES", "10"))
+
+# Column written by every append or update, per base sheet title
+FINGERPRINT_COLUMNS = {
+    "xp": "D",              # LastUpdated
+    "attendance": "C",      # Date
+    "buddy": "E",           # Status
+    "buddy_requests": "F",  # Status
+    "reminders": "G",       # Status
+    "rollup": "L",          # UpdatedAt
+}
+
+def get_ranges(ranges):
+    """Fetch several A1 ranges in one call, returns a list of row lists"""
+    if not ranges:
+        return []
+    batch = spreadsheet.values_batch_get(ranges)
+    return [value_range.get("values", []) for value_range in batch.get("valueRanges", [])]
+
+def fingerprint_sheets():
+    """Read the fingerprint column of every snapshotted sheet, by title"""
+    sheets = [xp_sheet, buddy_sheet, buddy_requests_sheet, reminder_sheet, rollup_sheet] + attendance_sheets()
+    ranges = [f"'{sheet.title}'!{FINGERPRINT_COLUMNS[shard_base(sheet.title)]}:{FINGERPRINT_COLUMNS[shard_base(sheet.title)]}"
+              for sheet in sheets]
+    columns = {}
+    for sheet, values in zip(sheets, get_ranges(ranges)):
+        columns[sheet.title] = [str(row[0]) if row else "" for row in values]
+    return columns
+
+def column_hash(values):
+    return hashlib.sha1("\n".join(values).encode("utf-8")).hexdigest()
+
+def save_snapshot():
+    """Write derived state and sheet fingerprints to SNAPSHOT_PATH"""
+    if not SNAPSHOT_PATH or not SHEETS_ENABLED:
+        return
+    
+    try:
+        # Row numbers in the indexes must match the fingerprinted sheets. A
+        # command may still append between the two reads, then the index is
+        # ahead of the fingerprint and restore reloads that sheet.
+        with sheet_maintenance_lock.shared():
+            columns = fingerprint_sheets()
+            with user_state_lock, buddy_lock, leaderboard_lock, reminder_lock:
+                snapshot = {
+                    "version": SNAPSHOT_VERSION,
+                    "saved_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                    "sheets": {title: {"rows": len(values), "hash": column_hash(values)}
+                               for title, values in columns.items()},
+                    "xp_column": columns[xp_sheet.title],
+                    "xp_index": ({r.userid: [r.username, r.total_xp, r.xp_row]
+                                  for r in user_records if r.xp_row is not None}
+                                 if xp_index_loaded else None),
+                    "attendance_index": ({r.userid: r.attendance.tolist()
+                                          for r in user_records if r.attendance}
+                                         if attendance_index_loaded else None),
+                    "known_users": known_users if known_users_loaded else None,
+                    "buddy_graph": ({
+                        "active": buddy_graph["active"],
+                        "pending": [request for requesters in buddy_graph["pending_to"].values()
+                                    for request in requesters.values()],
+                    } if buddy_graph["loaded"] else None),
+                    "rollup_index": rollup_index if rollup_loaded else None,
+                    "reminders": list(active_reminders.values()),
+                    "xp_buckets": {day: {user_records[key].userid: xp for key, xp in bucket.items()}
+                                   for day, bucket in xp_buckets.items()},
+                    "quota_ledger": {name: {"day": str(entry["day"]), "used": entry["used"]}
+                                     for name, entry in list(quota_ledger.items())},
+                    "timers": {
+                        video_id: [{
+                            "message": t["message"],
+                            "last_sent": t["last_sent"].isoformat() if t["last_sent"] else None,
+                            "chat_lines": t["chat_lines"],
+                        } for t in stream["timers"]]
+                        for video_id, stream in streams.items()
+                    },
+                }
+                data = json.dumps(snapshot, default=str)
+        
+        # Write to a temp file first so a crash never leaves half a snapshot
+        tmp_path = f"{SNAPSHOT_PATH}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(tmp_path, SNAPSHOT_PATH)
+        logger.debug(f"💾 Saved state snapshot to {SNAPSHOT_PATH}")
+    except Exception as e:
+        logger.error(f"❌ Error saving state snapshot: {e}")
+
+def load_snapshot():
+    """Read the snapshot file, None if it is missing, unreadable or from another version"""
+    if not SNAPSHOT_PATH or not os.path.exists(SNAPSHOT_PATH):
+        return None
+    try:
+        with open(SNAPSHOT_PATH, encoding="utf-8") as f:
+            snapshot = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.error(f"❌ Ignoring unreadable state snapshot: {e}")
+        return None
+    return snapshot if snapshot.get("version") == SNAPSHOT_VERSION else None
+
+def restore_xp_index(snapshot, column):
+    """Restore the XP index, re-reading only rows whose LastUpdated changed"""
+    global xp_index_loaded
+    
+    saved_column = snapshot["xp_column"]
+    if snapshot["xp_index"] is None or len(column) < len(saved_column):
+        return  # Not saved, or rows were deleted, so load from scratch on first use
+    
+    changed_rows = [i + 1 for i, value in enumerate(column)
+                    if i > 0 and (i >= len(saved_column) or saved_column[i] != value)]
+    fetched = get_ranges([f"'{xp_sheet.title}'!A{row}:D{row}" for row in changed_rows])
+    
+    with user_state_lock:
+        for record in user_records:
+            record.total_xp = 0
+            record.xp_row = None
+        for userid, (username, total_xp, row) in snapshot["xp_index"].items():
+            record_xp(userid, username, total_xp, row)
+        for row, values in zip(changed_rows, fetched):
+            cells = (values[0] if values else []) + [""] * len(XP_HEADER)
+            username, userid, total_xp = str(cells[0]), str(cells[1]), cells[2]
+            try:
+                total_xp = int(total_xp or 0)
+            except (TypeError, ValueError):
+                total_xp = 0
+            record_xp(userid, username, total_xp, row)
+            if username and known_users_loaded:
+                known_users.setdefault(username.lower(), userid)
+        xp_index_loaded = True
+    return len(changed_rows)
+
+def restore_attendance_index(snapshot, columns):
+    """Restore attendance dates, reading only rows appended since the save"""
+    global attendance_index_loaded
+    
+    saved_sheets = snapshot["sheets"]
+    titles = [sheet.title for sheet in attendance_sheets()]
+    saved_titles = sorted(title for title in saved_sheets if shard_base(title) == "attendance")
+    if snapshot["attendance_index"] is None or sorted(titles) != saved_titles:
+        return  # Not saved, or the month rolled over since, so load from scratch on first use
+    
+    ranges = []
+    for title in titles:
+        saved, column = saved_sheets[title], columns[title]
+        if column_hash(column[:saved["rows"]]) != saved["hash"]:
+            return  # Rows were edited or deleted, not just appended
+        if len(column) > saved["rows"]:
+            ranges.append(f"'{title}'!A{saved['rows'] + 1}:C{len(column)}")
+    
+    with user_state_lock:
+        for record in user_records:
+            record.attendance = array("i")
+        for userid, days in snapshot["attendance_index"].items():
+            get_user_record(userid, create=True).attendance = array("i", days)
+        for values in get_ranges(ranges):
+            for cells in values:
+                cells = cells + [""] * len(ATTENDANCE_HEADER)
+                date = parse_sheet_time(cells[2])
+                if date:
+                    record_attendance(str(cells[1]), date.date())
+        attendance_index_loaded = True
+    return len(ranges)
+
+def restore_snapshot():
+    """Reconcile the snapshot with the sheets and restore what is still valid"""
+    global known_users_loaded, rollup_loaded
+    
+    snapshot = load_snapshot()
+    if snapshot:
+        restore_quota_ledger(snapshot.get("quota_ledger", {}))
+    if not snapshot or not SHEETS_ENABLED:
+        resume_reminders(None)
+        return
+    
+    with sheet_maintenance_lock.shared():
+        columns = fingerprint_sheets()
+        saved_sheets = snapshot["sheets"]
+        
+        def unchanged(sheet):
+            saved = saved_sheets.get(sheet.title)
+            values = columns[sheet.title]
+            return bool(saved) and saved["rows"] == len(values) and saved["hash"] == column_hash(values)
+        
+        for video_id, timers in snapshot["timers"].items():
+            restored_timers[video_id] = [{
+                "message": t["message"],
+                "last_sent": datetime.fromisoformat(t["last_sent"]) if t["last_sent"] else None,
+                "chat_lines": t["chat_lines"],
+            } for t in timers]
+        
+        if snapshot["known_users"] is not None:
+            with buddy_lock:
+                snapshot["known_users"].update(known_users)
+                known_users.clear()
+                known_users.update(snapshot["known_users"])
+                known_users_loaded = True
+        
+        xp_rows = restore_xp_index(snapshot, columns[xp_sheet.title])
+        attendance_reads = restore_attendance_index(snapshot, columns)
+        
+        if snapshot["buddy_graph"] is not None and unchanged(buddy_sheet) and unchanged(buddy_requests_sheet):
+            with buddy_lock:
+                buddy_graph["active"] = snapshot["buddy_graph"]["active"]
+                buddy_graph["pending_to"] = {}
+                buddy_graph["pending_from"] = {}
+                for pending in snapshot["buddy_graph"]["pending"]:
+                    _add_pending_request(pending)
+                buddy_graph["loaded"] = True
+        
+        for day, bucket in snapshot.get("xp_buckets", {}).items():
+            for userid, xp in bucket.items():
+                record_xp_award(userid, xp, int(day))
+        
+        if snapshot["rollup_index"] is not None and unchanged(rollup_sheet):
+            rollup_index.clear()
+            rollup_index.update(snapshot["rollup_index"])
+            rollup_loaded = True
+        
+        resume_reminders(snapshot["reminders"] if unchanged(reminder_sheet) else None)
+    
+    logger.info(f"💾 Restored snapshot from {snapshot['saved_at']}: "
+                f"xp {'reloads later' if xp_rows is None else f'{xp_rows} rows re-read'}, "
+                f"attendance {'reloads later' if attendance_reads is None else f'{attendance_reads} shards extended'}, "
+                f"buddies {'restored' if buddy_graph['loaded'] else 'reload later'}, "
+                f"rollup {'restored' if rollup_loaded else 'reloads later'}")
+
+def restore_quota_ledger(saved_ledger):
+    """Carry today's YouTube quota spend over a restart"""
+    with quota_lock:
+        for name, saved in saved_ledger.items():
+            entry = _ledger_entry(name)
+            if saved["day"] == str(entry["day"]):
+                entry["used"] = max(entry["used"], saved["used"])
+
+def resume_reminders(saved_reminders):
+    """Restart reminders that were pending at shutdown, from the snapshot or the sheet"""
+    if not SHEETS_ENABLED:
+        return
+    
+    if saved_reminders is None:
+        # No snapshot, or the sheet changed since, so the sheet is the source of truth
+        try:
+            saved_reminders = [{
+                "username": str(row.get('Username', '')),
+                "userid": str(row.get('UserID', '')),
+                "message": str(row.get('Message', '')),
+                "delay_minutes": int(row.get('DelayMinutes', 0) or 0),
+                "reminder_id": str(row.get('ReminderID', '')),
+                "video_id": str(row.get('VideoID') or VIDEO_ID),  # Rows from before VideoID go to the default stream
+                "trigger_time": str(row.get('TriggerTime', '')),
+                "row": i + 2,  # Google Sheets row index
+            } for i, row in enumerate(reminder_sheet.get_all_records()) if str(row.get('Status')) == 'Active']
+        except Exception as e:
+            logger.error(f"❌ Error reading reminders to resume: {e}")
+            return
+    
+    now = datetime.now()
+    resumed = 0
+    for reminder in saved_reminders:
+        trigger_time = parse_sheet_time(reminder["trigger_time"])
+        if (not trigger_time or reminder["reminder_id"] in active_reminders
+                or not owns_user(reminder["userid"])):
+            continue
+        wait_seconds = (trigger_time - now).total_seconds()
+        if wait_seconds < -REMINDER_RESUME_GRACE_MINUTES * 60:
+            logger.warning(f"⚠️ Reminder {reminder['reminder_id']} was due at {trigger_time} and is too late to send")
+            continue
+        start_reminder(reminder, max(0, wait_seconds))
+        resumed += 1
+    
+    if resumed:
+        logger.info(f"⏰ Resumed {resumed} pending reminders")
+
+def snapshot_worker():
+    """Background worker that saves the snapshot on a schedule"""
+    while True:
+        time.sleep(SNAPSHOT_INTERVAL_SECONDS)
+        save_snapshot()
+
+def handle_shutdown_signal(signum, frame):
+    """Exit cleanly on SIGTERM so atexit saves the snapshot"""
+    logger.info(f"👋 Received signal {signum}, shutting down")
+    sys.exit(0)
+
+def start_snapshot_system():
+    """Restore the last snapshot and keep saving new ones"""
+    try:
+        restore_snapshot()
+    except Exception as e:
+        logger.error(f"❌ Error restoring state snapshot, loading from the sheets instead: {e}")
+    
+    if not SNAPSHOT_PATH:
+        return
+    
+    atexit.register(save_snapshot)
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, handle_shutdown_signal)
+    
+    snapshot_thread = threading.Thread(target=snapshot_worker, daemon=True)
+    snapshot_thread.start()
+    logger.info(f"✅ Saving state snapshots to {SNAPSHOT_PATH} every {SNAPSHOT_INTERVAL_SECONDS}s")
+
+# === Change Detection ===
+# Moderators fix rows by hand in the spreadsheet. Every CHANGE_POLL_SECONDS
+# the bot asks Drive for the file's modifiedTime, one small request. Only
+# when that moved are the watched sheets read in one values_batch_get and
+# hashed row by row. A sheet counts as edited by hand when rows were deleted
+# or a changed row is not one the bot wrote since the last probe. Only
+# those sheets are reloaded, through the same hooks archival uses. In cluster
+# mode the leader probes and broadcasts. The other instances send the rows
+# they wrote to the leader as one cluster event per poll, so their writes
+# are not taken for manual edits. A write made in the last cluster poll
+# before a probe may still reach the leader too late and cost one reload.
+DRIVE_FILES_URL = "https://www.googleapis.com/drive/v3/files"
+
+# Columns hashed per base sheet title
+CHANGE_PROBE_COLUMNS = {
+    "xp": "A:D",
+    "attendance": "A:C",
+    "session": "A:F",
+    "task": "A:F",
+    "goal": "A:F",
+    "buddy": "A:H",
+    "buddy_requests": "A:F",
+    "reminders": "A:J",
+    "rollup": "A:L",
+}
+
+sheet_probes = {}  # worksheet title -> row hashes from the last probe
+
+def spreadsheet_modified_time():
+    """Drive modifiedTime of the spreadsheet, changes on any edit"""
+    response = client.request("get", f"{DRIVE_FILES_URL}/{spreadsheet.id}",
+                              params={"fields": "modifiedTime", "supportsAllDrives": True})
+    return response.json().get("modifiedTime")
+
+def watched_sheets():
+    return ([xp_sheet, task_sheet, goal_sheet, buddy_sheet, buddy_requests_sheet, reminder_sheet, rollup_sheet]
+            + session_sheets() + attendance_sheets())
+
+def probe_sheets():
+    """Hash the watched sheets, returns the titles that were edited outside the bot"""
+    with sheet_maintenance_lock.shared():
+        sheets = watched_sheets()
+        ranges = [f"'{sheet.title}'!{CHANGE_PROBE_COLUMNS[shard_base(sheet.title)]}" for sheet in sheets]
+        with sheet_write_lock:
+            written = {sheet.title: own_sheet_writes.pop(sheet.title, set()) for sheet in sheets}
+        values = get_ranges(ranges)
+        # Commands keep writing during the read. Rows written meanwhile are
+        # excused now and stay recorded for the next probe, whether or not
+        # the read saw them.
+        with sheet_write_lock:
+            for sheet in sheets:
+                during = own_sheet_writes.get(sheet.title, set())
+                if written[sheet.title] is not None:
+                    written[sheet.title] = None if during is None else written[sheet.title] | during
+    
+    edited = []
+    for sheet, rows in zip(sheets, values):
+        hashes = [hash(tuple(row)) for row in rows]
+        previous = sheet_probes.get(sheet.title)
+        sheet_probes[sheet.title] = hashes
+        if previous is None or written[sheet.title] is None:
+            continue  # New to the probe, or rows moved here, take as the new baseline
+        
+        changed = {i + 1 for i, (old, new) in enumerate(zip(previous, hashes)) if old != new}
+        changed.update(range(len(previous) + 1, len(hashes) + 1))
+        if len(hashes) < len(previous) or changed - written[sheet.title]:
+            edited.append(sheet.title)
+    return edited
+
+def flush_sheet_writes():
+    """Send the rows this instance wrote to the leader, which does the probing"""
+    if is_cluster_leader():
+        return
+    with sheet_write_lock:
+        writes = {title: None if rows is None else sorted(rows) for title, rows in own_sheet_writes.items()}
+        own_sheet_writes.clear()
+    if writes:
+        publish_cluster_event("sheet_writes", writes)
+
+def apply_peer_sheet_writes(payload):
+    """Count rows another instance wrote as the bot's own on the next probe"""
+    if not is_cluster_leader():
+        return
+    for title, rows in payload.items():
+        note_sheet_write(title, None if rows is None else set(rows))
+
+def change_detection_worker():
+    """Background worker that reloads sheets edited by hand"""
+    last_modified = None
+    while True:
+        time.sleep(CHANGE_POLL_SECONDS)
+        if not is_cluster_leader():
+            # A stale baseline would flag every write made meanwhile
+            last_modified = None
+            sheet_probes.clear()
+            continue
+        
+        try:
+            modified = spreadsheet_modified_time()
+            if modified == last_modified:
+                continue
             
-            # Handle study bot commands
-            response = process_command(c.message, c.author.name, c.author.channelId)
+            for title in probe_sheets():
+                logger.info(f"🔄 Sheet {title} was edited outside the bot, reloading it")
+                increment_metric("sheet_changes_detected")
+                notify_sheet_rewritten(title)
+            last_modified = modified
+        except Exception as e:
+            logger.error(f"❌ Change detection error: {e}")
+
+def start_change_detection():
+    """Watch the spreadsheet for manual edits"""
+    if not CHANGE_POLL_SECONDS or not SHEETS_ENABLED:
+        return
+    
+    change_thread = threading.Thread(target=change_detection_worker, daemon=True)
+    change_thread.start()
+    logger.info(f"✅ Checking the spreadsheet for manual edits every {CHANGE_POLL_SECONDS}s")
+
+# === Chat Reader Supervision ===
+# run_stream supervises a reader thread per stream. The reader records
+# when its current connect or poll started. If the chat ends, the reader
+# dies, or one poll takes longer than CHAT_STALL_SECONDS, the supervisor
+# abandons that reader and reconnects after a jittered exponential backoff.
+# Time spent answering commands is not a stall, however long the sheets
+# take. An abandoned reader stops before its next item because its
+# generation is out of date. Replays resume
+# from the last continuation token. Live chats start a few seconds back,
+# and the message de-duplication drops the overlap. The live chat ID is
+# looked up again, while caches, indexes, timers and cluster state stay
+# as they are, so a reconnect takes seconds.
+CHAT_STALL_SECONDS = float(os.getenv("CHAT_STALL_SECONDS", "60"))
+CHAT_RECONNECT_BASE_SECONDS = float(os.getenv("CHAT_RECONNECT_BASE_SECONDS", "1"))
+CHAT_RECONNECT_MAX_SECONDS = float(os.getenv("CHAT_RECONNECT_MAX_SECONDS", "120"))
+CHAT_HEALTHY_SECONDS = 60  # A reader that lived this long resets the backoff
+
+def handle_chat_item(stream, c):
+    """Log, count and answer one chat item"""
+    video_id = stream["video_id"]
+    
+    # Redelivered items are dropped before they count or reach a handler
+    if is_duplicate_message(chat_message_id(c)):
+        return
+    
+    log_chat_line(stream, c)
+    
+    # Increment chat count for timer system
+    increment_chat_count(stream)
+    
+    # Keep the username index warm for !buddy @username lookups, plain chatters included
+    remember_user(c.author.name, c.author.channelId)
+    
+    # Another instance answers users outside this one's partitions
+    if not owns_user(c.author.channelId):
+        return
+    
+    # Handle original !hello command
+    if "!hello" in c.message.lower():
+        reply = f"Hi {c.author.name} !"
+        post_reply(video_id, reply)
+    
+    # Handle study bot commands, plain chat never starts with "!"
+    if not c.message.strip().startswith("!"):
+        return
+    
+    started = time.perf_counter()
+    command = c.message.strip().split(" ", 1)[0].lower()
+    with start_trace(command, user=c.author.channelId, stream=video_id) as command_trace:
+        try:
+            wait_for_cluster_maintenance()
+            with span("process_command"), sheet_maintenance_lock.shared(), command_reads_scope():
+                response = process_command(c.message, c.author.name, c.author.channelId, video_id)
             if response:
-                send_message(VIDEO_ID, response, ACCESS_TOKEN)
-                
+                with span("send_message"):
+                    post_reply(video_id, response)
+            for rank_up in pop_rank_ups(c.author.channelId):
+                with span("send_message", kind="rank_up"):
+                    post_reply(video_id, rank_up)
+            outcome = "replied" if response else "no_reply"
+        except Exception:
+            logger.exception(f"❌ Error handling: {c.message}")
+            outcome = "error"
+        command_trace["attrs"]["outcome"] = outcome
+    
+    latency_ms = (time.perf_counter() - started) * 1000
+    log_command(stream, command, c.author.channelId, latency_ms, outcome)
+
+def read_chat(stream, generation):
+    """Poll one pytchat connection until it ends or the supervisor replaces it"""
+    video_id = stream["video_id"]
+    options = {"video_id": video_id, "interruptable": False}  # Reader threads can't install pytchat's SIGINT handler
+    if stream["is_replay"] and stream["continuation"]:
+        options["replay_continuation"] = stream["continuation"]
+    stream["poll_started"] = time.monotonic()
+    try:
+        chat = pytchat.create(**options)
+    except Exception as e:
+        logger.error(f"❌ Error connecting to chat for {video_id}: {e}")
+        return
+    finally:
+        if stream["reader_generation"] == generation:
+            stream["poll_started"] = None
+    stream["chat"] = chat
+    stream["is_replay"] = chat.is_replay()
+    logger.info(f"✅ Bot started for {video_id}...")
+    
+    while chat.is_alive() and stream["reader_generation"] == generation:
+        stream["poll_started"] = time.monotonic()
+        items = chat.get()
+        if stream["reader_generation"] != generation:
+            break  # Abandoned while this poll was stuck, the new reader owns the chat now
+        stream["poll_started"] = None
+        stream["continuation"] = chat.continuation
+        
+        for c in items.sync_items():
+            if stream["reader_generation"] != generation:
+                return  # Retired mid-batch, the new reader replays from its own position
+            handle_chat_item(stream, c)
+        
         time.sleep(1)
+    
+    try:
+        chat.raise_for_status()
+    except Exception as e:
+        logger.warning(f"⚠️ Chat reader for {video_id} stopped: {e}")
+
+def run_stream(stream):
+    """Keep a chat reader running for one stream, reconnecting with backoff"""
+    video_id = stream["video_id"]
+    failures = 0
+    
+    while True:
+        stream["reader_generation"] += 1
+        generation = stream["reader_generation"]
+        stream["poll_started"] = None
+        started = time.monotonic()
+        reader = threading.Thread(target=read_chat, args=(stream, generation), daemon=True)
+        reader.start()
+        
+        # Watch the reader until it ends or stops polling
+        while reader.is_alive():
+            reader.join(timeout=min(5, CHAT_STALL_SECONDS))
+            poll_started = stream["poll_started"]
+            if reader.is_alive() and poll_started is not None and time.monotonic() - poll_started > CHAT_STALL_SECONDS:
+                logger.warning(f"⚠️ Chat reader for {video_id} stalled for {CHAT_STALL_SECONDS:.0f}s, reconnecting")
+                increment_metric("chat_stalls")
+                try:
+                    stream["chat"].terminate()
+                except Exception:
+                    pass
+                break
+        
+        stream["reader_generation"] += 1  # Retire the reader, even if it is still stuck in a poll
+        failures = 0 if time.monotonic() - started > CHAT_HEALTHY_SECONDS else failures + 1
+        delay = min(CHAT_RECONNECT_MAX_SECONDS, CHAT_RECONNECT_BASE_SECONDS * 2 ** failures)
+        delay *= random.uniform(0.5, 1.5)
+        logger.warning(f"⚠️ Chat ended for {video_id}, reconnecting in {delay:.1f}s")
+        increment_metric("chat_reconnects")
+        time.sleep(delay)
+        
+        # The stream may have a new live chat after an outage
+        stream["live_chat_id"] = None
+        try:
+            get_live_chat_id(video_id, ACCESS_TOKEN)
+        except Exception as e:
+            logger.error(f"❌ Error resolving live chat for {video_id}: {e}")
+
+def run_bot():
+    if not VIDEO_IDS:
+        logger.error("❌ Error: YOUTUBE_VIDEO_ID or YOUTUBE_VIDEO_IDS environment variable not set.")
+        return
+
+    # 🔁 Refresh access token before anything else
+    refresh_access_token_auto()
+    
+    # 🧩 Join the cluster before answering anyone
+    start_cluster_system()
+    
+    # 📊 Count API quota and batch replies when it runs short
+    start_quota_system()
+    
+    # 💾 Restore state saved by the last run
+    start_snapshot_system()
+    
+    # 🔄 Reload sheets moderators edit by hand
+    start_change_detection()
+    
+    # 🗄️ Start archival of old rows
+    start_archive_system()
+
+    # ✅ One chat reader and timer system per stream
+    readers = []
+    for video_id in VIDEO_IDS:
+        stream = create_stream(video_id)
+        start_timer_system(stream)
+        reader = threading.Thread(target=run_stream, args=(stream,), daemon=True)
+        reader.start()
+        readers.append(reader)
+
+    for reader in readers:
+        reader.join()
+
+# === Export ===
+# `python app.py export --out DIR` snapshots every study worksheet in one
+# values_batch_get call and writes typed, columnar files for offline
+# analysis: Parquet when pyarrow is installed, otherwise CSV with a JSON
+# schema next to it. Archived rows are included, from "<sheet>_archive"
+# worksheets or from ARCHIVE_DIR CSV files. Timestamps are parsed to ISO
+# 8601 and durations to integer minutes. With --incremental, only rows whose
+# newest timestamp is after the previous export's cursor are written, as a
+# new part file. Timestamps later than the export's start (a reminder's
+# TriggerTime) don't count, or the cursor would jump past rows added
+# meanwhile. Rows with no timestamp at all are remembered by fingerprint
+# and written once.
+EXPORT_SHEETS = ["attendance", "session", "task", "xp", "goal", "reminders", "buddy", "buddy_requests", "rollup"]
+
+def export_base(title):
+    """Study sheet a title belongs to, so session_2026_10_archive maps to session"""
+    if title.endswith("_archive"):
+        title = title[:-len("_archive")]
+    return shard_base(title)
+
+def export_worksheet_titles():
+    """Export targets: the study sheets plus any month shards and archive sheets"""
+    titles = [sheet.title for sheet in spreadsheet.worksheets()]
+    return [t for t in titles if export_base(t) in EXPORT_SHEETS]
+
+def archive_file_values():
+    """Rows archived to ARCHIVE_DIR, keyed by the archive worksheet title they replace"""
+    archives = {}
+    if not ARCHIVE_DIR or not os.path.isdir(ARCHIVE_DIR):
+        return archives
+    for name in sorted(os.listdir(ARCHIVE_DIR)):
+        base, ext = os.path.splitext(name)
+        if ext != ".csv" or base not in EXPORT_SHEETS:
+            continue
+        with open(os.path.join(ARCHIVE_DIR, name), newline="", encoding="utf-8") as f:
+            archives[f"{base}_archive"] = list(csv.reader(f))
+    return archives
+
+def write_export_part(directory, part_name, header, types, rows, use_parquet):
+    """Write one part file and the schema for its dataset"""
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, "_schema.json"), "w", encoding="utf-8") as f:
+        json.dump({"columns": [{"name": c, "type": types[c]} for c in header]}, f, indent=2)
+    
+    if use_parquet:
+        columns = {c: [row[i] for row in rows] for i, c in enumerate(header)}
+        pyarrow_types = {"timestamp": pa.timestamp("s"), "int": pa.int64(),
+                         "duration_minutes": pa.int64(), "string": pa.string()}
+        table = pa.table({c: pa.array(columns[c], type=pyarrow_types[types[c]]) for c in header})
+        pq.write_table(table, os.path.join(directory, f"{part_name}.parquet"), compression="zstd")
+        return
+    
+    with open(os.path.join(directory, f"{part_name}.csv"), "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        for row in rows:
+            writer.writerow(["" if v is None else v.isoformat() if isinstance(v, datetime) else v for v in row])
+
+def export_all(out_dir, incremental=False, output_format="auto"):
+    """Snapshot every study worksheet into out_dir, returns rows written per sheet"""
+    use_parquet = output_format == "parquet" or (output_format == "auto" and pa is not None)
+    if use_parquet and pa is None:
+        raise RuntimeError("pyarrow is not installed, use --format csv")
+    
+    state_path = os.path.join(out_dir, "_export_state.json")
+    state = {}
+    if incremental and os.path.exists(state_path):
+        with open(state_path, encoding="utf-8") as f:
+            state = json.load(f)
+    
+    titles = export_worksheet_titles()
+    batch = spreadsheet.values_batch_get(
+        [f"'{title}'" for title in titles],
+        params={"valueRenderOption": "UNFORMATTED_VALUE"}
+    )
+    datasets = [(title, value_range.get("values", []))
+                for title, value_range in zip(titles, batch.get("valueRanges", []))]
+    # Archived CSV rows are plain strings; parse_cell_value types them like sheet cells
+    datasets += [(title, values) for title, values in archive_file_values().items()
+                 if title not in titles]
+    
+    started = datetime.now()
+    part_name = f"part-{started.strftime('%Y%m%d%H%M%S')}"
+    untimed = state.setdefault("_untimed", {})  # title -> fingerprints of rows without a timestamp
+    written = {}
+    for title, values in datasets:
+        if not values:
+            continue
+        header = [str(c) for c in values[0]]
+        types = {c: COLUMN_TYPES.get(c, "string") for c in header}
+        timestamp_columns = [i for i, c in enumerate(header) if types[c] == "timestamp"]
+        cursor = state.get(title)
+        cursor_time = datetime.fromisoformat(cursor) if cursor else None
+        seen_untimed = set(untimed.get(title, []))
+        
+        rows = []
+        newest = cursor_time
+        for raw in values[1:]:
+            raw = list(raw) + [""] * (len(header) - len(raw))
+            row = [parse_cell_value(raw[i], types[c]) for i, c in enumerate(header)]
+            # A row counts as changed at its newest timestamp (e.g. EndTime for sessions)
+            row_times = [row[i] for i in timestamp_columns if row[i] is not None and row[i] <= started]
+            row_time = max(row_times) if row_times else None
+            if row_time is None:
+                fingerprint = hashlib.sha1(json.dumps(raw, default=str).encode("utf-8")).hexdigest()
+                if incremental and fingerprint in seen_untimed:
+                    continue
+                seen_untimed.add(fingerprint)
+            elif cursor_time and row_time <= cursor_time:
+                continue
+            rows.append(row)
+            if row_time and (newest is None or row_time > newest):
+                newest = row_time
+        
+        if rows:
+            write_export_part(os.path.join(out_dir, title), part_name, header, types, rows, use_parquet)
+        if newest:
+            state[title] = newest.isoformat()
+        if seen_untimed:
+            untimed[title] = sorted(seen_untimed)
+        written[title] = len(rows)
+    
+    os.makedirs(out_dir, exist_ok=True)
+    with open(state_path, "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=2)
+    return written
+
+def run_export_cli(argv):
+    parser = argparse.ArgumentParser(prog="app.py export", description="Export StudyPlusData worksheets")
+    parser.add_argument("--out", default="export", help="output directory")
+    parser.add_argument("--incremental", action="store_true", help="only rows changed since the last export")
+    parser.add_argument("--format", choices=["auto", "csv", "parquet"], default="auto")
+    args = parser.parse_args(argv)
+    
+    if not SHEETS_ENABLED:
+        logger.error("❌ Google Sheets is not connected, nothing to export")
+        return 1
+    
+    written = export_all(args.out, incremental=args.incremental, output_format=args.format)
+    for title, count in written.items():
+        logger.info(f"📦 Exported {count} rows from {title}")
+    return 0
+
+# === State Benchmark ===
+# `python app.py bench-state --users N` builds N synthetic viewers in the
+# layouts below and prints bytes per user, measured with tracemalloc.
+def bench_state(users, days):
+    """Return bytes per user for row dicts, the old dict index and UserRecords"""
+    import tracemalloc
+    
+    today = datetime.now().date()
+    userids = [f"UC{i:022d}" for i in range(users)]
+    
+    def sheet_rows():
+        # What get_all_records returns: one dict per xp row and per attendance row
+        rows = [{"Username": f"viewer{i}", "UserID": userid, "TotalXP": 100 + i, "LastUpdated": "2026-01-01 00:00:00"}
+                for i, userid in enumerate(userids)]
+        rows += [{"Username": f"viewer{i}", "UserID": userid,
+                  "Date": f"{today - timedelta(days=d)} 09:00:00"}
+                 for i, userid in enumerate(userids) for d in range(days)]
+        return rows
+    
+    def dict_index():
+        xp = {str(userid): {"username": f"viewer{i}", "total_xp": 100 + i, "row": i + 2}
+              for i, userid in enumerate(userids)}
+        attendance = {str(userid): {today - timedelta(days=d) for d in range(days)} for userid in userids}
+        return xp, attendance
+    
+    def compact():
+        keys, records = {}, []
+        for i, userid in enumerate(userids):
+            record = UserRecord(sys.intern(str(userid)))
+            record.username = f"viewer{i}"
+            record.total_xp = 100 + i
+            record.xp_row = i + 2
+            record.attendance = array("i", range(today.toordinal() - days + 1, today.toordinal() + 1))
+            keys[record.userid] = len(records)
+            records.append(record)
+        return keys, records
+    
+    results = {}
+    for name, build in (("sheet rows", sheet_rows), ("dict index", dict_index), ("UserRecord", compact)):
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        built = build()
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        size = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+        results[name] = size / users
+        del built
+    return results
+
+def run_bench_state_cli(argv):
+    parser = argparse.ArgumentParser(prog="app.py bench-state", description="Measure memory per user of the user state")
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--days", type=int, default=30, help="attendance days per user")
+    args = parser.parse_args(argv)
+    
+    results = bench_state(args.users, args.days)
+    for name, per_user in results.items():
+        print(f"{name:>12}: {per_user:8.0f} bytes/user, {per_user * args.users / (1024 * 1024):8.1f} MB total")
+    print(f"Budget USER_STATE_BUDGET_MB={USER_STATE_BUDGET_MB:.0f} fits about "
+          f"{int(USER_STATE_BUDGET_MB * 1024 * 1024 / results['UserRecord'])} users")
+    return 0
 
 @app.route("/")
 def home():
@@ -1437,11 +4938,222 @@ def home():
 def ping():
     return "🟢 YouTube Study Bot is alive!"
 
+@app.route("/analytics/<window>")
+def analytics_endpoint(window):
+    """Community study stats for a window, plus one user's with ?user=<channel id>"""
+    if window not in ANALYTICS_WINDOWS:
+        abort(404)
+    if not SHEETS_ENABLED:
+        return jsonify({"error": "Google Sheets is not connected"}), 503
+    
+    aggregates = get_window_aggregates(window)
+    result = {
+        "window": window,
+        "community": dict(window_stats(aggregates), active_users=aggregates["active_users"]),
+    }
+    userid = request.args.get("user")
+    if userid:
+        result["user"] = window_stats(aggregates, userid)
+    return jsonify(result)
+
+@app.route("/quota")
+def quota_status():
+    names = [cred["name"] for cred in credentials] or ["default"]
+    projects = {}
+    for name in names:
+        projected = projected_quota_usage(name)
+        with quota_lock:
+            used = _ledger_entry(name)["used"]
+        projects[name] = {"used": used, "budget": project_budget(name), "projected": round(projected)}
+    return jsonify({"current_project": current_project(), "digest_mode": digest_mode, "projects": projects})
+
+@app.route("/cluster")
+def cluster_status():
+    return jsonify({
+        "instance_id": INSTANCE_ID,
+        "enabled": bool(CLUSTER_DB),
+        "leader": is_cluster_leader(),
+        "partitions": sorted(owned_partitions)
+    })
+
+# === Profiling ===
+# A sampling profiler that can be started against the live bot. A sampler
+# thread snapshots every thread's stack (chat readers, timer workers,
+# reminder threads, Flask) at a fixed interval. Results come back as
+# collapsed stacks for flame graphs, or as a pstats-style table of
+# self/cumulative samples per function. Nothing runs until an endpoint
+# starts it.
+profiler_lock = threading.Lock()
+profiler = {
+    "running": False,
+    "stop_event": None,
+    "thread": None,
+    "stacks": Counter(),  # "thread;outer;...;inner" -> samples
+    "started_at": None,
+    "interval": 0.01,
+}
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def _sample_stacks(stop_event, interval, deadline):
+    """Sampler loop, records one stack per thread per tick"""
+    own_id = threading.get_ident()
+    names = {}
+    while not stop_event.is_set() and time.monotonic() < deadline:
+        if len(names) != threading.active_count():
+            names = {t.ident: t.name for t in threading.enumerate()}
+        
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+            labels = []
+            while frame is not None:
+                labels.append(_frame_label(frame))
+                frame = frame.f_back
+            labels.append(names.get(thread_id, str(thread_id)))
+            key = ";".join(reversed(labels))
+            with profiler_lock:
+                profiler["stacks"][key] += 1
+        
+        stop_event.wait(interval)
+    
+    with profiler_lock:
+        profiler["running"] = False
+
+def start_profiler(seconds, interval):
+    """Start sampling for up to seconds, returns False if already running"""
+    with profiler_lock:
+        if profiler["running"]:
+            return False
+        stop_event = threading.Event()
+        profiler.update({
+            "running": True,
+            "stop_event": stop_event,
+            "stacks": Counter(),
+            "started_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "interval": interval,
+        })
+        profiler["thread"] = threading.Thread(
+            target=_sample_stacks,
+            args=(stop_event, interval, time.monotonic() + seconds),
+            name="profiler",
+            daemon=True
+        )
+        profiler["thread"].start()
+    logger.info(f"🔬 Profiler started for {seconds}s every {interval * 1000:.0f}ms")
+    return True
+
+def stop_profiler():
+    """Stop sampling and wait for the sampler to finish"""
+    with profiler_lock:
+        stop_event, sampler = profiler["stop_event"], profiler["thread"]
+    if stop_event:
+        stop_event.set()
+    if sampler:
+        sampler.join()
+
+def format_collapsed(stacks):
+    """Brendan Gregg's collapsed format, one "stack count" per line"""
+    return "\n".join(f"{stack} {count}" for stack, count in stacks.most_common())
+
+def format_pstats(stacks, interval, limit=40):
+    """pstats-like table of self and cumulative time per function, estimated from samples"""
+    self_samples = Counter()
+    total_samples = Counter()
+    for stack, count in stacks.items():
+        frames = stack.split(";")[1:]  # Drop the thread name
+        if not frames:
+            continue
+        self_samples[frames[-1]] += count
+        for label in set(frames):
+            total_samples[label] += count
+    
+    lines = [f"{sum(stacks.values())} samples every {interval * 1000:.0f}ms",
+             "",
+             f"{'self_s':>9} {'cum_s':>9}  function"]
+    for label, cum in total_samples.most_common(limit):
+        lines.append(f"{self_samples[label] * interval:9.3f} {cum * interval:9.3f}  {label}")
+    return "\n".join(lines)
+
+def profiler_report(output_format):
+    with profiler_lock:
+        stacks = Counter(profiler["stacks"])
+        interval = profiler["interval"]
+    if output_format == "pstats":
+        return format_pstats(stacks, interval)
+    return format_collapsed(stacks)
+
+# Debug endpoints are never open: they 404 until DEBUG_TOKEN is set, then ?token= must match
+DEBUG_TOKEN = os.getenv("DEBUG_TOKEN")
+
+def require_debug_token():
+    if not DEBUG_TOKEN:
+        abort(404)
+    if request.args.get("token") != DEBUG_TOKEN:
+        abort(403)
+
+def query_number(name, default, low, high, cast=float):
+    """Numeric query parameter clamped to [low, high], 400 when it isn't a number"""
+    try:
+        value = cast(request.args.get(name, default))
+    except (TypeError, ValueError):
+        abort(400)
+    return min(max(value, low), high)
+
+@app.route("/debug/traces")
+def debug_traces():
+    require_debug_token()
+    limit = query_number("limit", 50, 1, TRACE_BUFFER_SIZE, cast=int)
+    with trace_lock:
+        recent = list(recent_traces)[-limit:]
+        slowest = [entry[2] for entry in sorted(slowest_traces, reverse=True)]
+    return jsonify({"recent": recent[::-1], "slowest": slowest})
+
+@app.route("/debug/profile/start")
+def debug_profile_start():
+    require_debug_token()
+    seconds = query_number("seconds", 30, 1, 600)
+    interval = query_number("interval_ms", 10, 1, 1000) / 1000
+    if not start_profiler(seconds, interval):
+        return jsonify({"error": "profiler already running"}), 409
+    return jsonify({"started": True, "seconds": seconds, "interval_ms": interval * 1000})
+
+@app.route("/debug/profile/stop")
+def debug_profile_stop():
+    require_debug_token()
+    stop_profiler()
+    return Response(profiler_report(request.args.get("format", "collapsed")), mimetype="text/plain")
+
+@app.route("/debug/profile")
+def debug_profile():
+    """Profile for ?seconds=N and return the result in one request"""
+    require_debug_token()
+    seconds = query_number("seconds", 10, 1, 120)
+    interval = query_number("interval_ms", 10, 1, 1000) / 1000
+    if not start_profiler(seconds, interval):
+        return jsonify({"error": "profiler already running"}), 409
+    with profiler_lock:
+        sampler = profiler["thread"]
+    sampler.join()
+    return Response(profiler_report(request.args.get("format", "collapsed")), mimetype="text/plain")
+
+@app.route("/metrics")
+def metrics_endpoint():
+    with metrics_lock:
+        return jsonify({**metrics, **sheets_health()})
+
 def start_flask():
     port = int(os.environ.get("PORT", 10000))
     app.run(host="0.0.0.0", port=port)
 
 # ✅ Start Flask in a thread, run bot in main thread
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "export":
+        sys.exit(run_export_cli(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == "bench-state":
+        sys.exit(run_bench_state_cli(sys.argv[2:]))
+    
     threading.Thread(target=start_flask, daemon=True).start()
     run_bot()  # 🔥 must be in main thread
@@ -0,0 +1,65 @@
+import os
+import sys
+
+import pytest
+
+# The bot configures itself at import time, so the fake backend must be set first
+os.environ["SHEETS_BACKEND"] = "fake"
+os.environ["SHEETS_FAULT_RATE"] = "0"
+os.environ["SHEETS_FAULT_LATENCY_MS"] = "0"
+os.environ["CHANGE_POLL_SECONDS"] = "0"
+os.environ["SNAPSHOT_PATH"] = ""
+os.environ.pop("CLUSTER_DB", None)
+os.environ.pop("ARCHIVE_DIR", None)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as bot_app  # noqa: E402
+
+
+def reset_bot_state(app):
+    """Empty the fake sheets down to their headers and drop every in-memory index"""
+    for sheet in app.client.open("StudyPlusData").sheets.values():
+        del sheet.rows[1:]
+    
+    with app.reminder_lock:
+        for timer in app.reminder_timers.values():
+            timer.cancel()
+        app.reminder_timers.clear()
+        app.active_reminders.clear()
+        app.user_reminders.clear()
+    
+    with app.user_state_lock:
+        app.user_records.clear()
+        app.user_keys.clear()
+    app.xp_index_loaded = app.attendance_index_loaded = app.study_minutes_loaded = False
+    app.known_users.clear()
+    app.known_users_loaded = False
+    app.buddy_graph["loaded"] = False
+    app.rollup_index.clear()
+    app.rollup_loaded = False
+    app.clear_cache()
+    
+    with app.leaderboard_lock:
+        app.xp_buckets.clear()
+        for window in app.LEADERBOARD_WINDOWS:
+            app.window_totals[window].clear()
+            app.window_heaps[window].clear()
+        app.leaderboard_day = None
+    
+    with app.rate_limit_lock:
+        app.user_buckets.clear()
+        app.command_buckets.clear()
+        app.recent_commands.clear()
+    app.seen_messages.clear()
+    app.rank_ups.clear()
+    app.quota_ledger.clear()
+    app.restored_timers.clear()
+    app.sheets_breaker.update(state="closed", failures=0, opened_at=0.0, trips=0, retries=0, rejected=0)
+    app.metrics.clear()
+
+
+@pytest.fixture
+def app():
+    reset_bot_state(bot_app)
+    yield bot_app
+    reset_bot_state(bot_app)
@@ -0,0 +1,68 @@
+import csv
+import json
+import os
+from datetime import datetime, timedelta
+
+
+def sheet_time(value):
+    return value.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def add_reminder(app, reminder_id, created, trigger):
+    app.reminder_sheet.append_row(["Amy", "UC1", "stretch", 30, sheet_time(created), sheet_time(trigger),
+                                   "Active", "", reminder_id, "video"])
+
+
+def exported_rows(out_dir, title):
+    rows = []
+    directory = os.path.join(out_dir, title)
+    for name in sorted(os.listdir(directory)):
+        if name.endswith(".csv"):
+            with open(os.path.join(directory, name), newline="", encoding="utf-8") as f:
+                rows += list(csv.DictReader(f))
+    return rows
+
+
+def test_future_timestamps_do_not_move_the_cursor_ahead(app, tmp_path):
+    now = datetime.now()
+    add_reminder(app, "R1", now - timedelta(minutes=10), now + timedelta(hours=24))
+    assert app.export_all(str(tmp_path), incremental=True, output_format="csv")["reminders"] == 1
+    
+    add_reminder(app, "R2", now - timedelta(minutes=5), now + timedelta(minutes=25))
+    assert app.export_all(str(tmp_path), incremental=True, output_format="csv")["reminders"] == 1
+    
+    with open(tmp_path / "_export_state.json", encoding="utf-8") as f:
+        cursor = datetime.fromisoformat(json.load(f)["reminders"])
+    assert cursor <= datetime.now()
+
+
+def test_incremental_export_skips_rows_already_written(app, tmp_path):
+    now = datetime.now()
+    app.attendance_sheet.append_row(["Amy", "UC1", sheet_time(now - timedelta(days=1))])
+    assert app.export_all(str(tmp_path), incremental=True, output_format="csv")["attendance"] == 1
+    assert app.export_all(str(tmp_path), incremental=True, output_format="csv")["attendance"] == 0
+
+
+def test_rows_without_timestamps_are_written_once(app, tmp_path):
+    app.task_sheet.append_row(["Amy", "UC1", "physics", "", "", "Pending"])
+    assert app.export_all(str(tmp_path), incremental=True, output_format="csv")["task"] == 1
+    assert app.export_all(str(tmp_path), incremental=True, output_format="csv")["task"] == 0
+    
+    app.task_sheet.append_row(["Bob", "UC2", "maths", "", "", "Pending"])
+    assert app.export_all(str(tmp_path), incremental=True, output_format="csv")["task"] == 1
+
+
+def test_archive_csv_files_are_exported(app, tmp_path, monkeypatch):
+    archive_dir = tmp_path / "archive"
+    archive_dir.mkdir()
+    with open(archive_dir / "session.csv", "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(app.SESSION_HEADER)
+        writer.writerow(["Amy", "UC1", "2026-01-01 09:00:00", "2026-01-01 10:00:00", 60, "Completed"])
+    monkeypatch.setattr(app, "ARCHIVE_DIR", str(archive_dir))
+    
+    out_dir = str(tmp_path / "export")
+    assert app.export_all(out_dir, output_format="csv")["session_archive"] == 1
+    row = exported_rows(out_dir, "session_archive")[0]
+    assert row["EndTime"] == "2026-01-01T10:00:00"
+    assert row["Duration"] == "60"
@@ -0,0 +1,58 @@
+from datetime import datetime
+
+
+def window_users(app, window):
+    return {app.user_records[key].userid: xp for key, xp in app.window_totals[window].items()}
+
+
+def test_awards_count_in_the_windows_covering_their_day(app):
+    today = datetime.now().date().toordinal()
+    app.record_xp_award("UC1", 10, today)
+    app.record_xp_award("UC2", 5, today - 3)
+    app.record_xp_award("UC3", 7, today - 10)
+    app.record_xp_award("UC1", 4, today - 1)
+    
+    assert window_users(app, "today") == {"UC1": 10}
+    assert window_users(app, "week") == {"UC1": 14, "UC2": 5}
+    assert window_users(app, "month") == {"UC1": 14, "UC2": 5, "UC3": 7}
+
+
+def test_awards_outside_every_window_are_ignored(app):
+    today = datetime.now().date().toordinal()
+    app.record_xp_award("UC1", 10, today - 30)
+    app.record_xp_award("UC1", 10, today + 1)
+    assert not app.xp_buckets
+    assert window_users(app, "month") == {}
+
+
+def test_advancing_the_day_expires_old_buckets(app):
+    today = datetime.now().date().toordinal()
+    app.record_xp_award("UC1", 10, today)
+    app.record_xp_award("UC2", 5, today - 3)
+    
+    with app.leaderboard_lock:
+        app.advance_leaderboard_day(today + 1)
+    assert window_users(app, "today") == {}
+    assert window_users(app, "week") == {"UC1": 10, "UC2": 5}
+    
+    with app.leaderboard_lock:
+        app.advance_leaderboard_day(today + 5)
+    assert window_users(app, "week") == {"UC1": 10}
+    assert window_users(app, "month") == {"UC1": 10, "UC2": 5}
+    
+    with app.leaderboard_lock:
+        app.advance_leaderboard_day(today + 30)
+    assert window_users(app, "month") == {}
+    assert not app.xp_buckets
+
+
+def test_window_top_orders_by_xp_and_skips_outdated_heap_entries(app):
+    today = datetime.now().date().toordinal()
+    for userid, xp in (("UC1", 10), ("UC2", 30), ("UC3", 20)):
+        app.record_xp_award(userid, xp, today)
+    app.record_xp_award("UC1", 25, today)
+    
+    top = [(app.user_records[key].userid, xp) for key, xp in app.window_top("today", k=2)]
+    assert top == [("UC1", 35), ("UC2", 30)]
+    # Asking again gives the same answer, the heap was restored
+    assert [xp for _, xp in app.window_top("today")] == [35, 30, 20]
@@ -0,0 +1,76 @@
+import pytest
+
+
+def admit(app, *messages, userid="UC1"):
+    return [app.admit_command(userid, message, message.split(" ", 1)[0]) for message in messages]
+
+
+def test_repeated_read_only_command_is_coalesced(app):
+    assert admit(app, "!rank", "!rank") == [True, False]
+    assert app.metrics["commands_coalesced"] == 1
+
+
+def test_coalescing_is_per_user(app):
+    assert admit(app, "!rank", userid="UC1") == [True]
+    assert admit(app, "!rank", userid="UC2") == [True]
+
+
+def test_state_changing_commands_always_run(app):
+    assert admit(app, "!start", "!stop", "!start") == [True, True, True]
+
+
+def test_state_change_clears_coalesced_reads(app):
+    assert admit(app, "!pending", "!task physics ch1", "!pending") == [True, True, True]
+    assert admit(app, "!rank", "!attend", "!rank") == [True, True, True]
+
+
+def test_coalesce_window_expires(app, monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(app.time, "monotonic", lambda: clock[0])
+    assert admit(app, "!top") == [True]
+    clock[0] += app.COALESCE_WINDOW_SECONDS + 1
+    assert admit(app, "!top") == [True]
+
+
+def test_user_bucket_is_refunded_when_the_command_bucket_is_empty(app, monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(app.time, "monotonic", lambda: clock[0])
+    monkeypatch.setattr(app, "RATE_LIMIT_COMMAND_BURST", 1)
+    
+    assert admit(app, "!task a", "!task b") == [True, False]
+    assert app.metrics["commands_rate_limited"] == 1
+    # Only the admitted command took a token from the user bucket
+    assert app.user_buckets["UC1"][0] == pytest.approx(app.RATE_LIMIT_USER_BURST - 1)
+
+
+def test_user_bucket_limits_every_command(app, monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(app.time, "monotonic", lambda: clock[0])
+    monkeypatch.setattr(app, "RATE_LIMIT_USER_BURST", 2)
+    
+    assert admit(app, "!start", "!stop", "!attend") == [True, True, False]
+    clock[0] += app.RATE_LIMIT_USER_REFILL_SECONDS
+    assert admit(app, "!attend") == [True]
+
+
+def test_duplicate_message_ids_are_dropped(app):
+    assert app.is_duplicate_message("m1") is False
+    assert app.is_duplicate_message("m1") is True
+    assert app.is_duplicate_message("m2") is False
+    assert app.metrics["duplicate_messages_dropped"] == 1
+
+
+def test_duplicate_message_ids_expire(app, monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(app.time, "monotonic", lambda: clock[0])
+    assert app.is_duplicate_message("m1") is False
+    clock[0] += app.DEDUP_WINDOW_SECONDS + 1
+    assert app.is_duplicate_message("m1") is False
+
+
+def test_duplicate_message_ids_are_bounded(app, monkeypatch):
+    monkeypatch.setattr(app, "DEDUP_MAX_IDS", 2)
+    for message_id in ("m1", "m2", "m3"):
+        assert app.is_duplicate_message(message_id) is False
+    assert "m1" not in app.seen_messages
+    assert app.is_duplicate_message("m3") is True
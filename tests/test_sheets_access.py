@@ -0,0 +1,103 @@
+import json
+
+import gspread
+import pytest
+import requests
+
+
+def api_error(status):
+    response = requests.Response()
+    response.status_code = status
+    response._content = json.dumps({"error": {"code": status, "message": "test"}}).encode("utf-8")
+    return gspread.exceptions.APIError(response)
+
+
+class Flaky:
+    """Callable that raises the given errors in turn, then returns "ok" """
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+    
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return "ok"
+
+
+@pytest.fixture(autouse=True)
+def no_backoff_sleep(app, monkeypatch):
+    monkeypatch.setattr(app.time, "sleep", lambda seconds: None)
+
+
+def test_rate_limits_are_retried_until_success(app):
+    method = Flaky(api_error(429), api_error(429))
+    assert app.call_sheets(method, (), {}) == "ok"
+    assert method.calls == 3
+    assert app.sheets_breaker["retries"] == 2
+    assert app.sheets_breaker["state"] == "closed"
+    assert app.sheets_breaker["failures"] == 0
+
+
+def test_server_errors_are_not_retried_for_appends(app):
+    method = Flaky(api_error(503))
+    with pytest.raises(gspread.exceptions.APIError):
+        app.call_sheets(method, (), {}, idempotent=False)
+    assert method.calls == 1
+
+
+def test_rate_limits_are_retried_for_appends(app):
+    method = Flaky(api_error(429))
+    assert app.call_sheets(method, (), {}, idempotent=False) == "ok"
+    assert method.calls == 2
+
+
+def test_permanent_errors_raise_at_once_and_keep_the_breaker_closed(app):
+    method = Flaky(api_error(400))
+    with pytest.raises(gspread.exceptions.APIError):
+        app.call_sheets(method, (), {})
+    assert method.calls == 1
+    assert app.sheets_breaker["failures"] == 0
+
+
+def test_retries_stop_at_the_deadline(app, monkeypatch):
+    monkeypatch.setattr(app, "SHEETS_RETRY_DEADLINE_SECONDS", 0)
+    method = Flaky(api_error(500), api_error(500))
+    with pytest.raises(app.SheetsUnavailable):
+        app.call_sheets(method, (), {})
+    assert method.calls == 1
+
+
+def test_breaker_opens_rejects_and_recovers_after_cooldown(app, monkeypatch):
+    monkeypatch.setattr(app, "SHEETS_BREAKER_FAILURES", 2)
+    monkeypatch.setattr(app, "SHEETS_RETRY_DEADLINE_SECONDS", 0)
+    
+    for _ in range(2):
+        with pytest.raises(app.SheetsUnavailable):
+            app.call_sheets(Flaky(api_error(503)), (), {})
+    assert app.sheets_breaker["state"] == "open"
+    assert app.sheets_breaker["trips"] == 1
+    
+    # Open: calls fail without reaching Sheets
+    method = Flaky()
+    with pytest.raises(app.SheetsUnavailable):
+        app.call_sheets(method, (), {})
+    assert method.calls == 0
+    assert app.sheets_breaker["rejected"] == 1
+    
+    # After the cooldown one trial call goes through and closes the breaker
+    app.sheets_breaker["opened_at"] -= app.SHEETS_BREAKER_COOLDOWN_SECONDS
+    assert app.call_sheets(method, (), {}) == "ok"
+    assert app.sheets_breaker["state"] == "closed"
+    assert app.sheets_health()["sheets_breaker_state"] == "closed"
+
+
+def test_failed_trial_call_reopens_the_breaker(app, monkeypatch):
+    monkeypatch.setattr(app, "SHEETS_RETRY_DEADLINE_SECONDS", 0)
+    app.sheets_breaker.update(state="open", opened_at=app.time.monotonic() - app.SHEETS_BREAKER_COOLDOWN_SECONDS)
+    
+    with pytest.raises(app.SheetsUnavailable):
+        app.call_sheets(Flaky(api_error(503)), (), {})
+    assert app.sheets_breaker["state"] == "open"
+    with pytest.raises(app.SheetsUnavailable):
+        app.call_sheets(Flaky(), (), {})
@@ -0,0 +1,85 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+
+@pytest.fixture
+def snapshot_path(app, tmp_path, monkeypatch):
+    path = tmp_path / "state_snapshot.json"
+    monkeypatch.setattr(app, "SNAPSHOT_PATH", str(path))
+    return path
+
+
+def forget_memory(app):
+    """What a restart loses: every in-memory index"""
+    with app.user_state_lock:
+        app.user_records.clear()
+        app.user_keys.clear()
+    app.xp_index_loaded = app.attendance_index_loaded = False
+    with app.leaderboard_lock:
+        app.xp_buckets.clear()
+        for window in app.LEADERBOARD_WINDOWS:
+            app.window_totals[window].clear()
+            app.window_heaps[window].clear()
+        app.leaderboard_day = None
+    app.quota_ledger.clear()
+    app.clear_cache()
+
+
+def add_xp_row(app, username, userid, total_xp):
+    app.xp_sheet.append_row([username, userid, total_xp, datetime.now().strftime("%Y-%m-%d %H:%M:%S")])
+
+
+def test_snapshot_round_trip_restores_indexes(app, snapshot_path):
+    add_xp_row(app, "Amy", "UC1", 40)
+    add_xp_row(app, "Bob", "UC2", 15)
+    yesterday = datetime.now() - timedelta(days=1)
+    app.attendance_sheet.append_row(["Amy", "UC1", yesterday.strftime("%Y-%m-%d %H:%M:%S")])
+    app.ensure_xp_index()
+    app.ensure_attendance_index()
+    app.record_xp_award("UC1", 40)
+    app.charge_quota("liveChatMessages.insert")
+    
+    app.save_snapshot()
+    assert snapshot_path.exists()
+    forget_memory(app)
+    
+    app.restore_snapshot()
+    
+    # Loaded from the snapshot, not on first use
+    assert app.xp_index_loaded and app.attendance_index_loaded
+    assert app.get_user_record("UC1").total_xp == 40
+    assert app.get_user_record("UC2").username == "Bob"
+    assert app.attended_on("UC1", yesterday.date())
+    assert [(app.user_records[key].userid, xp) for key, xp in app.window_top("today")] == [("UC1", 40)]
+    assert app.quota_ledger[app.current_project()]["used"] == app.QUOTA_COSTS["liveChatMessages.insert"]
+
+
+def test_restore_picks_up_rows_written_after_the_save(app, snapshot_path):
+    add_xp_row(app, "Amy", "UC1", 40)
+    app.ensure_xp_index()
+    app.save_snapshot()
+    
+    add_xp_row(app, "Cat", "UC3", 5)
+    forget_memory(app)
+    app.restore_snapshot()
+    
+    assert app.xp_index_loaded
+    assert app.get_user_record("UC1").total_xp == 40
+    assert app.get_user_record("UC3").total_xp == 5
+    assert app.get_user_record("UC3").xp_row == 3
+
+
+def test_restore_reloads_from_scratch_when_rows_were_deleted(app, snapshot_path):
+    add_xp_row(app, "Amy", "UC1", 40)
+    add_xp_row(app, "Bob", "UC2", 15)
+    app.ensure_xp_index()
+    app.save_snapshot()
+    
+    del app.client.open("StudyPlusData").sheets["xp"].rows[1]
+    forget_memory(app)
+    app.restore_snapshot()
+    
+    assert not app.xp_index_loaded
+    app.ensure_xp_index()
+    assert app.get_user_record("UC2").xp_row == 2